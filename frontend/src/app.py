@@ -1,6 +1,9 @@
 import os
+import re
+import json
 from flask import Flask, render_template, request, jsonify, g, make_response, url_for, redirect, abort, send_from_directory
 import requests
+from requests.adapters import HTTPAdapter
 from flask_htmx import HTMX
 from flask_talisman import Talisman
 from flask_limiter import Limiter
@@ -15,6 +18,33 @@ dataset_names = ['sitzungsprotokolle', 'zusatzmaterial',
                  'corona_MPK', 'corona_ALL', 'corona_ABSOLUTELY_EVERYTHING',
                  'pei_files', 'kanzleramt_mails']
 
+API_URL = os.getenv('RKI_API_URL', 'http://api:5000/rkiapi/search')
+
+# connections to the API are kept alive and reused. RKI_API_POOL_SIZE is the
+# max. number of idle connections kept per worker
+API_POOL_SIZE = int(os.getenv('RKI_API_POOL_SIZE', 10))
+API_TIMEOUT = (float(os.getenv('RKI_API_CONNECT_TIMEOUT', 3)),
+               float(os.getenv('RKI_API_READ_TIMEOUT', 60)))
+
+# chunks of the API response streamed through /rkileaks_api
+STREAM_CHUNK_SIZE = 64 * 1024
+
+api_session = None
+api_session_pid = None
+
+
+def get_api_session():
+    # one session per worker process: gunicorn forks after import
+    global api_session, api_session_pid
+    if api_session is None or api_session_pid != os.getpid():
+        api_session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=API_POOL_SIZE)
+        api_session.mount('http://', adapter)
+        api_session.mount('https://', adapter)
+        api_session_pid = os.getpid()
+    return api_session
+
+
 app = Flask(__name__)
 htmx = HTMX(app)
 
@@ -209,16 +239,14 @@ def search():
     if dataset not in dataset_names:
         dataset = 'sitzungsprotokolle'
 
-    api_url = 'http://api:5000/rkiapi/search'
-
     try:
-        response = requests.get(api_url, params={
+        response = get_api_session().get(API_URL, params={
             'dataset': dataset,
             'query': query,
             'k_results': num_results,
             'remove_dupes': remove_dupes,
             'auto_context_size': result_size
-        })
+        }, timeout=API_TIMEOUT)
         response.raise_for_status()  # Raise an exception for HTTP errors
     except requests.exceptions.HTTPError as http_err:
         print(f"HTTP error occurred: {http_err}", flush=True)
@@ -294,57 +322,92 @@ def page_not_found(e):
     return render_template('404.html'), 404
 
 
+# "doc_path": "..." in the JSON of the API, compact or not. Quotes inside
+# strings are escaped, so "doc_path" is a key or a whole string value
+DOC_PATH_KEY = b'"doc_path"'
+DOC_PATH_KEY_RE = re.compile(rb'"doc_path"\s*:\s*"')
+# the key at the end of a chunk, its value still to come
+DOC_PATH_KEY_END_RE = re.compile(rb'"doc_path"\s*(?::\s*)?')
+JSON_STRING_RE = re.compile(rb'((?:[^"\\]|\\.)*)"')
+
+
+def rewrite_doc_paths(chunks):
+    """
+    rewrite the doc_path values in the JSON text chunks with get_foreign_path()
+    while they pass through
+    """
+    buffer = b''
+    for chunk in chunks:
+        buffer += chunk
+        out = []
+        while True:
+            i = buffer.find(DOC_PATH_KEY)
+            if i < 0:
+                # the end could be the start of a key
+                keep = len(DOC_PATH_KEY) - 1
+                out.append(buffer[:-keep])
+                buffer = buffer[-keep:]
+                break
+            key = DOC_PATH_KEY_RE.match(buffer, i)
+            if key is None:
+                if DOC_PATH_KEY_END_RE.fullmatch(buffer, i):
+                    out.append(buffer[:i])
+                    buffer = buffer[i:]
+                    break
+                # "doc_path" as a value
+                out.append(buffer[:i + 1])
+                buffer = buffer[i + 1:]
+                continue
+            match = JSON_STRING_RE.match(buffer, key.end())
+            if match is None:
+                # the value continues in the next chunk
+                out.append(buffer[:i])
+                buffer = buffer[i:]
+                break
+            doc_path = json.loads(b'"' + match.group(1) + b'"')
+            out.append(buffer[:key.end() - 1])
+            out.append(json.dumps(get_foreign_path(doc_path)).encode())
+            buffer = buffer[match.end():]
+        out = b''.join(out)
+        if out:
+            yield out
+    if buffer:
+        yield buffer
+
+
 # API pass-through endpoint
 @app.route('/rkileaks_api', methods=['GET'])
 @limiter.limit("60 per minute")
 def api():
-    api_url = 'http://api:5000/rkiapi/search'
     query_params = request.args.to_dict()
+    response = None
     try:
-        response = requests.get(api_url, params=query_params)
+        response = get_api_session().get(API_URL, params=query_params, stream=True,
+                                         timeout=API_TIMEOUT)
         response.raise_for_status()  # Raise an exception for HTTP errors
     except requests.exceptions.HTTPError as http_err:
         print(f"HTTP error occurred: {http_err}", flush=True)
         print(f"Response content: {response.content}", flush=True)
+        # streamed responses go back to the pool only when closed
+        response.close()
         return jsonify({"error": "API request failed"}), 400
     except Exception as err:
         print(f"Other error occurred: {err}", flush=True)  # Python 3.3+ only
+        if response is not None:
+            response.close()
         return jsonify({"error": "An error occurred"}), 500
 
-    # Handle JSON response content
-    json_result = []
-    try:
-        json_data = response.json()
-        for result in json_data:
-            meta = result['meta']
-            meta['doc_path'] = get_foreign_path(meta['doc_path'])
-
-            p = result['prev']
-            new_prev = []
-            for d in p:
-                d['doc_path'] = get_foreign_path(d['doc_path'])
-                new_prev.append(d)
-            new_next = []
-            n = result['next']
-            for d in n:
-                d['doc_path'] = get_foreign_path(d['doc_path'])
-                new_next.append(d)
-            new_result = {
-                    'meta': meta,
-                    'prev': new_prev,
-                    'next': new_next,
-                    }
-            json_result.append(new_result)
-
-    except ValueError as json_err:
-        print(f"JSON decode error: {json_err}", flush=True)
-        return jsonify({"error": "Failed to decode JSON response"}), 500
+    def generate():
+        # the connection goes back to the pool when the response is closed
+        try:
+            yield from rewrite_doc_paths(response.iter_content(STREAM_CHUNK_SIZE))
+        finally:
+            response.close()
 
-    
-    # Create a response object using the JSON data
-    flask_response = make_response(jsonify(json_result), response.status_code)
+    # the JSON is streamed through with rewritten paths, not parsed
+    flask_response = app.response_class(generate(), response.status_code)
     for key, value in response.headers.items():
-        if key.lower() not in ['content-length', 'content-encoding']:
+        if key.lower() not in ['content-length', 'content-encoding', 'transfer-encoding', 'connection', 'keep-alive']:
             flask_response.headers[key] = value
 
     return flask_response
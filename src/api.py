@@ -3,6 +3,8 @@ from flask_compress import Compress
 import os
 from dotenv import load_dotenv
 import main
+import metastore
+import querycache
 
 # Load environment variables from the specified .env file if provided
 env_file = os.getenv('FLASK_ENV_FILE', None)
@@ -17,12 +19,19 @@ dataset_name = os.getenv('RKI_DATASET')
 print('Using datasets_dir', datasets_dir)
 print('Using dataset_name', dataset_name)
 
-# N.B. don't save the query embedding cache since its name is fixed here
-#      as to avoid conflicts in multiple workers
-metadata, faiss_index, q_emb_cache = main.get_resources(datasets_dir,
-                                                        dataset_name,
-                                                        query_cache_name='query',
-                                                        max_cache_size=50)
+metadata, faiss_index, _ = main.get_resources(datasets_dir, dataset_name)
+
+# query embeddings are cached on disk, shared by all workers. queries are
+# embedded by the model the dataset was built with
+embedding_config = main.load_embedding_config(datasets_dir, dataset_name)
+q_emb_cache = querycache.QueryEmbeddingCache(
+        os.getenv('RKI_QUERY_CACHE',
+                  os.path.join(datasets_dir, querycache.FILN_QUERY_CACHE)),
+        max_entries=int(os.getenv('RKI_QUERY_CACHE_SIZE', 20000)),
+        backend=embedding_config['backend'],
+        model=embedding_config['model'],
+        dims=embedding_config['dims'],
+        )
 
 app = Flask(__name__)
 Compress(app)
@@ -45,62 +54,61 @@ def process_query(query_text, embedding_cache, faiss_index, metadata,
 
     query_embedding = main.get_query_embeddings(query_text, embedding_cache)
     query_embedding = main.normalize_embeddings(query_embedding)
-    faiss_distances, faiss_indices = main.search_faiss_index(faiss_index,
-                                                             query_embedding,
-                                                             k=k_results)
+    if remove_dupes:
+        # over-fetches until there are k_results unique paragraphs
+        faiss_distances, faiss_indices = main.search_faiss_index_unique(faiss_index,
+                                                                        query_embedding,
+                                                                        metadata,
+                                                                        k=k_results)
+    else:
+        faiss_distances, faiss_indices = main.search_faiss_index(faiss_index,
+                                                                 query_embedding,
+                                                                 k=k_results)
 
     result_indices = faiss_indices[0]
     result_distances = faiss_distances[0]
 
-    results = []
-    result_texts = []
+    kept = []
     for r_no, (idx, dist) in enumerate(zip(result_indices, result_distances)):
-        text = metadata[idx].para
-        if text in result_texts and remove_dupes:
-            continue
-        results.append(format_result(r_no, metadata, idx, dist, auto_context_size))
-        result_texts.append(text)
+        if idx < 0:
+            break
+        kept.append((r_no, idx, dist))
+
+    # context windows of all results at once
+    firsts, lasts = metastore.context_windows(metadata, [idx for _, idx, _ in kept],
+                                              auto_context_size)
+    results = []
+    for (r_no, idx, dist), first, last in zip(kept, firsts, lasts):
+        results.append(format_result(r_no, metadata, idx, dist, auto_context_size,
+                                     window=(first, last)))
     return results
 
-def format_result(result_number, metas, result_index, distance, auto_context_size):
+def format_result(result_number, metas, result_index, distance, auto_context_size,
+                  window=None):
+    """
+    window: (first, last) rows of the context, see metastore.context_windows()
+    """
     meta = metas[result_index]
     text = meta.para
-    filp = meta.doc_path
-    filn = os.path.basename(filp)
+    if window is None:
+        firsts, lasts = metastore.context_windows(metas, [result_index], auto_context_size)
+        window = (firsts[0], lasts[0])
+    first, last = window
 
     prev_metas = []
     next_metas = []
-    total_text = text
-    ctx_iter = 0
-    prev_exhausted = False
-    next_exhausted = False
-    while len(total_text) < auto_context_size:
-        if prev_exhausted and next_exhausted:
-            break
-        ctx_iter += 1
-        # add context before
-        if result_index - ctx_iter >= 0:
-            prev = metas[result_index - ctx_iter]
-            # if same doc, extract text
-            if prev.doc_path == meta.doc_path:
-                # only use if text differs from main text
-                if prev.para != text:
-                    prev_metas.append(prev._asdict())
-                    total_text += prev.para
-            else:
-                prev_exhausted = True
-        # add context after
-        if result_index + ctx_iter < len(metas):
-            next = metas[result_index + ctx_iter]
-            # if same doc, extract text
-            if next.doc_path == meta.doc_path:
-                # only use if text differs from main text
-                if next.para != text:
-                    next_metas.append(next._asdict())
-                    total_text += next.para
-            else:
-                next_exhausted = True
-    prev_metas.reverse()
+    # add context before
+    for index in range(first, result_index):
+        prev = metas[index]
+        # only use if text differs from main text
+        if prev.para != text:
+            prev_metas.append(prev._asdict())
+    # add context after
+    for index in range(result_index + 1, last + 1):
+        next = metas[index]
+        # only use if text differs from main text
+        if next.para != text:
+            next_metas.append(next._asdict())
     meta = meta._asdict()
     meta['dist'] = f'{distance:0.3f}'
     ret = {
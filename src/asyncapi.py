@@ -0,0 +1,132 @@
+"""
+asyncio (ASGI) server for the API of doubleapi.py.
+
+With the Flask app, a request waiting for its query embedding from OpenAI
+occupies a worker thread. Here, embedding requests are awaited on the event
+loop, so one process keeps hundreds of searches in flight. Everything that
+uses the CPU or blocks on files (the query embedding cache, FAISS search,
+formatting the results) runs in a pool of RKI_ASYNC_THREADS threads
+(default 16). Concurrent searches in a dataset are still micro-batched, see
+searchexecutor.py, and concurrent requests for the same uncached query share
+one embedding request.
+
+Datasets, parameters and responses are those of doubleapi.py, which is
+imported for them:
+
+    uvicorn asyncapi:app --host 0.0.0.0 --port 5000
+"""
+
+import os
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.responses import Response
+from starlette.routing import Route
+
+import doubleapi
+import querycache
+
+
+pool = ThreadPoolExecutor(max_workers=int(os.getenv('RKI_ASYNC_THREADS', 16)))
+
+# embedding requests in flight, by (model, dims, normalized text)
+pending_embeddings = {}
+
+
+async def run_in_pool(func, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(pool, functools.partial(func, *args, **kwargs))
+
+
+async def get_query_embedding(qcache, query_text):
+    """
+    the normalized embedding of query_text, as an array of one row
+    """
+    text = querycache.normalize_text(query_text)
+    found = await run_in_pool(qcache.lookup, [text])
+    if text not in found:
+        key = (qcache.model.cache_name, qcache.model.dims, text)
+        task = pending_embeddings.get(key)
+        if task is None:
+            task = asyncio.ensure_future(embed(qcache, text))
+            pending_embeddings[key] = task
+            task.add_done_callback(lambda _: pending_embeddings.pop(key, None))
+        found[text] = await asyncio.shield(task)
+    embedding = np.array([found[text]], dtype='float32')
+    return embedding / np.linalg.norm(embedding, axis=1, keepdims=True)
+
+
+async def embed(qcache, text):
+    embedding, _ = await qcache.model.aget_embeddings(text)
+    await run_in_pool(qcache.store, {text: embedding})
+    return np.asarray(embedding, dtype='float32')
+
+
+def json_response(data, status_code=200):
+    # the same bytes as flask.jsonify
+    return Response(doubleapi.app.json.response(data).get_data(), status_code=status_code,
+                    media_type='application/json')
+
+
+async def search(request):
+    # may load the dataset, see datasetmanager.py
+    params, error = await run_in_pool(doubleapi.parse_search_params, request.query_params)
+    if error:
+        return json_response({"error": error}, 400)
+    print('API passthrough:', params['query'], flush=True)
+
+    cache_key = (params['dataset'], params['query'], params['k_results'],
+                 params['remove_dupes'], params['auto_context_size'], params['mode'])
+    data = doubleapi.result_cache.get(cache_key)
+    if data is not None:
+        return Response(data, media_type='application/json')
+
+    dataset = await run_in_pool(doubleapi.datasets.__getitem__, params['dataset'])
+    query_embedding = None
+    if params['mode'] != 'lexical':
+        query_embedding = await get_query_embedding(dataset['qcache'], params['query'])
+    results = await run_in_pool(doubleapi.process_query, params['query'], dataset['qcache'],
+                                dataset['faiss'], dataset['metadata'],
+                                k_results=params['k_results'],
+                                remove_dupes=params['remove_dupes'],
+                                auto_context_size=params['auto_context_size'],
+                                dataset_name=params['dataset'],
+                                mode=params['mode'],
+                                lexical_index=dataset['lexical'],
+                                query_embedding=query_embedding)
+    response = json_response(results)
+    doubleapi.result_cache.put(cache_key, response.body)
+    return response
+
+
+async def cache_stats(request):
+    return json_response(doubleapi.get_cache_stats())
+
+
+async def dataset_status(request):
+    return json_response(doubleapi.datasets.status())
+
+
+async def search_batch(request):
+    try:
+        body = await request.json()
+    except ValueError:
+        body = None
+    # all uncached queries are embedded in one request, which blocks a
+    # thread of the pool
+    data, status_code = await run_in_pool(doubleapi.run_search_batch, body)
+    return json_response(data, status_code)
+
+
+app = Starlette(
+        routes=[
+            Route('/rkiapi/search', search, methods=['GET']),
+            Route('/rkiapi/search_batch', search_batch, methods=['POST']),
+            Route('/rkiapi/cache_stats', cache_stats, methods=['GET']),
+            Route('/rkiapi/datasets', dataset_status, methods=['GET']),
+        ],
+        middleware=[Middleware(GZipMiddleware, minimum_size=500, compresslevel=6)],
+        )
@@ -1,63 +1,207 @@
-from tqdm import tqdm
+"""
+Pack paragraphs into embedding requests.
+
+A request may carry at most max_tokens tokens and max_batch_size texts.
+create_optimal_batches() packs with best-fit decreasing: paragraphs are
+placed from longest to shortest, each into the fullest batch that still has
+room for it, so few requests are needed. packing_stats() compares the result
+with the lower bound of requests.
+
+Building a dataset is limited by the requests and tokens per minute of the
+OpenAI account. schedule_batches() interleaves big and small batches so that
+every stretch of requests carries the average number of tokens: whichever
+budget limits the build is used up evenly from start to end, instead of the
+big batches exhausting the tokens first and the small ones the requests
+last.
+
+To compare with the previous heuristic on a corpus:
+
+    python src/batchpacking.py ./data/Zusatzmaterial --rpm=3000 --tpm=1000000
+"""
+
+import sys
+import time
+import math
 import heapq
+import bisect
+from tqdm import tqdm
+
+from myargs import parse_args
+
 
+MAX_TOKENS = 8191
+MAX_BATCH_SIZE = 2000
 
-def create_optimal_batches(metas, max_tokens=8191, max_batch_size=2000):
-    # Sort the list of tuples in descending order based on the number of tokens
+
+def create_optimal_batches(metas, max_tokens=MAX_TOKENS, max_batch_size=MAX_BATCH_SIZE):
+    """
+    best-fit decreasing. paragraphs with max_tokens or more tokens are
+    skipped.
+    """
     sorted_metas = sorted(metas, key=lambda x: x.token_length, reverse=True)
+    min_tokens = sorted_metas[-1].token_length if sorted_metas else 0
 
-    # Priority queue to keep track of batches' current sizes
-    heap = []
     batches = []
-
+    # batches that can take more, by free tokens. there are at most
+    # max_tokens distinct values, so the sorted list of them stays short
+    free_values = []
+    open_batches = {}
     num_skipped = 0
 
     for meta in tqdm(sorted_metas):
-        placed = False
         tokens = meta.token_length
+        if tokens >= max_tokens:
+            # heml inline images
+            num_skipped += 1
+            continue
 
-        # Check if there's any batch that can accommodate the current tuple
+        # the fullest batch with room for the paragraph
+        pos = bisect.bisect_left(free_values, tokens)
+        if pos < len(free_values):
+            free = free_values[pos]
+            batch_index = open_batches[free].pop()
+            if not open_batches[free]:
+                del open_batches[free]
+                del free_values[pos]
+        else:
+            batches.append([])
+            free, batch_index = max_tokens, len(batches) - 1
+        batches[batch_index].append(meta)
+        free -= tokens
+        # batches that cannot take even the shortest paragraph are done
+        if free >= min_tokens and len(batches[batch_index]) < max_batch_size:
+            if free not in open_batches:
+                bisect.insort(free_values, free)
+                open_batches[free] = []
+            open_batches[free].append(batch_index)
+    if num_skipped:
+        print('Skipped too long paras', num_skipped)
+    return batches
+
+
+def create_heuristic_batches(metas, max_tokens=MAX_TOKENS, max_batch_size=MAX_BATCH_SIZE):
+    """
+    the previous packer, for comparison: adds each paragraph to the emptiest
+    batch. batches that reach max_batch_size drop out of the heap.
+    """
+    sorted_metas = sorted(metas, key=lambda x: x.token_length, reverse=True)
+    heap = []
+    batches = []
+    for meta in sorted_metas:
+        tokens = meta.token_length
         if heap and heap[0][0] + tokens <= max_tokens:
-            # Get the batch with the smallest current size
             current_batch_size, batch_index = heapq.heappop(heap)
             if len(batches[batch_index]) < max_batch_size:
                 batches[batch_index].append(meta)
-                current_batch_size += tokens
-                # Push the updated batch size back into the heap
-                heapq.heappush(heap, (current_batch_size, batch_index))
-                placed = True
-
-        # If no suitable batch was found, create a new batch
-        if not placed:
-            if meta.token_length >= max_tokens:
-                # raise ValueError("Batch too large", meta.doc_path, meta.token_length)
-                # heml inline images
-                num_skipped += 1
+                heapq.heappush(heap, (current_batch_size + tokens, batch_index))
                 continue
-            batches.append([meta])
-            # Push the new batch into the heap
-            heapq.heappush(heap, (tokens, len(batches) - 1))
-    if num_skipped:
-        print('Skipped too long paras', num_skipped)
+        if tokens >= max_tokens:
+            continue
+        batches.append([meta])
+        heapq.heappush(heap, (tokens, len(batches) - 1))
     return batches
 
 
+def batch_tokens(batch):
+    return sum(meta.token_length for meta in batch)
+
+
+def packing_stats(batches, max_tokens=MAX_TOKENS, max_batch_size=MAX_BATCH_SIZE):
+    """
+    efficiency: the lower bound of requests divided by the requests needed.
+    fill: the share of the token capacity of the requests that is used.
+    """
+    num_items = sum(len(batch) for batch in batches)
+    tokens = sum(batch_tokens(batch) for batch in batches)
+    lower_bound = max(math.ceil(tokens / max_tokens), math.ceil(num_items / max_batch_size))
+    return {
+            'batches': len(batches),
+            'items': num_items,
+            'tokens': tokens,
+            'lower_bound': lower_bound,
+            'efficiency': lower_bound / len(batches) if batches else 1.0,
+            'fill': tokens / (len(batches) * max_tokens) if batches else 1.0,
+           }
+
+
+def schedule_batches(batches, rpm, tpm):
+    """
+    returns the batches in an order that keeps the tokens sent proportional
+    to the requests sent, and the minutes the budgets allow for them
+    """
+    sizes = [batch_tokens(batch) for batch in batches]
+    order = sorted(range(len(batches)), key=sizes.__getitem__)
+    average = sum(sizes) / len(sizes) if sizes else 0
+    scheduled = []
+    sent = 0
+    lo, hi = 0, len(order) - 1
+    while lo <= hi:
+        # take the biggest or the smallest batch, whichever keeps us closer
+        # to the average
+        goal = (len(scheduled) + 1) * average
+        if abs(sent + sizes[order[hi]] - goal) <= abs(sent + sizes[order[lo]] - goal):
+            index = order[hi]
+            hi -= 1
+        else:
+            index = order[lo]
+            lo += 1
+        scheduled.append(batches[index])
+        sent += sizes[index]
+    minutes = max(len(batches) / rpm, sum(sizes) / tpm)
+    return scheduled, minutes
+
+
+def simulate_minutes(token_counts, rpm, tpm):
+    """
+    minutes to send requests of token_counts in order through token buckets
+    of rpm and tpm that start full, like embedscheduler.RateLimiter
+    """
+    now = 0.0
+    requests, tokens = rpm, tpm
+    for n in token_counts:
+        n = min(n, tpm)
+        wait = max(0, (1 - requests) / rpm, (n - tokens) / tpm)
+        now += wait
+        requests = min(rpm, requests + wait * rpm) - 1
+        tokens = min(tpm, tokens + wait * tpm) - n
+    return now
+
+
+def print_stats(name, batches, elapsed, max_tokens, max_batch_size):
+    stats = packing_stats(batches, max_tokens, max_batch_size)
+    print(f'{name:10s}: {stats["batches"]:7d} batches for {stats["items"]} paras, '
+          f'lower bound {stats["lower_bound"]}, efficiency {stats["efficiency"]:.3f}, '
+          f'fill {stats["fill"]:.3f}, {elapsed:.2f}s')
+
+
 if __name__ == '__main__':
-    import sys
     from textloading import read_text_files_by_paragraph
-    metas = read_text_files_by_paragraph(sys.argv[1])
-    max_tokens = 8191
-    batches = create_optimal_batches(metas, max_tokens=max_tokens)
-    print(len(batches))
-    for b in batches[0:5]:
-        bl = sum(m.token_length for m in b)
-        print(bl, len(b))
-    print('...')
-    for b in batches[-5:]:
-        bl = sum(m.token_length for m in b)
-        print(bl, len(b))
 
+    args, kwargs, flags = parse_args(sys.argv[1:])
+    if len(args) != 1:
+        print(f'Usage  : python {sys.argv[0]} data_dir')
+        print(f'Compares the packer with the previous heuristic on the paragraphs of data_dir')
+        print(f'Options: --max_tokens={MAX_TOKENS} --max_batch_size={MAX_BATCH_SIZE} --rpm=3000 --tpm=1000000')
+        sys.exit(1)
+
+    max_tokens = int(kwargs.get('max_tokens', MAX_TOKENS))
+    max_batch_size = int(kwargs.get('max_batch_size', MAX_BATCH_SIZE))
+    rpm = int(kwargs.get('rpm', 3000))
+    tpm = int(kwargs.get('tpm', 1000000))
+    metas = read_text_files_by_paragraph(args[0])
     tokens = [meta.token_length for meta in metas]
+    print(f'{sum(tokens)} total tokens in {len(metas)} paras')
 
+    start = time.time()
+    old_batches = create_heuristic_batches(metas, max_tokens, max_batch_size)
+    print_stats('heuristic', old_batches, time.time() - start, max_tokens, max_batch_size)
+    start = time.time()
+    batches = create_optimal_batches(metas, max_tokens, max_batch_size)
+    print_stats('best fit', batches, time.time() - start, max_tokens, max_batch_size)
 
-    print(f'{sum(tokens)} total tokens in {len(metas)} paras')
+    scheduled, minutes = schedule_batches(batches, rpm, tpm)
+    print(f'At {rpm} rpm and {tpm} tpm:')
+    print(f'  heuristic, packing order: {simulate_minutes([batch_tokens(b) for b in old_batches], rpm, tpm):8.2f} min')
+    print(f'  best fit, packing order : {simulate_minutes([batch_tokens(b) for b in batches], rpm, tpm):8.2f} min')
+    print(f'  best fit, scheduled     : {simulate_minutes([batch_tokens(b) for b in scheduled], rpm, tpm):8.2f} min')
+    print(f'  steady-state limit      : {minutes:8.2f} min')
@@ -0,0 +1,126 @@
+"""
+Dependency-free recursive text chunker.
+
+Produces the same chunks as langchain's RecursiveCharacterTextSplitter with
+its defaults (separators are kept at the start of the following split,
+whitespace is stripped from chunks): the text is split at the first
+separator that occurs in it, splits shorter than chunk_size are merged into
+chunks of up to chunk_size characters that overlap by up to chunk_overlap
+characters, longer splits are split again at the next separator.
+
+Chunks are generated one by one, and chunk_offsets() finds where each chunk
+starts in the text and by how much it overlaps the previous one.
+"""
+
+import sys
+import time
+from collections import deque
+
+from myargs import parse_args
+
+
+SEPARATORS = ["\n\n", "\n", ".", "!", "?", ",", " "]
+CHUNK_SIZE = 600
+CHUNK_OVERLAP = 200
+
+
+def split_keep_separator(text, separator):
+    # every split but the first starts with the separator
+    if not separator:
+        return list(text)
+    parts = text.split(separator)
+    splits = [parts[0]] + [separator + part for part in parts[1:]]
+    return [split for split in splits if split]
+
+
+def merge_splits(splits, chunk_size, chunk_overlap):
+    current = deque()
+    total = 0
+    for split in splits:
+        n = len(split)
+        if current and total + n > chunk_size:
+            chunk = ''.join(current).strip()
+            if chunk:
+                yield chunk
+            # keep the tail of the chunk as the overlap of the next one
+            while total > chunk_overlap or (total + n > chunk_size and total > 0):
+                total -= len(current.popleft())
+        current.append(split)
+        total += n
+    chunk = ''.join(current).strip()
+    if chunk:
+        yield chunk
+
+
+def split_text(text, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, separators=SEPARATORS):
+    """
+    generate the chunks of text
+    """
+    separator = separators[-1]
+    next_separators = []
+    for i, s in enumerate(separators):
+        if s == '':
+            separator = s
+            break
+        if s in text:
+            separator = s
+            next_separators = separators[i + 1:]
+            break
+
+    good_splits = []
+    for split in split_keep_separator(text, separator):
+        if len(split) < chunk_size:
+            good_splits.append(split)
+            continue
+        if good_splits:
+            yield from merge_splits(good_splits, chunk_size, chunk_overlap)
+            good_splits = []
+        if next_separators:
+            yield from split_text(split, chunk_size, chunk_overlap, next_separators)
+        else:
+            yield split
+    if good_splits:
+        yield from merge_splits(good_splits, chunk_size, chunk_overlap)
+
+
+def chunk_offsets(text, chunks, chunk_overlap=CHUNK_OVERLAP):
+    """
+    generate (start, end, overlap) of the chunks in text, where overlap is the
+    number of characters shared with the previous chunk
+    """
+    start = 0
+    previous_end = 0
+    previous_len = 0
+    for chunk in chunks:
+        offset = max(0, start + previous_len - chunk_overlap)
+        start = text.find(chunk, offset)
+        if start < 0:
+            start = text.find(chunk)
+        end = start + len(chunk)
+        yield start, end, max(0, previous_end - start)
+        previous_end = end
+        previous_len = len(chunk)
+
+
+if __name__ == '__main__':
+    args, kwargs, flags = parse_args(sys.argv[1:])
+    if len(args) < 1:
+        print(f'Usage  : python {sys.argv[0]} file.txt [file.txt ...]')
+        print(f'Measures chunking speed')
+        print(f'Options: --chunk_size={CHUNK_SIZE} --chunk_overlap={CHUNK_OVERLAP}')
+        sys.exit(1)
+
+    chunk_size = int(kwargs.get('chunk_size', CHUNK_SIZE))
+    chunk_overlap = int(kwargs.get('chunk_overlap', CHUNK_OVERLAP))
+    texts = []
+    for filn in args:
+        with open(filn, 'rt', errors='ignore') as f:
+            texts.append(f.read().replace('\n', ' '))
+    num_chars = sum(len(text) for text in texts)
+
+    start = time.time()
+    num_chunks = 0
+    for text in texts:
+        num_chunks += sum(1 for _ in split_text(text, chunk_size, chunk_overlap))
+    elapsed = time.time() - start
+    print(f'{num_chunks} chunks of {num_chars / 1e6:.1f}M characters in {elapsed:.2f}s: {num_chars / elapsed / 1e6:.1f}M chars/s')
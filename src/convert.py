@@ -1,11 +1,20 @@
 import sys
 import os
+import json
+import time
+import queue
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from tqdm import tqdm
 import email
 from email import policy
 from email.parser import BytesParser
 from email.message import EmailMessage
 
+from myargs import parse_args
+
 supported_extensions = [
   ".pdf", ".html", ".rtf", ".odt", ".msg", ".docx",
 ]
@@ -16,6 +25,8 @@ libreoffice_extensions = [
 ]
 
 
+FILN_MANIFEST = 'convert_manifest.json'
+
 grep = 'grep'
 libreoffice = 'libreoffice'
 
@@ -24,15 +35,19 @@ if platform.system() == 'Darwin':
     grep = 'ggrep'
     libreoffice = '/Applications/LibreOffice.app/Contents/MacOS/soffice'
 
+def is_supported(filepath):
+    basename = os.path.basename(filepath)
+    if basename.startswith('.') or basename.startswith('~'):
+        return False
+    extension = os.path.splitext(basename)[1].lower()
+    return extension in supported_extensions or extension in libreoffice_extensions
+
+
 def get_files(directory):
     all_files = []
     for dirpath, _, filenames in os.walk(directory):
         for filename in filenames:
-            basename = os.path.basename(filename)
-            if basename.startswith('.') or basename.startswith('~'):
-                continue
-            extension = os.path.splitext(filename)[1].lower()
-            if (extension not in supported_extensions) and (extension not in libreoffice_extensions):
+            if not is_supported(filename):
                 continue
             doc_path = os.path.join(dirpath, filename)
             all_files.append(doc_path)
@@ -112,7 +127,80 @@ def save_attachments_and_strip_email(raw_email, output_file):
     return attachments
 
 
-def convert_file(filn):
+def is_up_to_date(filn, output_file):
+    return os.path.exists(output_file) and os.path.getmtime(output_file) >= os.path.getmtime(filn)
+
+
+def parse_tool_instances(value):
+    """
+    'pandoc:2,msgconvert:1' -> {'pandoc': 2, 'msgconvert': 1}
+    """
+    tool_instances = {}
+    for item in value.split(','):
+        if item:
+            tool, instances = item.rsplit(':', 1)
+            tool_instances[tool] = int(instances)
+    return tool_instances
+
+
+class Tools:
+    """
+    runs the converters as subprocesses, with a limit of concurrent runs per
+    tool: tool_instances[tool], default one per core. LibreOffice instances
+    must not share a user profile, so each concurrent instance gets its own.
+    """
+    def __init__(self, libreoffice_instances=1, tool_instances=None):
+        self.tool_instances = tool_instances or {}
+        self.semaphores = {}
+        self.profiles = queue.Queue()
+        for i in range(libreoffice_instances):
+            # one instance uses the default profile, as before
+            self.profiles.put(None if libreoffice_instances == 1 else
+                              os.path.join(tempfile.gettempdir(), f'rki-convert-lo-{i}'))
+        self.lock = threading.Lock()
+        self.num_skipped = 0
+
+    def semaphore(self, tool):
+        with self.lock:
+            if tool not in self.semaphores:
+                self.semaphores[tool] = threading.Semaphore(
+                        self.tool_instances.get(tool, os.cpu_count()))
+            return self.semaphores[tool]
+
+    def run(self, args, stdout_file=None):
+        with self.semaphore(os.path.basename(args[0])):
+            try:
+                if stdout_file is None:
+                    return subprocess.run(args, stdout=subprocess.DEVNULL).returncode
+                with open(stdout_file, 'wb') as f:
+                    return subprocess.run(args, stdout=f).returncode
+            except FileNotFoundError:
+                print(f'{args[0]} not found')
+                return 127
+
+    def libreoffice_to_pdf(self, filn):
+        profile = self.profiles.get()
+        try:
+            args = [libreoffice, '--headless']
+            if profile is not None:
+                args.append(f'-env:UserInstallation=file://{profile}')
+            return self.run(args + ['--convert-to', 'pdf', filn, '--outdir', os.path.dirname(filn) or '.'])
+        finally:
+            self.profiles.put(profile)
+
+    def skipped(self):
+        with self.lock:
+            self.num_skipped += 1
+        return 0
+
+
+def convert_file(filn, tools=None):
+    """
+    returns the return code of the conversion and paths of extracted mail
+    attachments. outputs newer than filn are not created again.
+    """
+    if tools is None:
+        tools = Tools()
     basename = os.path.basename(filn)
     if basename.startswith('.'):
         return None
@@ -124,75 +212,145 @@ def convert_file(filn):
 
     if extension in supported_extensions:
         if extension in ['.html', '.odt', '.docx']:
-            ret = os.system(f'pandoc "{filn}" -t rst --list-tables -o "{output_file}"')
+            if is_up_to_date(filn, output_file):
+                ret = tools.skipped()
+            else:
+                ret = tools.run(['pandoc', filn, '-t', 'rst', '--list-tables', '-o', output_file])
             # for word docs, create a PDF for the web
             if extension == '.docx':
                 # in addition, also create a PDF for later viewing
                 pdf_file = filn + '.pdf'
-                pdf_dir = os.path.dirname(filn)
-                os.system(f'{libreoffice} --headless --convert-to pdf "{filn}" --outdir "{pdf_dir}"')
+                if not is_up_to_date(filn, pdf_file):
+                    tools.libreoffice_to_pdf(filn)
                 if not os.path.exists(pdf_file):
                     print(f'Cannot find converted PDF file for {filn}')
                     print(f'Expected {pdf_file}')
         elif extension == '.pdf':
-            ret = os.system(f'pdftotext "{filn}" "{output_file}"')
+            if is_up_to_date(filn, output_file):
+                ret = tools.skipped()
+            else:
+                ret = tools.run(['pdftotext', filn, output_file])
         elif extension == '.rtf':
-            ret = os.system(f'unrtf --text "{filn}" > "{output_file}"')
+            if is_up_to_date(filn, output_file):
+                ret = tools.skipped()
+            else:
+                ret = tools.run(['unrtf', '--text', filn], stdout_file=output_file)
         elif extension == '.msg':
             raw_file = filn + '.raw'
-            ret = os.system(f'msgconvert --outfile "{raw_file}" "{filn}"')
-            attachments = save_attachments_and_strip_email(raw_file, output_file)
+            if is_up_to_date(filn, output_file) and is_up_to_date(filn, raw_file):
+                ret = tools.skipped()
+                attachments_folder = raw_file + '.attachments'
+                if os.path.isdir(attachments_folder):
+                    attachments = [os.path.join(attachments_folder, f) for f in sorted(os.listdir(attachments_folder))]
+            else:
+                ret = tools.run(['msgconvert', '--outfile', raw_file, filn])
+                if ret == 0:
+                    attachments = save_attachments_and_strip_email(raw_file, output_file)
         else:
             print(filn)
             raise RuntimeError("unreachable")
     elif extension in libreoffice_extensions:
         pdf_file = filn + '.pdf'
-        if os.path.exists(pdf_file):
+        if is_up_to_date(filn, pdf_file):
             # we've converted it already in a previous run
             ret = 0
         else:
-            pdf_dir = os.path.dirname(filn)
-            ret = os.system(f'{libreoffice} --headless --convert-to pdf "{filn}" --outdir "{pdf_dir}"')
+            ret = tools.libreoffice_to_pdf(filn)
             if not os.path.exists(pdf_file):
                 print(f'Cannot find converted PDF file for {filn}')
                 print(f'Expected {pdf_file}')
                 ret = 1
         if ret == 0:
-            return convert_file(pdf_file)
+            return convert_file(pdf_file, tools)
         else:
             print(f'Could not convert to PDF: {filn}')
     return ret, attachments
 
-def process_folder(directory, all_attachments, error_files):
-    all_files = get_files(directory)
-    print(f'Converting {len(all_files)} files in {directory}...')
-    for f in tqdm(all_files):
-        ok, attachments = convert_file(f)
-        if ok != 0:
-            error_files.append(f)
-        if attachments:
-            all_attachments.extend(attachments)
-    return all_attachments, error_files
+
+def convert_and_record(filn, tools):
+    start = time.time()
+    try:
+        ret, attachments = convert_file(filn, tools)
+    except Exception as e:
+        print(f'Error converting {filn}: {e}')
+        ret, attachments = -1, []
+    return filn, {
+            'status': 'ok' if ret == 0 else 'error',
+            'returncode': ret,
+            'attachments': attachments,
+            'seconds': round(time.time() - start, 3),
+            }
+
+
+def load_manifest(filepath):
+    if not os.path.exists(filepath):
+        return {}
+    with open(filepath, 'rt') as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, filepath):
+    with open(filepath + '.tmp', 'wt') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(filepath + '.tmp', filepath)
+
+
+def process_folder(directory, workers=None, libreoffice_instances=1, tool_instances=None):
+    """
+    convert all files below directory with a pool of workers. attachments of
+    mails are converted as soon as they are extracted. results are recorded
+    in the manifest in directory. returns the files with errors.
+    """
+    filn_manifest = os.path.join(directory, FILN_MANIFEST)
+    manifest = load_manifest(filn_manifest)
+    tools = Tools(libreoffice_instances, tool_instances)
+    error_files = []
+    submitted = set()
+    pending = set()
+    if workers is None:
+        workers = os.cpu_count()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        def submit(files):
+            for filn in files:
+                if filn not in submitted:
+                    submitted.add(filn)
+                    pending.add(pool.submit(convert_and_record, filn, tools))
+
+        all_files = get_files(directory)
+        print(f'Converting {len(all_files)} files in {directory} with {workers} workers...')
+        submit(all_files)
+        progress = tqdm(total=len(submitted))
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.remove(future)
+                filn, entry = future.result()
+                manifest[filn] = entry
+                if entry['status'] != 'ok':
+                    error_files.append(filn)
+                submit(a for a in entry['attachments'] if is_supported(a))
+                progress.total = len(submitted)
+                progress.update()
+        progress.close()
+
+    save_manifest(manifest, filn_manifest)
+    print(f'{len(submitted)} files, {tools.num_skipped} up to date, {len(error_files)} errors')
+    return sorted(error_files)
 
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        print(f'Usage: python {sys.argv[0]} data_dir')
+    args, kwargs, flags = parse_args(sys.argv[1:])
+    if len(args) != 1:
+        print(f'Usage  : python {sys.argv[0]} data_dir')
+        print(f'Options: --workers={os.cpu_count()} --libreoffice_instances=1')
+        print(f'         --tool_instances=pandoc:2,msgconvert:1 (default: {os.cpu_count()} of each tool)')
         sys.exit(1)
-    all_attachments = []
-    error_files = []
-    directory = sys.argv[1]
-
-    all_attachments, error_files = process_folder(directory, [], [])
-    while True:
-        new_attachment_folders = set()
-        for att in all_attachments:
-            new_attachment_folders.add(os.path.dirname(att))
-        all_attachments = []
-        for folder in new_attachment_folders:
-            attachments, error_files = process_folder(folder, [], error_files)
-            all_attachments.extend(attachments)
-        if not all_attachments:
-            break
+    directory = args[0]
+
+    error_files = process_folder(directory,
+                                 workers=int(kwargs.get('workers', os.cpu_count())),
+                                 libreoffice_instances=int(kwargs.get('libreoffice_instances', 1)),
+                                 tool_instances=parse_tool_instances(kwargs.get('tool_instances', '')))
 
     print('The following files had errors or warnings:')
     print('\n'.join(error_files))
@@ -1,34 +1,31 @@
 """
 Convert existing .txt files that are e.g. the result of pdftotext
 
-Use langchain TextSplitter.
+Split them with chunker.py, the way langchain's RecursiveCharacterTextSplitter
+does.
 
 Convert paragraphs with overlaps.
 
-Replace .txt files and keep a copy of the original in .bak files 
+Replace .txt files and keep a copy of the original in .bak files. Where each
+chunk starts in the .bak file and how much it overlaps the previous chunk is
+recorded in .chunks.json files.
 """
 
 import sys
 import os
+import json
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 
-
-supported_extensions=['.txt']
-
-separators=[ "\n\n", "\n", ".", "!", "?", ",", " ", ]
+from chunker import split_text, chunk_offsets, SEPARATORS
+from myargs import parse_args
 
 
-def len_func(text):
-    return len(text)
-
+supported_extensions=['.txt']
 
-text_splitter = RecursiveCharacterTextSplitter(
-        separators=separators,
-        chunk_size=600,
-        chunk_overlap=200,
-        length_function=len_func,
-)
+separators = SEPARATORS
+chunk_size = 600
+chunk_overlap = 200
 
 
 def convert_file(filn):
@@ -37,35 +34,44 @@ def convert_file(filn):
         return None
     root, extension = os.path.splitext(filn)
     extension = extension.lower()
-    output_file = filn + '.txt'
     ret = 0
 
     if extension not in supported_extensions:
         print(filn)
         raise RuntimeError("unreachable")
 
-    # create a backup file so we can revert
+    # the backup file is the original, so we can revert and re-run
     bak_file = filn + '.bak'
-    if os.path.exists(bak_file):
-        os.system(f"cp '{bak_file}' '{filn}'")
-    with open(filn, 'rt', errors='ignore') as f:
-        try:
+    source_file = bak_file if os.path.exists(bak_file) else filn
+    try:
+        with open(source_file, 'rt', errors='ignore') as f:
             text = f.read()
-        except:
-            print()
-            print()
-            print('ERROR IN FILE', filn)
-            raise RuntimeError()
+    except OSError as e:
+        print()
+        print('ERROR IN FILE', filn, e)
+        return 1
 
     text = text.replace('\n', ' ')
-    with open(bak_file, 'wt') as bak:
-        bak.write(text)
+    if source_file != bak_file:
+        with open(bak_file, 'wt') as bak:
+            bak.write(text)
 
     # we don't care about metadata for now
-    docs = text_splitter.create_documents([text])
-    with open(filn, 'wt') as f:
-        for doc in docs:
-            f.write(f'{doc.page_content}\n\n')
+    chunks = []
+    with open(filn + '.tmp', 'wt') as f:
+        for chunk in split_text(text, chunk_size, chunk_overlap, separators):
+            f.write(f'{chunk}\n\n')
+            chunks.append(chunk)
+    os.replace(filn + '.tmp', filn)
+
+    with open(filn + '.chunks.json', 'wt') as f:
+        json.dump({
+            'source': os.path.basename(bak_file),
+            'chunk_size': chunk_size,
+            'chunk_overlap': chunk_overlap,
+            # [start, end, overlap with the previous chunk]
+            'chunks': [list(offsets) for offsets in chunk_offsets(text, chunks, chunk_overlap)],
+            }, f)
     return ret
 
 
@@ -85,24 +91,26 @@ def get_files(directory):
     return all_files
 
 
-def process_folder(directory, error_files):
+def process_folder(directory, error_files, workers=None):
     all_files = get_files(directory)
     print(f'Converting {len(all_files)} files in {directory}...')
-    for f in tqdm(all_files):
-        ok = convert_file(f)
-        if ok != 0:
-            error_files.append(f)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(convert_file, all_files, chunksize=16)
+        for f, ok in zip(all_files, tqdm(results, total=len(all_files))):
+            if ok != 0:
+                error_files.append(f)
     return error_files
 
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        print(f'Usage: python {sys.argv[0]} data_dir')
+    args, kwargs, flags = parse_args(sys.argv[1:])
+    if len(args) != 1:
+        print(f'Usage  : python {sys.argv[0]} data_dir')
+        print(f'Options: --workers={os.cpu_count()}')
         sys.exit(1)
     error_files = []
-    directory = sys.argv[1]
-    error_files = process_folder(directory, [])
+    directory = args[0]
+    error_files = process_folder(directory, [], workers=int(kwargs.get('workers', os.cpu_count())))
     if error_files:
         print('The following files had errors or warnings:')
         print('\n'.join(error_files))
     print("READY.")
-
@@ -0,0 +1,321 @@
+"""
+The datasets served by the API: which there are, loading them in parallel
+or on first use, and unloading the least recently used ones when they need
+more memory than RKI_MEMORY_BUDGET_MB.
+
+Datasets are listed in `datasets.json` in RKI_DATASETS_DIR:
+
+    {
+        "sitzungsprotokolle": {"name": "Sitzungsprotokolle_RST"},
+        "pei_files": {"preload": false},
+        "corona_BKA": {"store": "corona_STORE"},
+        "corona_ALL": {"store": "corona_STORE", "subset": "corona_ALL"}
+    }
+
+name is the file name prefix of the dataset (default: the dataset name).
+With store, the dataset is a subset of that vector store (see
+vectorstore.py); subset defaults to the dataset name. Datasets with
+"preload": false are loaded on first use, all others at startup.
+
+Without datasets.json, the datasets are those of the RKI_DATASET_<dataset>
+environment variables and the subsets of RKI_VECTOR_STORE, as before.
+
+A vector store is loaded and unloaded with all its subsets as one unit. The
+memory of a unit is estimated from the sizes of the files it loads or maps.
+"""
+
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import faissindex
+import vectorstore
+
+
+FILN_DATASETS = 'datasets.json'
+
+# a dataset that failed to load is tried again after this many seconds
+RETRY_SECONDS = 60
+
+FILN_FAISS_INDEX = 'faiss.index'
+FILN_METADATA = 'metadata.pkl'
+DIRN_METASTORE = 'metastore'
+DIRN_LEXICAL = 'lexical'
+FILN_INDEX_CONFIG = faissindex.FILN_INDEX_CONFIG
+FILN_VECTORS = faissindex.FILN_VECTORS
+
+# datasets of the API before datasets.json
+LEGACY_DATASET_NAMES = ['sitzungsprotokolle', 'zusatzmaterial',
+                        'corona_BKA', 'corona_BMG_BMI', 'corona_EXP_REGIERUNG',
+                        'corona_MPK', 'corona_ALL', 'corona_ABSOLUTELY_EVERYTHING',
+                        'pei_files', 'kanzleramt_mails']
+
+
+class Unit:
+    """
+    a dataset, or a vector store with the datasets that are its subsets.
+    datasets: dict of dataset name -> name of the dataset or subset in the
+    files of the unit
+    """
+    def __init__(self, dataset_dir, name, is_store, preload=True):
+        self.dataset_dir = dataset_dir
+        self.name = name
+        self.is_store = is_store
+        self.preload = preload
+        self.datasets = {}
+        self.lock = threading.Lock()
+        self.state = 'unloaded'
+        self.resources = None
+        self.size = 0
+        self.load_seconds = None
+        self.loaded_at = None
+        self.last_used = None
+        self.num_loads = 0
+        self.num_evictions = 0
+        self.error = None
+        self.failed_at = None
+
+    @property
+    def label(self):
+        return f'{self.name} (store)' if self.is_store else self.name
+
+
+def file_size(filepath):
+    if not os.path.exists(filepath):
+        return 0
+    if os.path.isdir(filepath):
+        return sum(file_size(os.path.join(filepath, filn)) for filn in os.listdir(filepath))
+    return os.path.getsize(filepath)
+
+
+def estimate_size(dataset_dir, name, mmap=False):
+    """
+    bytes a dataset occupies in memory or in the page cache once searched
+    """
+    def path(suffix):
+        return os.path.join(dataset_dir, f'{name}_{suffix}')
+
+    config = faissindex.load_index_config(path(FILN_INDEX_CONFIG))
+    size = file_size(path(DIRN_LEXICAL))
+    if os.path.exists(path(DIRN_METASTORE)):
+        size += file_size(path(DIRN_METASTORE))
+    else:
+        size += file_size(path(FILN_METADATA))
+    # see main.get_resources()
+    if (mmap and config['index_type'] == 'flat' and config['storage'] == 'fp32'
+            and not config['coarse_dims'] and os.path.exists(path(FILN_VECTORS))):
+        return size + file_size(path(FILN_VECTORS))
+    size += file_size(path(FILN_FAISS_INDEX))
+    if config['rerank'] > 0 or config['coarse_dims']:
+        size += file_size(path(FILN_VECTORS))
+    return size
+
+
+def read_manifest(dataset_dir, filepath=None):
+    """
+    returns a dict of dataset name -> unit, from datasets.json or from the
+    environment
+    """
+    if filepath is None:
+        filepath = os.path.join(dataset_dir, FILN_DATASETS)
+    units = {}
+    if os.path.exists(filepath):
+        print('Reading datasets from', filepath, flush=True)
+        with open(filepath, 'rt') as f:
+            manifest = json.load(f)
+        stores = {}
+        for dn, entry in manifest.items():
+            if 'store' in entry:
+                store = entry['store']
+                if store not in stores:
+                    stores[store] = Unit(dataset_dir, store, True, preload=False)
+                unit = stores[store]
+                unit.datasets[dn] = entry.get('subset', dn)
+                # a store is preloaded if one of its datasets is
+                unit.preload = unit.preload or entry.get('preload', True)
+            else:
+                unit = Unit(dataset_dir, entry.get('name', dn), False, preload=entry.get('preload', True))
+                unit.datasets[dn] = unit.name
+            units[dn] = unit
+        return units
+
+    vector_store = os.getenv('RKI_VECTOR_STORE')
+    subsets = {}
+    if vector_store:
+        store = Unit(dataset_dir, vector_store, True)
+        subsets = vectorstore.load_subsets(os.path.join(dataset_dir, f'{vector_store}_{vectorstore.FILN_SUBSETS}'))
+    for dn in LEGACY_DATASET_NAMES:
+        if dn in subsets:
+            store.datasets[dn] = dn
+            units[dn] = store
+        elif os.getenv(f'RKI_DATASET_{dn}'):
+            units[dn] = Unit(dataset_dir, os.getenv(f'RKI_DATASET_{dn}'), False)
+            units[dn].datasets[dn] = units[dn].name
+        else:
+            print(f'RKI_DATASET_{dn} not set, not serving {dn}', flush=True)
+    return units
+
+
+class DatasetManager:
+    """
+    Maps dataset names to their resources (a dict of faiss, metadata, qcache
+    and lexical), loading them on first access.
+
+    load_unit(unit) returns a dict of dataset name -> resources for the
+    datasets of the unit, unload_unit(resources) is called with it when the
+    unit is evicted. memory_budget: bytes, 0 for no limit. retry_seconds:
+    how long a unit that failed to load is not tried again.
+    """
+    def __init__(self, units, load_unit, unload_unit=None, memory_budget=0, mmap=False,
+                 retry_seconds=RETRY_SECONDS):
+        self.units = units
+        self.load_unit = load_unit
+        self.unload_unit = unload_unit
+        self.memory_budget = memory_budget
+        self.mmap = mmap
+        self.retry_seconds = retry_seconds
+        self.lock = threading.Lock()
+
+    def names(self):
+        return list(self.units)
+
+    def __contains__(self, dataset_name):
+        return dataset_name in self.units
+
+    def __iter__(self):
+        return iter(self.units)
+
+    def __getitem__(self, dataset_name):
+        resources = self.get(dataset_name)
+        if resources is None:
+            raise KeyError(f'Dataset {dataset_name} is not available: {self.units[dataset_name].error}')
+        return resources
+
+    def get(self, dataset_name):
+        """
+        the resources of the dataset, None if it cannot be loaded
+        """
+        unit = self.units[dataset_name]
+        # evicted by another thread right after loading: load again
+        for _ in range(3):
+            resources = unit.resources
+            if resources is not None:
+                unit.last_used = time.time()
+                return resources[dataset_name]
+            if not self.load(unit):
+                return None
+        return None
+
+    def load(self, unit):
+        """
+        returns False if the unit could not be loaded
+        """
+        with unit.lock:
+            if unit.resources is not None:
+                return True
+            # e.g. files replaced by a rebuild: try again later
+            if unit.state == 'failed' and time.time() - unit.failed_at < self.retry_seconds:
+                return False
+            print(f'Loading {unit.label} ...', flush=True)
+            unit.state = 'loading'
+            start = time.time()
+            try:
+                resources = self.load_unit(unit)
+                size = estimate_size(unit.dataset_dir, unit.name, self.mmap)
+            # main.get_resources() exits if a dataset does not exist
+            except (Exception, SystemExit) as e:
+                unit.state = 'failed'
+                unit.failed_at = time.time()
+                unit.error = f'{type(e).__name__}: {e}'
+                print(f'Loading {unit.label} failed: {unit.error}', flush=True)
+                return False
+            with self.lock:
+                unit.size = size
+                unit.load_seconds = time.time() - start
+                unit.loaded_at = unit.last_used = time.time()
+                unit.num_loads += 1
+                unit.resources = resources
+                unit.state = 'loaded'
+                unit.error = unit.failed_at = None
+            print(f'Loaded {unit.label} in {unit.load_seconds:.1f}s ({size / 1024 / 1024:.0f} MB)', flush=True)
+        self.enforce_budget(keep=unit)
+        return True
+
+    def loaded_units(self):
+        return list({id(unit): unit for unit in self.units.values() if unit.state == 'loaded'}.values())
+
+    def loaded_size(self):
+        return sum(unit.size for unit in self.loaded_units())
+
+    def enforce_budget(self, keep=None):
+        """
+        evict the least recently used units until the loaded ones fit into
+        the budget. keep is never evicted.
+        """
+        if not self.memory_budget:
+            return
+        evicted = []
+        with self.lock:
+            units = sorted((unit for unit in self.loaded_units() if unit is not keep),
+                           key=lambda unit: unit.last_used)
+            total = self.loaded_size()
+            for unit in units:
+                if total <= self.memory_budget:
+                    break
+                # searches running in the unit keep their references
+                evicted.append((unit, unit.resources))
+                unit.resources = None
+                unit.state = 'evicted'
+                unit.num_evictions += 1
+                total -= unit.size
+        for unit, resources in evicted:
+            print(f'Evicted {unit.label} ({unit.size / 1024 / 1024:.0f} MB), '
+                  f'{total / 1024 / 1024:.0f} MB loaded', flush=True)
+            if self.unload_unit is not None:
+                self.unload_unit(resources)
+
+    def preload(self, workers=4):
+        """
+        load the units to preload in parallel and wait for them
+        """
+        units = list({id(unit): unit for unit in self.units.values() if unit.preload}.values())
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            list(pool.map(self.load, units))
+        print(f'Preloaded {len(units)} datasets in {time.time() - start:.1f}s', flush=True)
+
+    def loaded(self):
+        """
+        dict of dataset name -> resources of the loaded datasets
+        """
+        found = {}
+        for dataset_name, unit in self.units.items():
+            resources = unit.resources
+            if resources is not None:
+                found[dataset_name] = resources[dataset_name]
+        return found
+
+    def status(self):
+        datasets = {}
+        for dataset_name, unit in self.units.items():
+            datasets[dataset_name] = {
+                    'unit': unit.label,
+                    'state': unit.state,
+                    'preload': unit.preload,
+                    'size_mb': round(unit.size / 1024 / 1024, 1),
+                    'load_seconds': None if unit.load_seconds is None else round(unit.load_seconds, 3),
+                    'loaded_at': unit.loaded_at,
+                    'last_used': unit.last_used,
+                    'loads': unit.num_loads,
+                    'evictions': unit.num_evictions,
+                    'error': unit.error,
+                    'failed_at': unit.failed_at,
+                   }
+        return {
+                'pid': os.getpid(),
+                'memory_budget_mb': round(self.memory_budget / 1024 / 1024, 1),
+                'loaded_mb': round(self.loaded_size() / 1024 / 1024, 1),
+                'datasets': datasets,
+               }
@@ -1,39 +1,132 @@
 from flask import Flask, request, jsonify
 from flask_compress import Compress
 import os
+import threading
 from dotenv import load_dotenv
+import numpy as np
+import faiss
 import main
+import metastore
+import vectorstore
+import lexicalindex
+import querycache
+import resultcache
+import searchexecutor
+import datasetmanager
 
 
-dataset_names = ['sitzungsprotokolle', 'zusatzmaterial', 
-                 'corona_BKA', 'corona_BMG_BMI', 'corona_EXP_REGIERUNG',
-                 'corona_MPK', 'corona_ALL', 'corona_ABSOLUTELY_EVERYTHING',
-                 'pei_files', 'kanzleramt_mails']
-
-datasets = {}
-for dn in dataset_names:
-    datasets[f'{dn}'] = {
-            'path': os.getenv(f'RKI_DATASETS_DIR'),
-            'name' : os.getenv(f'RKI_DATASET_{dn}'),
-            }
-
-print('Using datasets', datasets, flush=True)
-
-# N.B. don't save the query embedding cache since its name is fixed here
-#      as to avoid conflicts in multiple workers
-for dn in dataset_names:
-    print('Loading', dn, '...', flush=True)
-    metadata, faiss_index, q_emb_cache = main.get_resources(
-            datasets[dn]['path'],
-            datasets[dn]['name'],
-            query_cache_name='query',
-            max_cache_size=50,
-            )
-    datasets[dn]['faiss'] = faiss_index
-    datasets[dn]['metadata'] = metadata
-    datasets[dn]['qcache'] = q_emb_cache
+# with RKI_MMAP=1, metadata and indexes are memory-mapped and shared by all
+# gunicorn workers via the page cache. See mmapconvert.py for old datasets.
+use_mmap = os.getenv('RKI_MMAP', '0') == '1'
+
+# one query embedding cache on disk for all datasets and workers. queries
+# are embedded by the model their dataset was built with, see embedding.py
+query_caches = {}
+query_caches_lock = threading.Lock()
+
+def get_query_cache(embedding_config):
+    key = (embedding_config['backend'], embedding_config['model'], embedding_config['dims'])
+    # datasets are loaded by several threads
+    with query_caches_lock:
+        if key not in query_caches:
+            query_caches[key] = querycache.QueryEmbeddingCache(
+                    os.getenv('RKI_QUERY_CACHE',
+                              os.path.join(os.getenv('RKI_DATASETS_DIR'), querycache.FILN_QUERY_CACHE)),
+                    max_entries=int(os.getenv('RKI_QUERY_CACHE_SIZE', 20000)),
+                    backend=embedding_config['backend'],
+                    model=embedding_config['model'],
+                    dims=embedding_config['dims'],
+                    )
+        return query_caches[key]
+
+# concurrent searches in a dataset are run as one multi-query search, see
+# searchexecutor.py. RKI_SEARCH_BATCH_SIZE=0 searches each request by itself
+search_batch_size = int(os.getenv('RKI_SEARCH_BATCH_SIZE', searchexecutor.MAX_BATCH_SIZE))
+if os.getenv('RKI_FAISS_THREADS'):
+    faiss.omp_set_num_threads(int(os.getenv('RKI_FAISS_THREADS')))
+
+def load_dataset_unit(unit):
+    """
+    the resources of the datasets of a unit, see datasetmanager.py
+    """
+    resources = {}
+    if unit.is_store:
+        # datasets defined as subsets of a vector store (see vectorstore.py)
+        # share its vectors and metadata
+        metadata, faiss_index, _ = main.get_resources(unit.dataset_dir, unit.name, mmap=use_mmap)
+        subset_indexes = vectorstore.get_subset_indexes(unit.dataset_dir, unit.name,
+                                                        metadata, faiss_index)
+        subset_ranges = vectorstore.load_subset_ranges(unit.dataset_dir, unit.name, metadata)
+        lexical = lexicalindex.load_lexical_index(unit.dataset_dir, unit.name, metadata)
+        qcache = get_query_cache(main.load_embedding_config(unit.dataset_dir, unit.name))
+        for dn, subset_name in unit.datasets.items():
+            print('Using subset', subset_name, 'of vector store', unit.name, 'for', dn, flush=True)
+            resources[dn] = {
+                    'faiss': subset_indexes[subset_name],
+                    'metadata': metadata,
+                    'qcache': qcache,
+                    'lexical': lexical.restrict(subset_ranges[subset_name]) if lexical else None,
+                    }
+    else:
+        metadata, faiss_index, _ = main.get_resources(unit.dataset_dir, unit.name, mmap=use_mmap)
+        for dn in unit.datasets:
+            resources[dn] = {
+                    'faiss': faiss_index,
+                    'metadata': metadata,
+                    'qcache': get_query_cache(main.load_embedding_config(unit.dataset_dir, unit.name)),
+                    # answers quoted and lexical queries without an embedding
+                    'lexical': lexicalindex.load_lexical_index(unit.dataset_dir, unit.name, metadata),
+                    }
+    if search_batch_size > 0:
+        for dataset in resources.values():
+            dataset['faiss'] = searchexecutor.SearchExecutor(
+                    dataset['faiss'],
+                    max_batch_size=search_batch_size,
+                    max_wait_ms=float(os.getenv('RKI_SEARCH_WAIT_MS', searchexecutor.MAX_WAIT_MS)),
+                    threads=int(os.getenv('RKI_SEARCH_THREADS', searchexecutor.THREADS)),
+                    )
+    return resources
+
+def unload_dataset_unit(resources):
+    for dataset in resources.values():
+        if isinstance(dataset['faiss'], searchexecutor.SearchExecutor):
+            dataset['faiss'].close()
+
+# datasets are listed in $RKI_DATASETS_DIR/datasets.json, see
+# datasetmanager.py. datasets[name] loads a dataset on first use
+datasets = datasetmanager.DatasetManager(
+        datasetmanager.read_manifest(os.getenv('RKI_DATASETS_DIR'), os.getenv('RKI_DATASETS_MANIFEST')),
+        load_dataset_unit,
+        unload_dataset_unit,
+        memory_budget=int(os.getenv('RKI_MEMORY_BUDGET_MB', 0)) * 1024 * 1024,
+        mmap=use_mmap,
+        retry_seconds=float(os.getenv('RKI_LOAD_RETRY_SECONDS', datasetmanager.RETRY_SECONDS)),
+        )
+dataset_names = datasets.names()
+print('Using datasets', dataset_names, flush=True)
+if os.getenv('RKI_PRELOAD', '1') == '1':
+    datasets.preload(workers=int(os.getenv('RKI_LOAD_WORKERS', 4)))
+
+# responses of repeated searches, per worker
+result_cache = resultcache.ResultCache(
+        max_bytes=int(os.getenv('RKI_RESULT_CACHE_MB', 64)) * 1024 * 1024,
+        ttl=int(os.getenv('RKI_RESULT_CACHE_TTL', 3600)),
+        )
 
 print('READY.', flush=True)
+
+# max. number of paragraphs added as context on either side of a result
+MAX_CONTEXT_STEPS = 9
+
+# max. number of queries in one batch request
+MAX_BATCH_QUERIES = 1000
+
+# search modes. default: lexical for queries with "quoted phrases", else vector
+SEARCH_MODES = ['vector', 'lexical', 'hybrid']
+
+# in hybrid mode, both searches fetch HYBRID_DEPTH * k_results results
+HYBRID_DEPTH = 2
+
 app = Flask(__name__)
 Compress(app)
 
@@ -45,26 +138,138 @@ def process_query(query_text, embedding_cache, faiss_index, metadata,
                   k_results=20,
                   remove_dupes=False,
                   auto_context_size=300,
-                  dataset_name=''
+                  dataset_name='',
+                  mode='vector',
+                  lexical_index=None,
+                  query_embedding=None,
                   ):
-    query_embedding = main.get_query_embeddings(query_text, embedding_cache)
-    query_embedding = main.normalize_embeddings(query_embedding)
-    faiss_distances, faiss_indices = main.search_faiss_index(faiss_index,
-                                                             query_embedding,
-                                                             k=k_results)
+    """
+    query_embedding: the normalized embedding of query_text, if the caller
+    has it already (see asyncapi.py)
+    """
+    if mode == 'lexical':
+        # no embedding needed
+        distances, indices = lexical_index.search(query_text, k_results, remove_dupes)
+    else:
+        if query_embedding is None:
+            query_embedding = main.get_query_embeddings(query_text, embedding_cache)
+            query_embedding = main.normalize_embeddings(query_embedding)
+        k_fetch = k_results * HYBRID_DEPTH if mode == 'hybrid' else k_results
+        faiss_distances, faiss_indices = search_index(faiss_index, query_embedding, metadata,
+                                                      k_fetch, remove_dupes)
+        distances, indices = faiss_distances[0], faiss_indices[0]
+        if mode == 'hybrid':
+            distances, indices = fuse(query_text, indices, lexical_index, metadata,
+                                      k_results, remove_dupes)
+    return collect_results(indices, distances, metadata,
+                           auto_context_size=auto_context_size,
+                           dataset_name=dataset_name,
+                           score_key=score_key(mode))
 
-    result_indices = faiss_indices[0]
-    result_distances = faiss_distances[0]
+def score_key(mode):
+    # vector distances are lower for better results, BM25 and fusion scores
+    # higher
+    return 'dist' if mode == 'vector' else 'score'
 
-    results = []
-    result_texts = []
+def fuse(query_text, vector_indices, lexical_index, metadata, k_results, remove_dupes):
+    _, lexical_indices = lexical_index.search(query_text, k_results * HYBRID_DEPTH, remove_dupes)
+    return lexicalindex.fuse_results([vector_indices, lexical_indices], k_results,
+                                     metadata=metadata if remove_dupes else None)
+
+def search_index(faiss_index, query_embeddings, metadata, k_results, remove_dupes):
+    if remove_dupes:
+        # over-fetches until there are k_results unique paragraphs
+        return main.search_faiss_index_unique(faiss_index, query_embeddings,
+                                              metadata, k=k_results)
+    return main.search_faiss_index(faiss_index, query_embeddings, k=k_results)
+
+def collect_results(result_indices, result_distances, metadata,
+                    auto_context_size=300,
+                    dataset_name='',
+                    score_key='dist'
+                    ):
+    kept = []
     for r_no, (idx, dist) in enumerate(zip(result_indices, result_distances)):
-        text = metadata[idx].para
-        if text in result_texts and remove_dupes:
-            continue
+        if idx < 0:
+            # fewer than k_results (unique) vectors in the (subset) index
+            break
+        kept.append((r_no, idx, dist))
+
+    # context windows of all results at once
+    firsts, lasts = metastore.context_windows(metadata, [idx for _, idx, _ in kept],
+                                              auto_context_size,
+                                              max_steps=MAX_CONTEXT_STEPS)
+    results = []
+    for (r_no, idx, dist), first, last in zip(kept, firsts, lasts):
         results.append(format_result(r_no, metadata, idx, dist,
-                                     auto_context_size, dataset=dataset_name))
-        result_texts.append(text)
+                                     auto_context_size, dataset=dataset_name,
+                                     window=(first, last), score_key=score_key))
+    return results
+
+def process_batch(search_params):
+    """
+    search_params: list of dicts as returned by parse_search_params()
+
+    The embeddings of all uncached queries are fetched in one request per
+    embedding model, and
+    each dataset is searched once for all of its queries (twice if some of
+    them remove duplicates and some don't). Lexical queries are answered
+    without an embedding.
+    """
+    by_model = {}
+    for i, params in enumerate(search_params):
+        if params['mode'] != 'lexical':
+            qcache = datasets[params['dataset']]['qcache']
+            by_model.setdefault(id(qcache), (qcache, []))[1].append(i)
+    query_embeddings = {}
+    for qcache, embedded in by_model.values():
+        texts = [search_params[i]['query'] for i in embedded]
+        embeddings = main.normalize_embeddings(main.get_query_embeddings_batch(texts, qcache))
+        query_embeddings.update(zip(embedded, embeddings))
+
+    by_dataset = {}
+    for i, params in enumerate(search_params):
+        key = (params['dataset'], params['remove_dupes'], params['mode'] == 'lexical')
+        by_dataset.setdefault(key, []).append(i)
+
+    results = {}
+    for (dataset_name, remove_dupes, lexical), batch in by_dataset.items():
+        dataset = datasets[dataset_name]
+        faiss_index = dataset['faiss']
+        metadata = dataset['metadata']
+        lexical_index = dataset['lexical']
+        results.setdefault(dataset_name, {})
+        if lexical:
+            for i in batch:
+                params = search_params[i]
+                distances, indices = lexical_index.search(params['query'], params['k_results'],
+                                                          remove_dupes)
+                results[dataset_name][params['query']] = collect_results(
+                        indices, distances, metadata,
+                        auto_context_size=params['auto_context_size'],
+                        dataset_name=dataset_name,
+                        score_key=score_key(params['mode']))
+            continue
+        k = max(search_params[i]['k_results'] * (HYBRID_DEPTH if search_params[i]['mode'] == 'hybrid' else 1)
+                for i in batch)
+        faiss_distances, faiss_indices = search_index(
+                faiss_index,
+                np.ascontiguousarray([query_embeddings[i] for i in batch], dtype='float32'),
+                metadata, k, remove_dupes)
+        for row, i in enumerate(batch):
+            params = search_params[i]
+            k_results = params['k_results']
+            if params['mode'] == 'hybrid':
+                distances, indices = fuse(params['query'],
+                                          faiss_indices[row][:k_results * HYBRID_DEPTH],
+                                          lexical_index, metadata, k_results, remove_dupes)
+            else:
+                distances, indices = faiss_distances[row][:k_results], faiss_indices[row][:k_results]
+            results[dataset_name][params['query']] = collect_results(
+                    indices, distances, metadata,
+                    auto_context_size=params['auto_context_size'],
+                    dataset_name=dataset_name,
+                    score_key=score_key(params['mode']))
     return results
 
 def cut_prev(prev, current):
@@ -88,55 +293,41 @@ def cut_next(next, current):
     return next[i:]
 
 def format_result(result_number, metas, result_index, distance,
-                  auto_context_size, dataset):
+                  auto_context_size, dataset, window=None, score_key='dist'):
+    """
+    window: (first, last) rows of the context, see metastore.context_windows()
+    score_key: 'dist' for vector distances, 'score' for BM25 and fusion scores
+    """
     meta = metas[result_index]
     text = meta.para
-    filp = meta.doc_path
-    filn = os.path.basename(filp)
+    if window is None:
+        firsts, lasts = metastore.context_windows(metas, [result_index],
+                                                  auto_context_size,
+                                                  max_steps=MAX_CONTEXT_STEPS)
+        window = (firsts[0], lasts[0])
+    first, last = window
 
     prev_metas = []
     next_metas = []
-    total_text = text
-    ctx_iter = 0
-    prev_exhausted = False
-    next_exhausted = False
-    safety_net = 0
-    while len(total_text) < auto_context_size:
-        safety_net += 1
-        if safety_net == 10:
-            break
-        if prev_exhausted and next_exhausted:
-            break
-        ctx_iter += 1
-        # add context before
-        if result_index - ctx_iter >= 0:
-            prev = metas[result_index - ctx_iter]
-            # if same doc, extract text
-            if prev.doc_path == meta.doc_path:
-                # only use if text differs from main text
-                if prev.para != text:
-                    d = prev._asdict()
-                    d['para'] = cut_prev(prev.para, text)
-                    prev_metas.append(d)
-                    total_text += d['para']
-            else:
-                prev_exhausted = True
-        # add context after
-        if result_index + ctx_iter < len(metas):
-            next = metas[result_index + ctx_iter]
-            # if same doc, extract text
-            if next.doc_path == meta.doc_path:
-                # only use if text differs from main text
-                if next.para != text:
-                    d = next._asdict()
-                    d['para'] = cut_next(next.para, text)
-                    next_metas.append(d)
-                    total_text += d['para']
-            else:
-                next_exhausted = True
-    prev_metas.reverse()
+    # add context before
+    for index in range(first, result_index):
+        prev = metas[index]
+        # only use if text differs from main text
+        if prev.para != text:
+            d = prev._asdict()
+            d['para'] = cut_prev(prev.para, text)
+            prev_metas.append(d)
+    # add context after
+    for index in range(result_index + 1, last + 1):
+        next = metas[index]
+        # only use if text differs from main text
+        if next.para != text:
+            d = next._asdict()
+            d['para'] = cut_next(next.para, text)
+            next_metas.append(d)
     meta = meta._asdict()
-    meta['dist'] = f'{distance:0.3f}'
+    # fusion scores differ in the 4th decimal
+    meta[score_key] = f'{distance:0.3f}' if score_key == 'dist' else f'{distance:0.4f}'
     ret = {
             'meta': meta,
             'prev': prev_metas,
@@ -145,53 +336,172 @@ def format_result(result_number, metas, result_index, distance,
     return ret
 
 
-@app.route('/rkiapi/search', methods=['GET'])
-def search():
-    dataset_name = request.args.get('dataset')
+def parse_search_params(args):
+    """
+    validate the parameters of a search, given as query args or as a JSON
+    object. returns (params, error)
+    """
+    def missing(value):
+        return value is None or value == ''
+
+    dataset_name = args.get('dataset')
     if dataset_name not in dataset_names:
-        return jsonify({"error": "dataset name invalid"}), 400
-    query = request.args.get('query')
-    print('API passthrough:', query, flush=True)
-    k_results = request.args.get('k_results')
-    remove_dupes = request.args.get('remove_dupes')
-    auto_context_size = request.args.get('auto_context_size')
-
-    if not query:
-        return jsonify({"error": "query parameter is required"}), 400
-    if not k_results:
-        return jsonify({"error": "k_results parameter is required"}), 400
-    if not remove_dupes:
-        return jsonify({"error": "remove_dupes parameter is required"}), 400
-    if not auto_context_size:
-        return jsonify({"error": "auto_context_size parameter is required"}), 400
+        return None, "dataset name invalid"
+    query = args.get('query')
+    k_results = args.get('k_results')
+    remove_dupes = args.get('remove_dupes')
+    auto_context_size = args.get('auto_context_size')
+
+    if missing(query):
+        return None, "query parameter is required"
+    if not isinstance(query, str):
+        return None, "query parameter is invalid"
+    if missing(k_results):
+        return None, "k_results parameter is required"
+    if missing(remove_dupes):
+        return None, "remove_dupes parameter is required"
+    if missing(auto_context_size):
+        return None, "auto_context_size parameter is required"
 
     try:
         k_results = int(k_results)
     except:
-        return jsonify({"error": "k_results parameter is invalid"}), 400
+        return None, "k_results parameter is invalid"
     try:
         auto_context_size = int(auto_context_size)
     except:
-        return jsonify({"error": "auto_context_size parameter is invalid"}), 400
+        return None, "auto_context_size parameter is invalid"
 
+    if isinstance(remove_dupes, bool):
+        remove_dupes = 'true' if remove_dupes else 'false'
     if remove_dupes != 'true' and remove_dupes != 'false':
-        return jsonify({"error": "remove_dupes parameter is invalid"}), 400
+        return None, "remove_dupes parameter is invalid"
     remove_dupes = remove_dupes == 'true'
 
+    mode = args.get('mode')
+    explicit_mode = not missing(mode)
+    if not explicit_mode:
+        mode = 'lexical' if lexicalindex.is_phrase_query(query) else 'vector'
+    if mode not in SEARCH_MODES:
+        return None, "mode parameter is invalid"
+    dataset = datasets.get(dataset_name)
+    if dataset is None:
+        return None, "dataset is not available"
+    if dataset['lexical'] is None and mode != 'vector':
+        # dataset built without lexical index: quoted queries fall back to
+        # vector search, explicit modes are refused
+        if explicit_mode:
+            return None, "lexical index not available"
+        mode = 'vector'
+
     # a bit of sanity
     if k_results > 1000:
         k_results = 1000
     if auto_context_size > 5000:
         auto_context_size = 5000
 
-    q_emb_cache = datasets[dataset_name]['qcache']
-    faiss_index = datasets[dataset_name]['faiss']
-    metadata = datasets[dataset_name]['metadata']
-    return jsonify(process_query(query, q_emb_cache, faiss_index, metadata,
-                                 k_results=k_results,
-                                 remove_dupes=remove_dupes,
-                                 auto_context_size=auto_context_size,
-                                 dataset_name=dataset_name))
+    return {
+            'dataset': dataset_name,
+            'query': query,
+            'k_results': k_results,
+            'remove_dupes': remove_dupes,
+            'auto_context_size': auto_context_size,
+            'mode': mode,
+           }, None
+
+
+@app.route('/rkiapi/search', methods=['GET'])
+def search():
+    params, error = parse_search_params(request.args)
+    if error:
+        return jsonify({"error": error}), 400
+    print('API passthrough:', params['query'], flush=True)
+
+    cache_key = (params['dataset'], params['query'], params['k_results'],
+                 params['remove_dupes'], params['auto_context_size'], params['mode'])
+    data = result_cache.get(cache_key)
+    if data is not None:
+        return app.response_class(data, mimetype='application/json')
+
+    dataset_name = params['dataset']
+    dataset = datasets[dataset_name]
+    q_emb_cache = dataset['qcache']
+    faiss_index = dataset['faiss']
+    metadata = dataset['metadata']
+    response = jsonify(process_query(params['query'], q_emb_cache, faiss_index, metadata,
+                                     k_results=params['k_results'],
+                                     remove_dupes=params['remove_dupes'],
+                                     auto_context_size=params['auto_context_size'],
+                                     dataset_name=dataset_name,
+                                     mode=params['mode'],
+                                     lexical_index=dataset['lexical']))
+    result_cache.put(cache_key, response.get_data())
+    return response
+
+
+@app.route('/rkiapi/cache_stats', methods=['GET'])
+def cache_stats():
+    return jsonify(get_cache_stats())
+
+
+@app.route('/rkiapi/datasets', methods=['GET'])
+def dataset_status():
+    return jsonify(datasets.status())
+
+
+def get_cache_stats():
+    # counters are per worker process
+    executors = {dn: dataset['faiss'].stats() for dn, dataset in datasets.loaded().items()
+                 if isinstance(dataset['faiss'], searchexecutor.SearchExecutor)}
+    return {'pid': os.getpid(), 'result_cache': result_cache.stats(),
+            'search_executors': executors}
+
+
+@app.route('/rkiapi/search_batch', methods=['POST'])
+def search_batch():
+    """
+    JSON body:
+        {
+            "queries": ["query", {"query": "other query", "dataset": "..."}, ...],
+            "dataset": "...", "k_results": 20, "remove_dupes": true,
+            "auto_context_size": 300, "mode": "vector"
+        }
+    Top-level parameters are defaults for all queries. Returns
+        {"results": {dataset: {query: [results as in /rkiapi/search]}}}
+    """
+    data, status = run_search_batch(request.get_json(silent=True))
+    return jsonify(data), status
+
+
+def run_search_batch(body):
+    """
+    returns (response data, status code) for the JSON body of a batch search
+    """
+    if not isinstance(body, dict):
+        return {"error": "JSON body is required"}, 400
+    queries = body.get('queries')
+    if not isinstance(queries, list) or not queries:
+        return {"error": "queries parameter is required"}, 400
+    if len(queries) > MAX_BATCH_QUERIES:
+        return {"error": f"at most {MAX_BATCH_QUERIES} queries allowed"}, 400
+
+    defaults = {key: value for key, value in body.items() if key != 'queries'}
+    search_params = []
+    # results are keyed by dataset and query text
+    seen = {}
+    for i, query in enumerate(queries):
+        if not isinstance(query, dict):
+            query = {'query': query}
+        params, error = parse_search_params({**defaults, **query})
+        if error:
+            return {"error": f"query {i}: {error}"}, 400
+        j = seen.setdefault((params['dataset'], params['query']), i)
+        if j != i and search_params[j] != params:
+            return {"error": f"query {i}: same query and dataset as query {j} with other parameters"}, 400
+        search_params.append(params)
+    print('API batch passthrough:', len(search_params), 'queries', flush=True)
+
+    return {"results": process_batch(search_params)}, 200
 
 if __name__ == "__main__":
     app.run(debug=True)
@@ -1,14 +1,72 @@
+"""
+Embedding backends and the pickled embedding cache.
+
+Two backends compute embeddings:
+
+    openai   Model: the OpenAI API (default), needs OPENAI_RKI_KEY
+    local    LocalModel: a sentence-transformers model on the CPU, no API key
+             or network needed. Install sentence-transformers for it.
+
+A dataset records the backend, model and dims it was built with in its
+index.json, see embedding_config(), so that queries are embedded by the
+same model as the corpus.
+"""
+
 from dataclasses import dataclass
 import os
+import re
+import asyncio
+import threading
 from time import time
 from collections import OrderedDict
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 import pickle
 
 DEFAULT_MODEL ='text-embedding-3-large'
 DEFAULT_DIMS = 3072
 
-client = OpenAI(api_key=os.environ['OPENAI_RKI_KEY'])
+BACKENDS = ['openai', 'local']
+DEFAULT_BACKEND = 'openai'
+# multilingual, 384 dims
+DEFAULT_LOCAL_MODEL = 'sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2'
+
+# what datasets built before backends were recorded were built with
+DEFAULT_EMBEDDING_CONFIG = {
+    'backend': DEFAULT_BACKEND,
+    'model': DEFAULT_MODEL,
+    'dims': DEFAULT_DIMS,
+}
+
+client = None
+client_no_retries = None
+client_lock = threading.Lock()
+
+
+def get_client(retries=True):
+    """
+    retries=False: the client does not retry failed requests by itself, for
+    embedscheduler.py, which retries and throttles on its own
+    """
+    # created on first use: without the openai backend, no key is needed
+    global client, client_no_retries
+    with client_lock:
+        if client is None:
+            if not os.getenv('OPENAI_RKI_KEY'):
+                raise RuntimeError('OPENAI_RKI_KEY is not set')
+            client = OpenAI(api_key=os.environ['OPENAI_RKI_KEY'])
+            client_no_retries = client.with_options(max_retries=0)
+    return client if retries else client_no_retries
+
+async_client = None
+
+def get_async_client():
+    # for the event loop of asyncapi.py, which is the only one using it
+    global async_client
+    if async_client is None:
+        if not os.getenv('OPENAI_RKI_KEY'):
+            raise RuntimeError('OPENAI_RKI_KEY is not set')
+        async_client = AsyncOpenAI(api_key=os.environ['OPENAI_RKI_KEY'])
+    return async_client
 
 @dataclass
 class EmbeddingStats:
@@ -26,6 +84,8 @@ class EmbeddingStats:
 
 
 class Model:
+    backend = 'openai'
+
     def __init__(self, name=DEFAULT_MODEL, dims=None):
         self.name = name
         self.dims = dims
@@ -33,6 +93,8 @@ class Model:
         self.stats = EmbeddingStats()
         self.sentence_stats : dict[str, EmbeddingStats] = OrderedDict()
         self.already_saved_stat_sentences = set()
+        # batches may be embedded from several threads, see embedscheduler.py
+        self.stats_lock = threading.Lock()
 
     def check_dims(self):
         model_max_dims = {
@@ -49,12 +111,17 @@ class Model:
             raise ValueError(f'Model {self.name} can handle only {max_dims} dims. Requested: {self.dims}')
         return
 
+    @property
+    def cache_name(self):
+        # part of cache file names and keys
+        return self.name
+
     def get_embeddings(self, sentence, keep_stats=True):
         time_start = time()
         if self.dims is None:
-            response = client.embeddings.create(model=self.name, input=sentence)
+            response = get_client().embeddings.create(model=self.name, input=sentence)
         else:
-            response = client.embeddings.create(model=self.name,
+            response = get_client().embeddings.create(model=self.name,
                                                 input=sentence,
                                                 dimensions=self.dims)
         time_end = time()
@@ -68,13 +135,29 @@ class Model:
             self.sentence_stats[sentence] = stats
         return embedding, stats
 
-    def get_embeddings_batch(self, batch):
+    async def aget_embeddings(self, sentence):
+        """
+        like get_embeddings(), awaiting the response instead of blocking
+        """
+        time_start = time()
+        if self.dims is None:
+            response = await get_async_client().embeddings.create(model=self.name, input=sentence)
+        else:
+            response = await get_async_client().embeddings.create(model=self.name,
+                                                                  input=sentence,
+                                                                  dimensions=self.dims)
+        time_end = time()
+        stats = EmbeddingStats(prompt_tokens=response.usage.prompt_tokens,
+                               time=time_end - time_start)
+        return response.data[0].embedding, stats
+
+    def get_embeddings_batch(self, batch, retries=True):
         time_start = time()
         batch_name = f'batch-{time_start}'
         if self.dims is None:
-            response = client.embeddings.create(model=self.name, input=batch)
+            response = get_client(retries).embeddings.create(model=self.name, input=batch)
         else:
-            response = client.embeddings.create(model=self.name,
+            response = get_client(retries).embeddings.create(model=self.name,
                                                 input=batch,
                                                 dimensions=self.dims)
         time_end = time()
@@ -82,12 +165,13 @@ class Model:
         usage = response.usage
         stats = EmbeddingStats(prompt_tokens=usage.prompt_tokens,
                                time=time_end - time_start)
-        self.stats.add(stats)
-        self.sentence_stats[batch_name] = stats
+        with self.stats_lock:
+            self.stats.add(stats)
+            self.sentence_stats[batch_name] = stats
         return embeddings, stats
 
     def save_stats(self):
-        stats_filn = f'modelstats_{self.name}_{self.dims}.csv'
+        stats_filn = f'modelstats_{self.cache_name}_{self.dims}.csv'
         if not os.path.exists(stats_filn):
             f = open(stats_filn, 'wt')
             f.write('num_tokens;time;sentence\n')
@@ -101,11 +185,116 @@ class Model:
         f.close()
 
 
+class LocalModel(Model):
+    """
+    sentence-transformers model on the CPU. Batches are embedded in one
+    inference call; RKI_LOCAL_THREADS sets the number of threads it uses,
+    RKI_LOCAL_RUNTIME=onnx runs the model with ONNX Runtime. With dims below
+    the model's, embeddings are truncated (for Matryoshka models).
+    """
+    backend = 'local'
+
+    def __init__(self, name=DEFAULT_LOCAL_MODEL, dims=None, batch_size=64):
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            raise RuntimeError('The local embedding backend needs sentence-transformers: '
+                               'pip install sentence-transformers')
+        threads = os.getenv('RKI_LOCAL_THREADS')
+        if threads:
+            import torch
+            torch.set_num_threads(int(threads))
+        kwargs = {}
+        if os.getenv('RKI_LOCAL_RUNTIME'):
+            kwargs['backend'] = os.getenv('RKI_LOCAL_RUNTIME')
+        print(f'Loading local embedding model {name}...')
+        self.transformer = SentenceTransformer(name, device='cpu', **kwargs)
+        self.batch_size = batch_size
+        # one inference at a time, each uses all threads
+        self.encode_lock = threading.Lock()
+        super().__init__(name=name, dims=dims)
+        self.transformer.truncate_dim = self.dims
+
+    def check_dims(self):
+        max_dims = self.transformer.get_sentence_embedding_dimension()
+        if self.dims is None:
+            self.dims = max_dims
+        if self.dims > max_dims:
+            raise ValueError(f'Model {self.name} can handle only {max_dims} dims. Requested: {self.dims}')
+
+    @property
+    def cache_name(self):
+        return 'local-' + re.sub(r'[^\w.-]+', '_', self.name).strip('_')
+
+    def get_embeddings(self, sentence, keep_stats=True):
+        embeddings, stats = self.encode([sentence])
+        if keep_stats:
+            with self.stats_lock:
+                self.stats.add(stats)
+                self.sentence_stats[sentence] = stats
+        return embeddings[0], stats
+
+    async def aget_embeddings(self, sentence):
+        # inference is CPU-bound, it runs in a thread
+        return await asyncio.to_thread(self.get_embeddings, sentence, False)
+
+    def get_embeddings_batch(self, batch, retries=True):
+        # nothing to retry locally
+        embeddings, stats = self.encode(batch)
+        with self.stats_lock:
+            self.stats.add(stats)
+            self.sentence_stats[f'batch-{time()}'] = stats
+        return embeddings, stats
+
+    def encode(self, batch):
+        time_start = time()
+        with self.encode_lock:
+            embeddings = self.transformer.encode(list(batch), batch_size=self.batch_size,
+                                                 convert_to_numpy=True)
+        stats = EmbeddingStats(time=time() - time_start, n=len(batch))
+        return list(embeddings.astype('float32')), stats
+
+
+# local models are big, all caches share one instance per model
+local_models = {}
+
+
+def create_model(backend=DEFAULT_BACKEND, name=None, dims=None):
+    """
+    name None: the default model of the backend
+    """
+    if backend == 'openai':
+        return Model(name=name or DEFAULT_MODEL, dims=dims)
+    if backend == 'local':
+        key = (name or DEFAULT_LOCAL_MODEL, dims)
+        with client_lock:
+            if key not in local_models:
+                local_models[key] = LocalModel(name=key[0], dims=dims)
+        return local_models[key]
+    raise ValueError(f'Unknown embedding backend {backend}. Choose one of {BACKENDS}')
+
+
+def embedding_config(model):
+    """
+    what a dataset records about the model it was built with
+    """
+    return {'backend': model.backend, 'model': model.name, 'dims': model.dims}
+
+
+def model_from_config(config):
+    """
+    config: as recorded in a dataset's index.json. missing: the OpenAI model
+    of datasets built before backends were recorded
+    """
+    config = {**DEFAULT_EMBEDDING_CONFIG, **(config or {})}
+    return create_model(config['backend'], config['model'], config['dims'])
+
+
 class EmbeddingCache:
-    def __init__(self, name, model=DEFAULT_MODEL, dataset_dir='.',
-                 max_cache_size=None):
-        self.model = Model(name=model)
-        self.cache_file = os.path.join(dataset_dir, f'{name}_{self.model.name}_{self.model.dims}.pkl')
+    def __init__(self, name, model=None, dataset_dir='.',
+                 max_cache_size=None, backend=DEFAULT_BACKEND, dims=None):
+        self.model = create_model(backend, model, dims)
+        self.cache_file = os.path.join(dataset_dir, f'{name}_{self.model.cache_name}_{self.model.dims}.pkl')
         self.max_cache_size = max_cache_size
         self.values = OrderedDict()
         self.load_cache()
@@ -155,18 +344,28 @@ class EmbeddingCache:
                 # Remove the first (least recently used) item
                 self.values.popitem(last=False)
 
+    def uncached(self, sentence_batch):
+        # unique sentences of the batch that are not cached, in order
+        return list(dict.fromkeys(s for s in sentence_batch if s not in self.values))
+
     def get_batch(self, sentence_batch, auto_save=False):
-        # find uncached sentences
-        new_batch = [s for s in sentence_batch if s not in self.values]
+        # cached embeddings are taken before the new ones are put: with
+        # max_cache_size, putting them might evict the cached ones
+        found = {}
+        for sentence in sentence_batch:
+            if sentence in self.values and sentence not in found:
+                if self.max_cache_size is not None:
+                    self.values.move_to_end(sentence)
+                found[sentence] = self.values[sentence]
+        new_batch = list(dict.fromkeys(s for s in sentence_batch if s not in found))
 
         if new_batch:
             # we need to process some of the batch
             embeddings, stats = self.model.get_embeddings_batch(new_batch)
             for embedding, sentence in zip(embeddings, new_batch):
-                self.values[sentence] = embedding
+                self.put(sentence, embedding)
+                found[sentence] = embedding
             if auto_save:
                 self.save_cache()
-        embeddings = []
-        for sentence in sentence_batch:
-            embeddings.append(self.values[sentence])
+        embeddings = [found[sentence] for sentence in sentence_batch]
         return embeddings
@@ -0,0 +1,186 @@
+"""
+Concurrent embedding requests for dataset builds.
+
+Building a dataset is mostly waiting for the network. embed_batches() keeps
+several batches in flight in a thread pool while staying within the
+requests-per-minute and tokens-per-minute budgets of the OpenAI account.
+Rate limit errors (429), server errors (5xx) and connection errors are
+retried with exponential backoff; a 429 pauses all workers and lowers the
+budgets, which recover after a quiet period. Results are returned in the order of the batches.
+
+Throughput can be measured offline against openaistub.py:
+
+    python src/openaistub.py --latency=0.5 &
+    OPENAI_BASE_URL=http://localhost:8000/v1 OPENAI_RKI_KEY=x \\
+        python src/embedscheduler.py --num_batches=200 --workers=1,4,16
+"""
+
+import sys
+import time
+import random
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+
+from myargs import parse_args
+
+
+DEFAULT_WORKERS = 4
+DEFAULT_RPM = 3000
+DEFAULT_TPM = 1000000
+MAX_RETRIES = 8
+MAX_BACKOFF = 60
+# after a 429, budgets are lowered by THROTTLE_FACTOR, but not below
+# MIN_BUDGET of the configured ones. After RECOVERY_SECONDS without a 429
+# they grow back by RECOVERY_RATE of the configured ones per minute
+THROTTLE_FACTOR = 0.8
+MIN_BUDGET = 0.25
+RECOVERY_SECONDS = 60
+RECOVERY_RATE = 0.1
+
+
+class RateLimiter:
+    """
+    token buckets for requests and tokens per minute, shared by all workers
+    """
+    def __init__(self, rpm=DEFAULT_RPM, tpm=DEFAULT_TPM):
+        self.max_rpm = rpm
+        self.max_tpm = tpm
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = rpm
+        self.tokens = tpm
+        self.last_refill = time.monotonic()
+        self.last_throttle = None
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        elapsed = now - self.last_refill
+        if self.last_throttle is not None and now - self.last_throttle >= RECOVERY_SECONDS:
+            self.rpm = min(self.max_rpm, self.rpm + elapsed * self.max_rpm * RECOVERY_RATE / 60)
+            self.tpm = min(self.max_tpm, self.tpm + elapsed * self.max_tpm * RECOVERY_RATE / 60)
+        self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+        self.last_refill = now
+
+    def acquire(self, tokens):
+        while True:
+            with self.lock:
+                # a batch larger than the budget waits for a full bucket
+                tokens = min(tokens, self.tpm)
+                now = time.monotonic()
+                self.refill(now)
+                if now >= self.paused_until and self.requests >= 1 and self.tokens >= tokens:
+                    self.requests -= 1
+                    self.tokens -= tokens
+                    return
+                wait = max(self.paused_until - now,
+                           (1 - self.requests) * 60 / self.rpm,
+                           (tokens - self.tokens) * 60 / self.tpm)
+            time.sleep(max(wait, 0.001))
+
+    def throttle(self, seconds):
+        """
+        after a 429: pause all workers and lower the budgets by 20%, once per
+        pause, since the server's limits are evidently lower than ours. The
+        limits of the server may only be lower for a while, see refill()
+        """
+        with self.lock:
+            now = time.monotonic()
+            if now >= self.paused_until:
+                self.refill(now)
+                self.rpm = max(self.max_rpm * MIN_BUDGET, 1, self.rpm * THROTTLE_FACTOR)
+                self.tpm = max(self.max_tpm * MIN_BUDGET, 1, self.tpm * THROTTLE_FACTOR)
+                self.requests = min(self.requests, self.rpm)
+                self.tokens = min(self.tokens, self.tpm)
+            self.last_throttle = now
+            self.paused_until = max(self.paused_until, now + seconds)
+
+
+def retry_after(error):
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+def embed_with_retry(model, texts, num_tokens, limiter, max_retries=MAX_RETRIES):
+    for attempt in range(max_retries + 1):
+        limiter.acquire(num_tokens)
+        try:
+            # the openai client must not retry by itself: its backoff would
+            # come on top of ours and delay throttling
+            embeddings, stats = model.get_embeddings_batch(texts, retries=False)
+            return embeddings
+        except (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError) as e:
+            if attempt == max_retries:
+                raise
+            delay = retry_after(e)
+            if delay is None:
+                delay = min(MAX_BACKOFF, 2 ** attempt) * random.uniform(0.5, 1.0)
+            if isinstance(e, openai.RateLimitError):
+                limiter.throttle(delay)
+            print(f'{type(e).__name__}, retrying in {delay:.1f}s ({attempt + 1}/{max_retries})', flush=True)
+            time.sleep(delay)
+
+
+def embed_batches(model, batches, token_counts, workers=DEFAULT_WORKERS,
+                  rpm=DEFAULT_RPM, tpm=DEFAULT_TPM):
+    """
+    yield the embeddings of each batch of texts, in order. token_counts are
+    the numbers of tokens of the batches, for the tokens-per-minute budget.
+    """
+    limiter = RateLimiter(rpm=rpm, tpm=tpm)
+    jobs = iter(zip(batches, token_counts))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        in_flight = deque()
+
+        def submit_next():
+            job = next(jobs, None)
+            if job is not None:
+                in_flight.append(pool.submit(embed_with_retry, model, job[0], job[1], limiter))
+
+        # keep one batch queued per worker so none of them idles
+        for _ in range(2 * workers):
+            submit_next()
+        while in_flight:
+            embeddings = in_flight.popleft().result()
+            submit_next()
+            yield embeddings
+
+
+if __name__ == '__main__':
+    from embedding import Model
+
+    args, kwargs, flags = parse_args(sys.argv[1:])
+    if 'help' in flags:
+        print(f'Usage  : python {sys.argv[0]} [options]')
+        print(f'Measures embedding throughput, e.g. against openaistub.py via OPENAI_BASE_URL')
+        print(f'Options: --num_batches=100 --batch_size=100 --workers=1,4,16 --rpm={DEFAULT_RPM} --tpm={DEFAULT_TPM}')
+        sys.exit(1)
+
+    num_batches = int(kwargs.get('num_batches', 100))
+    batch_size = int(kwargs.get('batch_size', 100))
+    rpm = int(kwargs.get('rpm', DEFAULT_RPM))
+    tpm = int(kwargs.get('tpm', DEFAULT_TPM))
+    model = Model()
+    # roughly 20 tokens per text
+    batches = [[f'benchmark text {b} {i} ' * 5 for i in range(batch_size)]
+               for b in range(num_batches)]
+    token_counts = [20 * batch_size] * num_batches
+
+    for workers in kwargs.get('workers', '1,4,16').split(','):
+        workers = int(workers)
+        start = time.time()
+        num_texts = 0
+        for embeddings in embed_batches(model, batches, token_counts,
+                                        workers=workers, rpm=rpm, tpm=tpm):
+            num_texts += len(embeddings)
+        elapsed = time.time() - start
+        print(f'workers={workers:3d}: {num_batches / elapsed:8.1f} batches/s {num_texts / elapsed:10.1f} texts/s')
@@ -0,0 +1,371 @@
+"""
+Building and loading of the different FAISS index types.
+
+The type of index and its search parameters are stored in a small json file
+next to the `<dataset>_faiss.index` file, so main.get_resources() knows how
+to query whatever was built.
+
+text-embedding-3 vectors still work when truncated to their first dimensions
+(Matryoshka embeddings). With coarse_dims, the index holds only the first
+coarse_dims dimensions of the vectors, renormalized. A search fetches
+coarse_candidates candidates from it and re-ranks them exactly against the
+full vectors in `<dataset>_vectors.npy`, see RerankIndex.
+"""
+
+import os
+import json
+import math
+import faiss
+import numpy as np
+
+
+FILN_INDEX_CONFIG = 'index.json'
+FILN_VECTORS = 'vectors.npy'
+
+INDEX_TYPES = ['flat', 'ivfflat', 'ivfpq', 'hnsw']
+STORAGE_TYPES = ['fp32', 'fp16', 'sq8', 'pq']
+
+DEFAULT_INDEX_CONFIG = {
+    'index_type': 'flat',
+    'storage': 'fp32',      # how vectors are stored in the index
+    'nlist': None,          # IVF: number of clusters. None: 4 * sqrt(n)
+    'nprobe': 32,           # IVF: number of clusters visited per query
+    'pq_m': 64,             # PQ: number of sub-quantizers (bytes per vector)
+    'hnsw_m': 32,           # HNSW: number of neighbors per node
+    'ef_construction': 200, # HNSW: search depth while building
+    'ef_search': 128,       # HNSW: search depth while querying
+    'train_size': 100000,   # max number of vectors used for training
+    'rerank': 0,            # re-rank rerank * k candidates exactly. 0: off
+    'coarse_dims': 0,       # index only the first coarse_dims dimensions. 0: all
+    'coarse_candidates': 300, # coarse index: candidates re-ranked at full dimension
+}
+
+# options that are strings, all others are ints
+STRING_OPTIONS = ['index_type', 'storage']
+
+
+def make_index_config(kwargs):
+    """
+    create an index config from command line kwargs, see myargs.parse_args
+    """
+    config = dict(DEFAULT_INDEX_CONFIG)
+    for key, default in DEFAULT_INDEX_CONFIG.items():
+        if key not in kwargs:
+            continue
+        value = kwargs[key]
+        if key not in STRING_OPTIONS:
+            value = int(value)
+        config[key] = value
+    if config['index_type'] not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type {config['index_type']}. Choose one of {INDEX_TYPES}")
+    if config['storage'] not in STORAGE_TYPES:
+        raise ValueError(f"Unknown storage {config['storage']}. Choose one of {STORAGE_TYPES}")
+    if config['index_type'] == 'ivfpq':
+        config['storage'] = 'pq'
+    if config['coarse_dims'] < 0:
+        raise ValueError('coarse_dims must not be negative')
+    return config
+
+
+def get_codec_string(config, dimension):
+    storage = config['storage']
+    if storage == 'fp32':
+        return 'Flat'
+    elif storage == 'fp16':
+        return 'SQfp16'
+    elif storage == 'sq8':
+        return 'SQ8'
+    elif storage == 'pq':
+        if dimension % config['pq_m'] != 0:
+            raise ValueError(f"pq_m={config['pq_m']} must divide the dimension {dimension}")
+        return f'PQ{config["pq_m"]}'
+    raise RuntimeError("unreachable")
+
+
+def get_factory_string(config, dimension, num_vectors):
+    index_type = config['index_type']
+    nlist = config['nlist']
+    if nlist is None:
+        nlist = max(1, int(4 * math.sqrt(num_vectors)))
+        config['nlist'] = nlist
+    codec = get_codec_string(config, dimension)
+    if index_type == 'flat':
+        return codec
+    elif index_type in ['ivfflat', 'ivfpq']:
+        return f'IVF{nlist},{codec}'
+    elif index_type == 'hnsw':
+        return f'HNSW{config["hnsw_m"]},{codec}'
+    raise RuntimeError("unreachable")
+
+
+def get_search_params(config):
+    index_type = config['index_type']
+    if index_type in ['ivfflat', 'ivfpq']:
+        return {'nprobe': config['nprobe']}
+    elif index_type == 'hnsw':
+        return {'efSearch': config['ef_search']}
+    return {}
+
+
+def get_training_sample(embeddings, train_size):
+    if len(embeddings) <= train_size:
+        return embeddings
+    rng = np.random.default_rng(1234)
+    sample = rng.choice(len(embeddings), size=train_size, replace=False)
+    sample.sort()
+    return embeddings[sample]
+
+
+class TruncatedVectors:
+    """
+    The first dims dimensions of vectors, renormalized, computed on access.
+    Quacks like an array as far as create_index() and refill_index() care.
+    """
+    def __init__(self, vectors, dims):
+        if not 0 < dims < vectors.shape[1]:
+            raise ValueError(f'coarse_dims={dims} must be less than the dimension {vectors.shape[1]}')
+        self.vectors = vectors
+        self.dims = dims
+        self.shape = (vectors.shape[0], dims)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, rows):
+        return truncate(self.vectors[rows, :self.dims])
+
+
+def truncate(embeddings, dims=None):
+    """
+    first dims dimensions of normalized embeddings, normalized again
+    """
+    embeddings = np.array(embeddings[:, :dims], dtype='float32')
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    embeddings /= np.maximum(norms, 1e-12)
+    return embeddings
+
+
+def coarse_vectors(embeddings, config):
+    if config['coarse_dims']:
+        return TruncatedVectors(embeddings, config['coarse_dims'])
+    return embeddings
+
+
+def create_index(embeddings, config, chunk_size=50000):
+    """
+    embeddings may be memory-mapped: they are added to the index in chunks
+    of chunk_size float32 vectors
+    """
+    embeddings = coarse_vectors(embeddings, config)
+    dimension = embeddings.shape[1]
+    factory = get_factory_string(config, dimension, len(embeddings))
+    config['factory'] = factory
+    config['dimension'] = dimension
+    config['search_params'] = get_search_params(config)
+    print(f'Creating FAISS index {factory}...')
+    index = faiss.index_factory(dimension, factory, faiss.METRIC_L2)
+    if config['index_type'] == 'hnsw':
+        index.hnsw.efConstruction = config['ef_construction']
+    if not index.is_trained:
+        print('Training FAISS index...')
+        index.train(np.ascontiguousarray(get_training_sample(embeddings, config['train_size']),
+                                         dtype='float32'))
+    for start in range(0, len(embeddings), chunk_size):
+        index.add(np.ascontiguousarray(embeddings[start:start + chunk_size], dtype='float32'))
+    apply_search_params(index, config)
+    return index
+
+
+def refill_index(index, embeddings, config, chunk_size=50000):
+    """
+    replace the vectors of a trained index, without training it again.
+    Flat and IVF indexes only store (and assign) the vectors, but an HNSW
+    graph is built again from all of them, which takes as long as a new index
+    """
+    embeddings = coarse_vectors(embeddings, config)
+    if config['index_type'] == 'hnsw':
+        print(f"Rebuilding the HNSW graph of FAISS index {config.get('factory', '')} "
+              f"for all {len(embeddings)} vectors...")
+    else:
+        print(f"Refilling FAISS index {config.get('factory', '')}...")
+    index.reset()
+    for start in range(0, len(embeddings), chunk_size):
+        index.add(np.ascontiguousarray(embeddings[start:start + chunk_size], dtype='float32'))
+    apply_search_params(index, config)
+    return index
+
+
+def apply_search_params(index, config):
+    params = faiss.ParameterSpace()
+    for name, value in config.get('search_params', {}).items():
+        params.set_index_parameter(index, name, value)
+    return index
+
+
+def save_vectors(embeddings, filepath):
+    """
+    keep a full-precision copy of the normalized vectors on disk for exact
+    re-ranking and for recall measurements of quantized indexes
+    """
+    print('Saving vectors...')
+    np.save(filepath, np.ascontiguousarray(embeddings, dtype='float32'))
+
+
+def create_vectors(filepath, num_vectors, dimension):
+    """
+    preallocated float32 vectors on disk, filled by the caller
+    """
+    return np.lib.format.open_memmap(filepath, mode='w+', dtype='float32',
+                                     shape=(num_vectors, dimension))
+
+
+def load_vectors(filepath):
+    return np.load(filepath, mmap_mode='r')
+
+
+class MmapFlatIndex:
+    """
+    Exact search directly over the memory-mapped full-precision vectors.
+
+    Equivalent to a flat index of the same vectors, but the vectors live in
+    the page cache and are shared by all processes that map the file.
+    With ranges (list of (start, end) row ranges), only those rows are
+    searched.
+    """
+    def __init__(self, vectors, ranges=None):
+        self.vectors = vectors
+        self.ranges = ranges
+        if ranges is None:
+            self.ntotal = vectors.shape[0]
+        else:
+            self.ntotal = sum(end - start for start, end in ranges)
+        self.d = vectors.shape[1]
+
+    def search(self, query_embeddings, k):
+        query_embeddings = np.ascontiguousarray(query_embeddings, dtype='float32')
+        if self.ranges is None:
+            return faiss.knn(query_embeddings, self.vectors, k)
+        heap = faiss.ResultHeap(len(query_embeddings), k)
+        for start, end in self.ranges:
+            distances, indices = faiss.knn(query_embeddings, self.vectors[start:end],
+                                           min(k, end - start))
+            heap.add_result(distances, indices + start)
+        heap.finalize()
+        return heap.D, heap.I
+
+
+def can_mmap(config):
+    """
+    faiss only memory-maps the inverted lists of IVF indexes. Flat indexes
+    can be replaced by MmapFlatIndex, everything else is read into memory.
+    """
+    return config['index_type'] in ['ivfflat', 'ivfpq']
+
+
+class RerankIndex:
+    """
+    Wraps a (quantized or coarse) index: fetches rerank * k candidates, at
+    least min_candidates, from it and re-ranks them exactly against the
+    full-precision vectors on disk. With dims, the index holds only the first
+    dims dimensions, and queries are truncated to them for the first stage.
+
+    Quacks like a faiss index as far as main.search_faiss_index() cares.
+    """
+    def __init__(self, index, vectors, k_factor, dims=None, min_candidates=0):
+        self.index = index
+        self.vectors = vectors
+        self.k_factor = k_factor
+        self.dims = dims
+        self.min_candidates = min_candidates
+        self.ntotal = index.ntotal
+        self.d = vectors.shape[1]
+
+    def search(self, query_embeddings, k):
+        query_embeddings = np.ascontiguousarray(query_embeddings, dtype='float32')
+        coarse_queries = truncate(query_embeddings, self.dims) if self.dims else query_embeddings
+        k_fetch = min(max(k * self.k_factor, self.min_candidates, k), self.ntotal)
+        _, candidates = self.index.search(coarse_queries, k_fetch)
+        distances = np.full((len(query_embeddings), k), np.inf, dtype='float32')
+        indices = np.full((len(query_embeddings), k), -1, dtype='int64')
+        for q, (query, cands) in enumerate(zip(query_embeddings, candidates)):
+            cands = cands[cands >= 0]
+            # sorted reads are friendlier to the page cache
+            cands.sort()
+            exact = ((self.vectors[cands] - query) ** 2).sum(axis=1)
+            order = np.argsort(exact)[:k]
+            distances[q, :len(order)] = exact[order]
+            indices[q, :len(order)] = cands[order]
+        return distances, indices
+
+
+def coarse_rerank_index(index, vectors, config):
+    """
+    the two-stage search of an index built with coarse_dims
+    """
+    return RerankIndex(index, vectors, config['rerank'], dims=config['coarse_dims'],
+                       min_candidates=config['coarse_candidates'])
+
+
+def ranges_to_bitmap(ranges, ntotal):
+    mask = np.zeros(ntotal, dtype=bool)
+    for start, end in ranges:
+        mask[start:end] = True
+    return np.packbits(mask, bitorder='little')
+
+
+class SubsetIndex:
+    """
+    Restricts searches in a faiss index to the rows in ranges, a list of
+    (start, end) row ranges, via an IDSelectorBitmap.
+    """
+    def __init__(self, index, ranges, config):
+        if config['index_type'] == 'flat' and config['storage'] == 'pq':
+            raise ValueError('Subsets are not supported for flat PQ indexes')
+        self.index = index
+        self.ranges = ranges
+        self.ntotal = sum(end - start for start, end in ranges)
+        self.d = index.d
+        # faiss does not copy the bitmap, keep a reference to it
+        self.bitmap = ranges_to_bitmap(ranges, index.ntotal)
+        self.selector = faiss.IDSelectorBitmap(index.ntotal, faiss.swig_ptr(self.bitmap))
+        search_params = config.get('search_params', {})
+        if config['index_type'] in ['ivfflat', 'ivfpq']:
+            self.params = faiss.SearchParametersIVF(sel=self.selector, **search_params)
+        elif config['index_type'] == 'hnsw':
+            self.params = faiss.SearchParametersHNSW(sel=self.selector, **search_params)
+        else:
+            self.params = faiss.SearchParameters(sel=self.selector)
+
+    def search(self, query_embeddings, k):
+        query_embeddings = np.ascontiguousarray(query_embeddings, dtype='float32')
+        return self.index.search(query_embeddings, k, params=self.params)
+
+
+def restrict_index(index, ranges, config):
+    """
+    return an index that searches only the rows in ranges
+    """
+    if isinstance(index, RerankIndex):
+        return RerankIndex(restrict_index(index.index, ranges, config),
+                           index.vectors, index.k_factor, index.dims, index.min_candidates)
+    if isinstance(index, MmapFlatIndex):
+        return MmapFlatIndex(index.vectors, ranges)
+    return SubsetIndex(index, ranges, config)
+
+
+def save_index_config(config, filepath):
+    print('Saving index config...')
+    with open(filepath, 'wt') as f:
+        json.dump(config, f, indent=4)
+
+
+def load_index_config(filepath):
+    """
+    datasets built before index types were introduced have no config file:
+    they are flat indexes.
+    """
+    config = dict(DEFAULT_INDEX_CONFIG)
+    if os.path.exists(filepath):
+        with open(filepath, 'rt') as f:
+            config.update(json.load(f))
+    return config
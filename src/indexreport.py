@@ -0,0 +1,168 @@
+"""
+Report memory usage and recall@k of datasets' FAISS indexes.
+
+Ground truth is an exact search over the full-precision vectors that
+preprocess.py saves next to the index (`<dataset>_vectors.npy`).
+
+With --coarse_dims, two-stage search is benchmarked against the flat
+full-dimension index: for each number of dimensions, a flat index of the
+truncated vectors is built in memory, and its results with and without
+re-ranking of --candidates candidates are compared by latency, memory and
+recall.
+"""
+
+import sys
+import os
+import time
+import faiss
+import numpy as np
+from tqdm import tqdm
+
+import faissindex
+from myargs import parse_args
+
+
+FILN_FAISS_INDEX = 'faiss.index'
+DIRN_METASTORE = 'metastore'
+FILN_INDEX_CONFIG = faissindex.FILN_INDEX_CONFIG
+FILN_VECTORS = faissindex.FILN_VECTORS
+
+
+def file_size_mb(filepath):
+    if not os.path.exists(filepath):
+        return 0.0
+    if os.path.isdir(filepath):
+        return sum(file_size_mb(os.path.join(filepath, filn)) for filn in os.listdir(filepath))
+    return os.path.getsize(filepath) / 1024 / 1024
+
+
+def make_queries(vectors, num_queries, seed=1234):
+    """
+    queries are blends of two random corpus vectors, so they are close to
+    real data but not identical to any indexed vector
+    """
+    rng = np.random.default_rng(seed)
+    a = rng.choice(len(vectors), size=num_queries)
+    b = rng.choice(len(vectors), size=num_queries)
+    a.sort()
+    b.sort()
+    queries = np.array(vectors[a]) + np.array(vectors[b])
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    return queries.astype('float32')
+
+
+def exact_search(vectors, queries, k, chunk_size=50000):
+    heap = faiss.ResultHeap(len(queries), k)
+    for start in tqdm(range(0, len(vectors), chunk_size)):
+        chunk = np.ascontiguousarray(vectors[start:start + chunk_size], dtype='float32')
+        distances, indices = faiss.knn(queries, chunk, min(k, len(chunk)))
+        heap.add_result(distances, indices + start)
+    heap.finalize()
+    return heap.D, heap.I
+
+
+def recall_at_k(found, truth):
+    k = truth.shape[1]
+    hits = sum(len(np.intersect1d(f, t)) for f, t in zip(found, truth))
+    return hits / (len(truth) * k)
+
+
+def timed_search(index, queries, k):
+    start = time.time()
+    _, indices = index.search(queries, k)
+    elapsed = time.time() - start
+    return indices, elapsed * 1000 / len(queries)
+
+
+def coarse_report(vectors, queries, truth, k, coarse_dims, candidates):
+    num_vectors, dimension = vectors.shape
+    flat_mb = num_vectors * dimension * 4 / 1024 / 1024
+    found, ms = timed_search(faissindex.MmapFlatIndex(vectors), queries, k)
+    print(f'\nflat {dimension:5d} dims: {flat_mb:10.1f} MB  recall@{k}: {recall_at_k(found, truth):.4f}  ({ms:.2f} ms/query)')
+    for dims in coarse_dims:
+        if dims >= dimension:
+            print(f'Skipping {dims} dims: not less than {dimension}')
+            continue
+        config = faissindex.make_index_config({'coarse_dims': dims})
+        index = faissindex.create_index(vectors, config)
+        index_mb = num_vectors * dims * 4 / 1024 / 1024
+        found, ms = timed_search(faissindex.RerankIndex(index, vectors, 1, dims=dims), queries, k)
+        print(f'flat {dims:5d} dims: {index_mb:10.1f} MB  recall@{k}: {recall_at_k(found, truth):.4f}  ({ms:.2f} ms/query, no re-ranking)')
+        for n in candidates:
+            rerank_index = faissindex.RerankIndex(index, vectors, 0, dims=dims, min_candidates=n)
+            found, ms = timed_search(rerank_index, queries, k)
+            # re-ranking reads n full vectors per query from the page cache
+            read_mb = n * dimension * 4 / 1024 / 1024
+            print(f'  + re-rank {n:5d}: {read_mb:6.1f} MB read per query  recall@{k}: {recall_at_k(found, truth):.4f}  ({ms:.2f} ms/query)')
+
+
+def report(dataset_dir, dataset_name, k=10, num_queries=1000, rerank=None,
+           coarse_dims=(), candidates=(100, 300, 1000)):
+    filn_faiss = os.path.join(dataset_dir, f'{dataset_name}_{FILN_FAISS_INDEX}')
+    dirn_metastore = os.path.join(dataset_dir, f'{dataset_name}_{DIRN_METASTORE}')
+    filn_index_config = os.path.join(dataset_dir, f'{dataset_name}_{FILN_INDEX_CONFIG}')
+    filn_vectors = os.path.join(dataset_dir, f'{dataset_name}_{FILN_VECTORS}')
+
+    index_config = faissindex.load_index_config(filn_index_config)
+    index = faiss.read_index(filn_faiss)
+    faissindex.apply_search_params(index, index_config)
+    print(f"\n=== {dataset_name}: {index_config.get('factory', 'Flat')} ({index.ntotal} vectors) ===")
+    print(f'index   : {file_size_mb(filn_faiss):10.1f} MB')
+    print(f'metadata: {file_size_mb(dirn_metastore):10.1f} MB (on disk, memory-mapped)')
+    print(f'vectors : {file_size_mb(filn_vectors):10.1f} MB (on disk, only needed for re-ranking)')
+
+    if not os.path.exists(filn_vectors):
+        print(f'Cannot compute recall: {filn_vectors} not found')
+        return
+
+    vectors = faissindex.load_vectors(filn_vectors)
+    queries = make_queries(vectors, num_queries)
+    print(f'Computing exact top-{k} for {num_queries} queries...')
+    _, truth = exact_search(vectors, queries, k)
+
+    if index_config['coarse_dims']:
+        # the index holds truncated vectors, queries must be truncated, too
+        found, ms = timed_search(faissindex.RerankIndex(index, vectors, 1, dims=index_config['coarse_dims']),
+                                 queries, k)
+        print(f"recall@{k} of {index_config['coarse_dims']} dimensions: {recall_at_k(found, truth):.4f}  ({ms:.2f} ms/query)")
+        found, ms = timed_search(faissindex.coarse_rerank_index(index, vectors, index_config), queries, k)
+        print(f"recall@{k} with re-ranking of {index_config['coarse_candidates']} candidates: "
+              f"{recall_at_k(found, truth):.4f}  ({ms:.2f} ms/query)")
+    else:
+        found, ms = timed_search(index, queries, k)
+        print(f'recall@{k}: {recall_at_k(found, truth):.4f}  ({ms:.2f} ms/query)')
+
+    if coarse_dims:
+        coarse_report(vectors, queries, truth, k, coarse_dims, candidates)
+
+    if index_config['coarse_dims']:
+        return
+    if rerank is None:
+        rerank = index_config['rerank']
+    if rerank > 0:
+        rerank_index = faissindex.RerankIndex(index, vectors, rerank)
+        found, ms = timed_search(rerank_index, queries, k)
+        print(f'recall@{k} with re-ranking of {rerank} * k: {recall_at_k(found, truth):.4f}  ({ms:.2f} ms/query)')
+
+
+if __name__ == '__main__':
+    args, kwargs, flags = parse_args(sys.argv[1:])
+    if len(args) < 1:
+        print(f'Usage  : python {sys.argv[0]} dataset_name [dataset_name ...]')
+        print(f'Options: --dataset_dir=. --k=10 --num_queries=1000 --rerank=N')
+        print(f'         --coarse_dims=256,512 --candidates=100,300,1000 (benchmark two-stage search)')
+        print(f"Example: python {sys.argv[0]} zusatzmaterial --dataset_dir=datasets-release --rerank=4")
+        sys.exit(1)
+
+    dataset_dir = kwargs.get('dataset_dir', '.')
+    k = int(kwargs.get('k', 10))
+    num_queries = int(kwargs.get('num_queries', 1000))
+    rerank = kwargs.get('rerank', None)
+    if rerank is not None:
+        rerank = int(rerank)
+    coarse_dims = [int(dims) for dims in kwargs.get('coarse_dims', '').split(',') if dims]
+    candidates = [int(n) for n in kwargs.get('candidates', '100,300,1000').split(',')]
+
+    for dataset_name in args:
+        report(dataset_dir, dataset_name, k=k, num_queries=num_queries, rerank=rerank,
+               coarse_dims=coarse_dims, candidates=candidates)
@@ -0,0 +1,317 @@
+"""
+BM25 inverted index over the paragraphs of a dataset.
+
+Searching for a file number or a name does not need an embedding. The
+lexical index answers such queries locally, without the round trip to the
+OpenAI API. It is built with the dataset, next to the metadata store, and
+memory-mapped on load:
+
+    <dataset>_lexical/
+        info.json            format version, counts, BM25 parameters
+        terms.bin            vocabulary, utf-8, sorted, concatenated
+        terms_offsets.npy    int64[num_terms + 1] byte offsets into terms.bin
+        postings.npy         int64[num_terms + 1] start of each term's postings
+        rows.npy             int32[num_postings] rows containing the term, ascending
+        tfs.npy              uint16[num_postings] occurrences of the term in the row
+        row_lengths.npy      int32[n] number of terms of each row
+
+Terms are lower-cased words. All words of a query are scored with BM25, a
+row matches if it contains any of them. "Quoted phrases" must occur in a
+row as they are, ignoring case and punctuation. fuse_results() merges
+lexical and vector hits by reciprocal rank fusion.
+
+To build the index of an existing dataset and try some queries:
+
+    python src/lexicalindex.py sitzungsprotokolle --dataset_dir=datasets-release --query='"Drosten"'
+"""
+
+import sys
+import os
+import re
+import json
+import math
+import time
+import copy
+from array import array
+from bisect import bisect_left
+from collections import Counter
+import numpy as np
+from tqdm import tqdm
+
+import metastore
+from myargs import parse_args
+
+
+DIRN_LEXICAL = 'lexical'
+FILN_INFO = 'info.json'
+VERSION = 1
+
+K1 = 1.2
+B = 0.75
+# reciprocal rank fusion: score of rank r (from 0) is 1 / (RRF_K + r + 1)
+RRF_K = 60
+
+TOKEN_RE = re.compile(r'\w+')
+PHRASE_RE = re.compile(r'"([^"]*)"')
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower())
+
+
+def normalize(text):
+    return ' '.join(tokenize(text))
+
+
+def parse_query(query):
+    """
+    returns the normalized quoted phrases and all terms of the query
+    """
+    phrases = [phrase for phrase in map(normalize, PHRASE_RE.findall(query)) if phrase]
+    return phrases, tokenize(query)
+
+
+def is_phrase_query(query):
+    return any(normalize(phrase) for phrase in PHRASE_RE.findall(query))
+
+
+def save_lexical_index(metadata, dirpath):
+    print('Saving lexical index...')
+    os.makedirs(dirpath, exist_ok=True)
+
+    term_ids = {}
+    term_col = array('i')
+    row_col = array('i')
+    tf_col = array('H')
+    row_lengths = np.zeros(len(metadata), dtype='int32')
+    for row, meta in enumerate(tqdm(metadata)):
+        tokens = tokenize(meta.para)
+        row_lengths[row] = len(tokens)
+        for term, tf in Counter(tokens).items():
+            term_col.append(term_ids.setdefault(term, len(term_ids)))
+            row_col.append(row)
+            tf_col.append(min(tf, 65535))
+
+    # number terms alphabetically, so they can be found by bisection
+    terms = sorted(term_ids)
+    renumber = np.empty(len(terms), dtype='int32')
+    renumber[[term_ids[term] for term in terms]] = np.arange(len(terms), dtype='int32')
+    term_col = renumber[np.frombuffer(term_col, dtype='int32')] if terms else np.zeros(0, dtype='int32')
+    # rows were added in ascending order and stay so within each term
+    order = np.argsort(term_col, kind='stable')
+    postings = np.zeros(len(terms) + 1, dtype='int64')
+    np.cumsum(np.bincount(term_col, minlength=len(terms)), out=postings[1:])
+
+    metastore.write_strings(terms,
+                            os.path.join(dirpath, 'terms.bin'),
+                            os.path.join(dirpath, 'terms_offsets.npy'))
+    np.save(os.path.join(dirpath, 'postings.npy'), postings)
+    np.save(os.path.join(dirpath, 'rows.npy'), np.frombuffer(row_col, dtype='int32')[order])
+    np.save(os.path.join(dirpath, 'tfs.npy'), np.frombuffer(tf_col, dtype='uint16')[order])
+    np.save(os.path.join(dirpath, 'row_lengths.npy'), row_lengths)
+
+    # written last: an index without info.json is incomplete
+    with open(os.path.join(dirpath, FILN_INFO), 'wt') as f:
+        json.dump({
+            'version': VERSION,
+            'num_rows': len(metadata),
+            'num_terms': len(terms),
+            'num_postings': len(order),
+            'avg_length': float(row_lengths.mean()) if len(row_lengths) else 0.0,
+            'k1': K1,
+            'b': B,
+            }, f, indent=4)
+
+
+class LexicalIndex:
+    """
+    Read-only BM25 index of a dataset. metadata is the dataset's metadata,
+    needed to check phrases and to remove duplicates.
+    """
+    def __init__(self, dirpath, metadata):
+        with open(os.path.join(dirpath, FILN_INFO), 'rt') as f:
+            self.info = json.load(f)
+        if self.info['num_rows'] != len(metadata):
+            raise RuntimeError(f'{dirpath} does not match the metadata of its dataset')
+        self.metadata = metadata
+        self.terms = metastore.MappedStrings(os.path.join(dirpath, 'terms.bin'),
+                                             os.path.join(dirpath, 'terms_offsets.npy'))
+        self.postings = np.load(os.path.join(dirpath, 'postings.npy'), mmap_mode='r')
+        self.rows = np.load(os.path.join(dirpath, 'rows.npy'), mmap_mode='r')
+        self.tfs = np.load(os.path.join(dirpath, 'tfs.npy'), mmap_mode='r')
+        self.row_lengths = np.load(os.path.join(dirpath, 'row_lengths.npy'), mmap_mode='r')
+        self.ranges = None
+
+    def restrict(self, ranges):
+        """
+        the same index, searching only the rows in ranges, see vectorstore.py
+        """
+        index = copy.copy(self)
+        index.ranges = np.array(ranges, dtype='int64').reshape(-1, 2)
+        return index
+
+    def lookup(self, term):
+        """
+        start and end of the postings of term, (0, 0) if it is unknown
+        """
+        t = bisect_left(self.terms, term)
+        if t == len(self.terms) or self.terms[t] != term:
+            return 0, 0
+        return int(self.postings[t]), int(self.postings[t + 1])
+
+    def term_rows(self, term):
+        """
+        rows containing term and the term's frequency in them
+        """
+        start, end = self.lookup(term)
+        rows, tfs = self.rows[start:end], self.tfs[start:end]
+        if self.ranges is not None and not len(self.ranges):
+            rows, tfs = rows[:0], tfs[:0]
+        elif self.ranges is not None:
+            # ranges are sorted and disjoint
+            pos = np.searchsorted(self.ranges[:, 0], rows, side='right') - 1
+            inside = (pos >= 0) & (rows < self.ranges[np.maximum(pos, 0), 1])
+            rows, tfs = rows[inside], tfs[inside]
+        return rows, tfs
+
+    def score(self, terms, required=()):
+        """
+        BM25 scores of the rows containing any of terms and all of required,
+        as (rows ascending, scores)
+        """
+        n = self.info['num_rows']
+        k1 = self.info['k1']
+        b = self.info['b']
+        avg_length = self.info['avg_length'] or 1.0
+        all_rows = []
+        all_scores = []
+        for term in dict.fromkeys(terms):
+            rows, tfs = self.term_rows(term)
+            if not len(rows):
+                continue
+            start, end = self.lookup(term)
+            df = end - start
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            tfs = tfs.astype('float32')
+            lengths = self.row_lengths[rows]
+            all_rows.append(rows)
+            all_scores.append(idf * tfs * (k1 + 1) / (tfs + k1 * (1 - b + b * lengths / avg_length)))
+        if not all_rows:
+            return np.zeros(0, dtype='int64'), np.zeros(0, dtype='float32')
+        rows, inverse = np.unique(np.concatenate(all_rows), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(all_scores)).astype('float32')
+        for term in set(required):
+            keep = np.isin(rows, self.term_rows(term)[0], assume_unique=True)
+            rows, scores = rows[keep], scores[keep]
+        return rows.astype('int64'), scores
+
+    def search(self, query, k, remove_dupes=False):
+        """
+        the k best rows for query, as (scores, rows), padded with -inf and -1
+        like faiss results
+        """
+        phrases, terms = parse_query(query)
+        required = {term for phrase in phrases for term in phrase.split()}
+        rows, scores = self.score(terms, required)
+        order = np.argsort(-scores, kind='stable')
+        rows, scores = rows[order], scores[order]
+
+        found_scores = np.full(k, -np.inf, dtype='float32')
+        found_rows = np.full(k, -1, dtype='int64')
+        seen = set()
+        n = 0
+        start = 0
+        # candidates are checked in chunks, most rows are never looked at
+        while n < k and start < len(rows):
+            chunk = slice(start, start + max(4 * k, 100))
+            keys = metastore.duplicate_keys(self.metadata, rows[chunk]) if remove_dupes else rows[chunk]
+            for row, score, key in zip(rows[chunk], scores[chunk], keys):
+                if remove_dupes and key in seen:
+                    continue
+                if phrases:
+                    text = f' {normalize(self.metadata[row].para)} '
+                    if not all(f' {phrase} ' in text for phrase in phrases):
+                        continue
+                seen.add(key)
+                found_scores[n] = score
+                found_rows[n] = row
+                n += 1
+                if n == k:
+                    break
+            start += max(4 * k, 100)
+        return found_scores, found_rows
+
+
+def fuse_results(result_rows, k, metadata=None):
+    """
+    reciprocal rank fusion of ranked lists of rows (padded with -1). with
+    metadata, duplicate paragraphs are removed. returns (scores, rows) like
+    LexicalIndex.search()
+    """
+    fused = {}
+    for rows in result_rows:
+        for rank, row in enumerate(rows):
+            if row < 0:
+                break
+            fused[int(row)] = fused.get(int(row), 0.0) + 1 / (RRF_K + rank + 1)
+    # sorted() is stable: ties keep the order of the first list
+    ranked = sorted(fused.items(), key=lambda item: -item[1])
+    if metadata is not None and ranked:
+        keys = metastore.duplicate_keys(metadata, [row for row, _ in ranked])
+        seen = set()
+        unique = []
+        for item, key in zip(ranked, keys):
+            if key not in seen:
+                seen.add(key)
+                unique.append(item)
+        ranked = unique
+    scores = np.full(k, -np.inf, dtype='float32')
+    rows = np.full(k, -1, dtype='int64')
+    for i, (row, score) in enumerate(ranked[:k]):
+        scores[i] = score
+        rows[i] = row
+    return scores, rows
+
+
+def load_lexical_index(dataset_dir, dataset_name, metadata):
+    """
+    None if the dataset has no lexical index
+    """
+    dirpath = os.path.join(dataset_dir, f'{dataset_name}_{DIRN_LEXICAL}')
+    if not os.path.exists(os.path.join(dirpath, FILN_INFO)):
+        print(f'No lexical index {dirpath}. See lexicalindex.py')
+        return None
+    print('Mapping lexical index...')
+    return LexicalIndex(dirpath, metadata)
+
+
+if __name__ == '__main__':
+    args, kwargs, flags = parse_args(sys.argv[1:])
+    if len(args) != 1:
+        print(f'Usage  : python {sys.argv[0]} dataset_name')
+        print(f'Builds the lexical index of an existing dataset from its metadata store')
+        print(f'Options: --dataset_dir=. --query="\\"some phrase\\" other words" --k=10 --rebuild')
+        sys.exit(1)
+
+    dataset_name = args[0]
+    dataset_dir = kwargs.get('dataset_dir', '.')
+    dirn_metastore = os.path.join(dataset_dir, f'{dataset_name}_{metastore.DIRN_METASTORE}')
+    dirn_lexical = os.path.join(dataset_dir, f'{dataset_name}_{DIRN_LEXICAL}')
+    metadata = metastore.load_metastore(dirn_metastore)
+    if 'rebuild' in flags or not os.path.exists(os.path.join(dirn_lexical, FILN_INFO)):
+        start = time.time()
+        save_lexical_index(metadata, dirn_lexical)
+        print(f'Built in {time.time() - start:.1f}s')
+    index = load_lexical_index(dataset_dir, dataset_name, metadata)
+    print(f"{index.info['num_terms']} terms, {index.info['num_postings']} postings")
+
+    if 'query' in kwargs:
+        k = int(kwargs.get('k', 10))
+        start = time.time()
+        scores, rows = index.search(kwargs['query'], k, remove_dupes=True)
+        print(f'Search took {(time.time() - start) * 1000:.1f} ms')
+        for score, row in zip(scores, rows):
+            if row < 0:
+                break
+            meta = metadata[row]
+            print(f'{score:7.3f} {os.path.basename(meta.doc_path)}: {meta.para[:150]}')
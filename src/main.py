@@ -4,21 +4,34 @@ import time
 import faiss
 import numpy as np
 import pickle
+import embedding
 from embedding import EmbeddingCache
 from tqdm import tqdm
 import textwrap
 import shutil
 from myargs import parse_args
+import faissindex
+import metastore
 
 
 FILN_FAISS_INDEX = 'faiss.index'
 FILN_METADATA = 'metadata.pkl'
+FILN_INDEX_CONFIG = faissindex.FILN_INDEX_CONFIG
+FILN_VECTORS = faissindex.FILN_VECTORS
+DIRN_METASTORE = metastore.DIRN_METASTORE
 
 
 def get_query_embeddings(text, embedding_cache, keep_stats=False):
     embedding = embedding_cache.get(text, auto_save=False, keep_stats=keep_stats)   # TODO: auto_saving takes too long if big
     return np.array([embedding])
 
+def get_query_embeddings_batch(texts, embedding_cache):
+    """
+    embeddings of many queries; all uncached ones are fetched in one request
+    """
+    embeddings = embedding_cache.get_batch(texts, auto_save=False)
+    return np.array(embeddings)
+
 # by normalizing, we effectively perform a cosine search. see faiss github
 def normalize_embeddings(embeddings):
     print('Normalizing embeddings...')
@@ -30,9 +43,57 @@ def search_faiss_index(index, query_embedding, k=5):
     distances, indices = index.search(query_embedding, k)
     return distances, indices
 
-def load_faiss_index(filepath):
-    print('Loading FAISS index...')
-    return faiss.read_index(filepath)
+def search_faiss_index_unique(index, query_embeddings, metadata, k=5, max_fetch_factor=32):
+    """
+    like search_faiss_index(), but without duplicate paragraphs: if duplicates
+    leave fewer than k results, more are fetched (up to max_fetch_factor * k)
+    until there are k unique ones. Missing results have index -1.
+    """
+    num_queries = len(query_embeddings)
+    distances = np.full((num_queries, k), -np.inf, dtype='float32')
+    indices = np.full((num_queries, k), -1, dtype='int64')
+    todo = np.arange(num_queries)
+    k_fetch = k
+    while len(todo):
+        k_fetch = min(k_fetch, index.ntotal)
+        if k_fetch == 0:
+            break
+        found_distances, found_indices = search_faiss_index(
+                index, np.ascontiguousarray(query_embeddings[todo]), k=k_fetch)
+        keys = metastore.duplicate_keys(metadata, found_indices)
+        more = []
+        for row, query in enumerate(todo):
+            seen = set()
+            n = 0
+            for dist, idx, key in zip(found_distances[row], found_indices[row], keys[row]):
+                if idx < 0:
+                    break
+                if key in seen:
+                    continue
+                seen.add(key)
+                distances[query, n] = dist
+                indices[query, n] = idx
+                n += 1
+                if n == k:
+                    break
+            exhausted = found_indices[row][-1] < 0 or k_fetch >= index.ntotal
+            if n < k and not exhausted and k_fetch < k * max_fetch_factor:
+                more.append(query)
+        todo = np.array(more, dtype='int64')
+        k_fetch *= 2
+    return distances, indices
+
+def load_faiss_index(filepath, index_config=None, mmap=False):
+    if mmap:
+        print('Mapping FAISS index...')
+        index = faiss.read_index(filepath, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    else:
+        print('Loading FAISS index...')
+        index = faiss.read_index(filepath)
+    if index_config is not None:
+        print(f"Index type {index_config['index_type']}, search params {index_config.get('search_params', {})}")
+        faissindex.apply_search_params(index, index_config)
+    return index
 
 def load_metadata(filepath):
     print('Loading metadata...')
@@ -59,49 +120,22 @@ def show_result(result_number, metas, result_index, distance,
 
     output_tuples = []
     if auto_contexts:
-        total_text = text
         if auto_contexts == True:
             desired_length = output_width
         else:
             desired_length = auto_contexts
-        ctx_iter = 0
-        prev_exhausted = False
-        next_exhausted = False
-        prev_ctx = []
-        next_ctx = []
-        while len(total_text) < desired_length:
-            if prev_exhausted and next_exhausted:
-                break
-            ctx_iter += 1
-            # add context before
-            if result_index - ctx_iter >= 0:
-                prev = metas[result_index - ctx_iter]
-                # if same doc, extract text
-                if prev.doc_path == meta.doc_path:
-                    prev = prev.para
-                    # only use if text differs from main text
-                    if prev != text:
-                        prev_ctx.append(prev)
-                        total_text += prev
-                else:
-                    prev_exhausted = True
-            # add context after
-            if result_index + ctx_iter < len(metas):
-                next = metas[result_index + ctx_iter]
-                # if same doc, extract text
-                if next.doc_path == meta.doc_path:
-                    next = next.para
-                    # only use if text differs from main text
-                    if next != text:
-                        next_ctx.append(next)
-                        total_text += next
-                else:
-                    next_exhausted = True
-        for prev in reversed(prev_ctx):
-            output_tuples.append((context_on, prev, context_off))
+        firsts, lasts = metastore.context_windows(metas, [result_index], desired_length)
+        for index in range(firsts[0], result_index):
+            prev = metas[index].para
+            # only use if text differs from main text
+            if prev != text:
+                output_tuples.append((context_on, prev, context_off))
         output_tuples.append((highlight_on, text, highlight_off))
-        for next in next_ctx:
-            output_tuples.append((context_on, next, context_off))
+        for index in range(result_index + 1, lasts[0] + 1):
+            next = metas[index].para
+            # only use if text differs from main text
+            if next != text:
+                output_tuples.append((context_on, next, context_off))
     else:
         for x in range(num_contexts_before):
             delta_idx = num_contexts_before - x
@@ -142,8 +176,9 @@ def process_query(query_text, embedding_cache, faiss_index, metadata, k_results=
     query_embedding = get_query_embeddings(query_text, embedding_cache)
     query_embedding = normalize_embeddings(query_embedding)
     search_start_time = time.time()
-    faiss_distances, faiss_indices = search_faiss_index(
-            faiss_index, query_embedding, k=k_results)
+    # compact results: supress identical ones, regardless of doc
+    faiss_distances, faiss_indices = search_faiss_index_unique(
+            faiss_index, query_embedding, metadata, k=k_results)
     search_end_time = time.time()
     print(f"Search took {search_end_time-search_start_time:0.3f} seconds.")
 
@@ -151,7 +186,7 @@ def process_query(query_text, embedding_cache, faiss_index, metadata, k_results=
     result_distances = faiss_distances[0]
 
     max_filn_len = 0
-    for idx in result_indices:
+    for idx in result_indices[result_indices >= 0]:
         filn_len = len(os.path.basename(metadata[idx].doc_path))
         if filn_len > max_filn_len:
             max_filn_len = filn_len
@@ -160,13 +195,9 @@ def process_query(query_text, embedding_cache, faiss_index, metadata, k_results=
     terminal_size = shutil.get_terminal_size()
     num_cols = terminal_size.columns
 
-    # compact results: supress existing identical ones, regardless of doc
-    result_texts = []
     for r_no, (idx, dist) in enumerate(zip(result_indices, result_distances)):
-        text = metadata[idx].para
-        if text in result_texts:
-            continue
-        result_texts.append(text)
+        if idx < 0:
+            break
         print()
         show_result(r_no, metadata, idx, dist,
                     max_filn_len=max_filn_len,
@@ -180,23 +211,83 @@ def process_query(query_text, embedding_cache, faiss_index, metadata, k_results=
                     output_width=num_cols - 1,
                     )
 
-def get_resources(dataset_dir, dataset_name, query_cache_name=None, max_cache_size=None):
+def load_mmapped_faiss_index(filn_faiss, filn_vectors, index_config):
+    if (index_config['index_type'] == 'flat' and index_config['storage'] == 'fp32'
+            and not index_config['coarse_dims'] and os.path.exists(filn_vectors)):
+        print('Mapping vectors for flat search...')
+        return faissindex.MmapFlatIndex(faissindex.load_vectors(filn_vectors))
+    if index_config['index_type'] == 'flat':
+        if not index_config['coarse_dims']:
+            print(f'{filn_vectors} not found, loading flat index into memory')
+        return load_faiss_index(filn_faiss, index_config)
+    if not faissindex.can_mmap(index_config):
+        print(f"Index type {index_config['index_type']} cannot be memory-mapped, loading it")
+        return load_faiss_index(filn_faiss, index_config)
+    return load_faiss_index(filn_faiss, index_config, mmap=True)
+
+def load_embedding_config(dataset_dir, dataset_name):
+    """
+    backend, model and dims the dataset was built with
+    """
+    filn_index_config = os.path.join(dataset_dir, f'{dataset_name}_{FILN_INDEX_CONFIG}')
+    return {**embedding.DEFAULT_EMBEDDING_CONFIG,
+            **faissindex.load_index_config(filn_index_config).get('embedding', {})}
+
+def get_resources(dataset_dir, dataset_name, query_cache_name=None, max_cache_size=None,
+                  mmap=False):
+    """
+    Metadata is always memory-mapped from the metadata store if there is one.
+    With mmap=True, index and vectors are memory-mapped where possible, too,
+    so that several worker processes share them.
+    """
     filn_metadata = os.path.join(dataset_dir, f'{dataset_name}_{FILN_METADATA}')
     filn_faiss = os.path.join(dataset_dir, f'{dataset_name}_{FILN_FAISS_INDEX}')
+    filn_index_config = os.path.join(dataset_dir, f'{dataset_name}_{FILN_INDEX_CONFIG}')
+    filn_vectors = os.path.join(dataset_dir, f'{dataset_name}_{FILN_VECTORS}')
+    dirn_metastore = os.path.join(dataset_dir, f'{dataset_name}_{DIRN_METASTORE}')
 
     # Load metadata, faiss index
-    if os.path.exists(filn_metadata):
-        metadata = load_metadata(filn_metadata)
+    if os.path.exists(filn_metadata) or os.path.exists(dirn_metastore):
+        if os.path.exists(dirn_metastore):
+            metadata = metastore.load_metastore(dirn_metastore)
+        else:
+            print(f'No metadata store {dirn_metastore}, loading {filn_metadata}. See mmapconvert.py')
+            metadata = load_metadata(filn_metadata)
         # we assume that embeddings cache is full if we have metadata
-        faiss_index = load_faiss_index(filn_faiss)
+        index_config = faissindex.load_index_config(filn_index_config)
+        if mmap:
+            faiss_index = load_mmapped_faiss_index(filn_faiss, filn_vectors, index_config)
+        else:
+            faiss_index = load_faiss_index(filn_faiss, index_config)
+        if index_config['coarse_dims']:
+            if not os.path.exists(filn_vectors):
+                print(f"Index of {index_config['coarse_dims']} dimensions needs {filn_vectors} for re-ranking")
+                sys.exit(1)
+            print(f"Re-ranking {index_config['coarse_candidates']} candidates of "
+                  f"{index_config['coarse_dims']} dimensions exactly")
+            faiss_index = faissindex.coarse_rerank_index(faiss_index,
+                                                         faissindex.load_vectors(filn_vectors),
+                                                         index_config)
+        elif index_config['rerank'] > 0 and not isinstance(faiss_index, faissindex.MmapFlatIndex):
+            if os.path.exists(filn_vectors):
+                print(f"Re-ranking {index_config['rerank']} * k candidates exactly")
+                faiss_index = faissindex.RerankIndex(faiss_index,
+                                                     faissindex.load_vectors(filn_vectors),
+                                                     index_config['rerank'])
+            else:
+                print(f'Cannot re-rank: {filn_vectors} not found')
     else:
         print(f'Dataset {dataset_name} not found in {dataset_dir}')
         sys.exit(1)
     if query_cache_name is None:
         query_embedding_cache = None
     else:
+        embedding_config = load_embedding_config(dataset_dir, dataset_name)
         query_embedding_cache = EmbeddingCache(query_cache_name, dataset_dir=dataset_dir,
-                                               max_cache_size=max_cache_size)
+                                               max_cache_size=max_cache_size,
+                                               backend=embedding_config['backend'],
+                                               model=embedding_config['model'],
+                                               dims=embedding_config['dims'])
         print(f'Query Embedding cache holds {len(query_embedding_cache.values)} unique texts (max_cache_size={query_embedding_cache.max_cache_size})')
     return metadata, faiss_index, query_embedding_cache
 
@@ -212,7 +303,8 @@ if __name__ == '__main__':
     k_results = int(args[1])
     dataset_dir = kwargs.get('dataset_dir', '.')
 
-    metadata, faiss_index, query_embedding_cache = get_resources(dataset_dir, dataset_name, 'query')
+    metadata, faiss_index, query_embedding_cache = get_resources(dataset_dir, dataset_name, 'query',
+                                                                 mmap='mmap' in flags)
 
     while True:
         query = input("Enter your query (or type 'exit' to quit): ")
@@ -0,0 +1,73 @@
+"""
+Per-file manifest of a dataset build, for incremental rebuilds.
+
+`<dataset>_manifest.json` records size, mtime and content hash of every text
+file a dataset was built from, the next free paragraph seq and a version
+number that is increased by every build:
+
+    {
+        "version": 3,
+        "next_seq": 421337,
+        "files": {"data/x/doc.txt": {"size": 1234, "mtime": 1700000000.0, "hash": "..."}}
+    }
+
+A file whose size and mtime are unchanged is not read again; otherwise its
+hash decides whether it changed.
+"""
+
+import os
+import json
+import hashlib
+
+
+FILN_MANIFEST = 'manifest.json'
+
+
+def file_hash(filepath):
+    h = hashlib.blake2b(digest_size=16)
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def file_entry(filepath, stat=None):
+    if stat is None:
+        stat = os.stat(filepath)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': file_hash(filepath)}
+
+
+def compare_files(manifest, all_files):
+    """
+    returns (files, changed, deleted): new manifest entries of all_files,
+    paths of new or changed files and paths of deleted files
+    """
+    old_files = manifest.get('files', {})
+    files = {}
+    changed = []
+    for filepath in all_files:
+        stat = os.stat(filepath)
+        old = old_files.get(filepath)
+        if old is not None and old['size'] == stat.st_size and old['mtime'] == stat.st_mtime:
+            files[filepath] = old
+            continue
+        files[filepath] = file_entry(filepath, stat)
+        if old is None or old['hash'] != files[filepath]['hash']:
+            changed.append(filepath)
+    deleted = [filepath for filepath in old_files if filepath not in files]
+    return files, changed, deleted
+
+
+def load_manifest(filepath):
+    if not os.path.exists(filepath):
+        return None
+    with open(filepath, 'rt') as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, filepath):
+    print('Saving manifest...')
+    filepath_tmp = f'{filepath}.tmp'
+    with open(filepath_tmp, 'wt') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(filepath_tmp, filepath)
@@ -0,0 +1,355 @@
+"""
+Columnar, memory-mappable metadata store.
+
+Instead of one pickled list of Meta namedtuples, the metadata of a dataset is
+stored as a directory of flat column files that are memory-mapped on load:
+
+    <dataset>_metastore/
+        info.json                format version, counts, kind names
+        para.bin                 all paragraphs, utf-8, concatenated
+        para_offsets.npy         int64[n + 1] byte offsets into para.bin
+        seq.npy                  int64[n]
+        doc_id.npy               int32[n] index into the document table
+        token_length.npy         int32[n]
+        kind_id.npy              uint8[n] index into info.json's kinds
+        para_char_offsets.npy    int64[n + 1] cumulative character lengths of paragraphs
+        doc_path.bin             document table: paths, utf-8, concatenated
+        doc_path_offsets.npy     int64[num_docs + 1] byte offsets into doc_path.bin
+        doc_start.npy            int64[num_docs] first row of each document
+        doc_end.npy              int64[num_docs] last row + 1 of each document
+        canonical.npy            int64[n] first row with the same paragraph text
+
+Loading takes no time, no Python objects are created per paragraph, and all
+processes mapping the same files share one copy in the page cache. Rows are
+accessed via MetaRow objects that read their fields on access and offer the
+same attributes as Meta.
+
+Rows of a document are contiguous. With the document boundaries and the
+cumulative paragraph lengths, the context window around a search result is
+found by bisection instead of walking and comparing neighbouring rows, see
+context_windows().
+
+Paragraphs are repeated a lot: chunks of overlapping documents, attachments
+of several mails. Exact duplicates are clustered when the store is saved, by
+a hash of their text; all rows of a cluster share the same canonical row, so
+duplicates are removed in O(k) without comparing texts, see duplicate_keys().
+"""
+
+import os
+import json
+import mmap
+import hashlib
+import numpy as np
+
+
+DIRN_METASTORE = 'metastore'
+FILN_INFO = 'info.json'
+VERSION = 4
+
+
+def write_strings(strings, filepath_bin, filepath_offsets):
+    offsets = np.zeros(len(strings) + 1, dtype='int64')
+    with open(filepath_bin, 'wb') as f:
+        pos = 0
+        for i, s in enumerate(strings):
+            b = s.encode('utf-8')
+            f.write(b)
+            pos += len(b)
+            offsets[i + 1] = pos
+    np.save(filepath_offsets, offsets)
+
+
+def save_metastore(metadata, dirpath):
+    print('Saving metadata store...')
+    os.makedirs(dirpath, exist_ok=True)
+
+    doc_paths = []
+    doc_ids = {}
+    kinds = []
+    kind_ids = {}
+    doc_id = np.zeros(len(metadata), dtype='int32')
+    kind_id = np.zeros(len(metadata), dtype='uint8')
+    for i, meta in enumerate(metadata):
+        if meta.doc_path not in doc_ids:
+            doc_ids[meta.doc_path] = len(doc_paths)
+            doc_paths.append(meta.doc_path)
+        if meta.kind not in kind_ids:
+            kind_ids[meta.kind] = len(kinds)
+            kinds.append(meta.kind)
+        doc_id[i] = doc_ids[meta.doc_path]
+        kind_id[i] = kind_ids[meta.kind]
+
+    write_strings([meta.para for meta in metadata],
+                  os.path.join(dirpath, 'para.bin'),
+                  os.path.join(dirpath, 'para_offsets.npy'))
+    write_strings(doc_paths,
+                  os.path.join(dirpath, 'doc_path.bin'),
+                  os.path.join(dirpath, 'doc_path_offsets.npy'))
+    np.save(os.path.join(dirpath, 'seq.npy'),
+            np.array([meta.seq for meta in metadata], dtype='int64'))
+    np.save(os.path.join(dirpath, 'token_length.npy'),
+            np.array([meta.token_length for meta in metadata], dtype='int32'))
+    np.save(os.path.join(dirpath, 'doc_id.npy'), doc_id)
+    doc_start, doc_end = get_doc_boundaries(doc_id, len(doc_paths))
+    np.save(os.path.join(dirpath, 'doc_start.npy'), doc_start)
+    np.save(os.path.join(dirpath, 'doc_end.npy'), doc_end)
+    para_char_offsets = np.zeros(len(metadata) + 1, dtype='int64')
+    np.cumsum([len(meta.para) for meta in metadata], out=para_char_offsets[1:])
+    np.save(os.path.join(dirpath, 'para_char_offsets.npy'), para_char_offsets)
+    np.save(os.path.join(dirpath, 'kind_id.npy'), kind_id)
+    canonical = get_canonical_rows(meta.para for meta in metadata)
+    np.save(os.path.join(dirpath, 'canonical.npy'), canonical)
+
+    # written last: a store without info.json is incomplete
+    with open(os.path.join(dirpath, FILN_INFO), 'wt') as f:
+        json.dump({
+            'version': VERSION,
+            'num_rows': len(metadata),
+            'num_docs': len(doc_paths),
+            'num_unique': int(np.count_nonzero(canonical == np.arange(len(canonical)))),
+            'kinds': kinds,
+            }, f, indent=4)
+
+
+def get_doc_boundaries(doc_id, num_docs):
+    """
+    doc ids are assigned in order of appearance, so they never decrease
+    """
+    if np.any(np.diff(doc_id) < 0):
+        raise ValueError('Rows of a document must be contiguous')
+    docs = np.arange(num_docs)
+    doc_start = np.searchsorted(doc_id, docs, side='left').astype('int64')
+    doc_end = np.searchsorted(doc_id, docs, side='right').astype('int64')
+    return doc_start, doc_end
+
+
+def get_canonical_rows(paras):
+    """
+    for each paragraph, the first row with the same text
+    """
+    first_rows = {}
+    canonical = []
+    for i, para in enumerate(paras):
+        key = hashlib.blake2b(para.encode('utf-8'), digest_size=16).digest()
+        canonical.append(first_rows.setdefault(key, i))
+    return np.array(canonical, dtype='int64')
+
+
+def map_file(filepath):
+    with open(filepath, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class MappedStrings:
+    def __init__(self, filepath_bin, filepath_offsets):
+        self.data = map_file(filepath_bin)
+        self.offsets = np.load(filepath_offsets, mmap_mode='r')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return self.data[start:end].decode('utf-8')
+
+
+class DocPathColumn:
+    """
+    doc_path per row, as a sequence (e.g. for bisect)
+    """
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, index):
+        return self.store.doc_paths[self.store.doc_ids[index]]
+
+
+class MetaRow:
+    """
+    Lazy stand-in for a Meta namedtuple: fields are read from the columns of
+    the store on access.
+    """
+    __slots__ = ('store', 'index')
+
+    _fields = ('seq', 'doc_path', 'para', 'token_length', 'kind')
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    @property
+    def seq(self):
+        return int(self.store.seqs[self.index])
+
+    @property
+    def doc_id(self):
+        return int(self.store.doc_ids[self.index])
+
+    @property
+    def doc_path(self):
+        return self.store.doc_paths[self.store.doc_ids[self.index]]
+
+    @property
+    def para(self):
+        return self.store.paras[self.index]
+
+    @property
+    def token_length(self):
+        return int(self.store.token_lengths[self.index])
+
+    @property
+    def kind(self):
+        return self.store.kinds[self.store.kind_ids[self.index]]
+
+    def _asdict(self):
+        return {field: getattr(self, field) for field in self._fields}
+
+    def __repr__(self):
+        return f'MetaRow({self._asdict()})'
+
+
+class MetaStore:
+    """
+    Read-only, list-like access to the metadata of a dataset.
+    """
+    def __init__(self, dirpath):
+        filn_info = os.path.join(dirpath, FILN_INFO)
+        if not os.path.exists(filn_info):
+            raise RuntimeError(f'{dirpath} is incomplete or in an old format. Re-create it with mmapconvert.py')
+        with open(filn_info, 'rt') as f:
+            self.info = json.load(f)
+        self.kinds = self.info['kinds']
+        self.paras = MappedStrings(os.path.join(dirpath, 'para.bin'),
+                                   os.path.join(dirpath, 'para_offsets.npy'))
+        self.doc_paths = MappedStrings(os.path.join(dirpath, 'doc_path.bin'),
+                                       os.path.join(dirpath, 'doc_path_offsets.npy'))
+        self.seqs = np.load(os.path.join(dirpath, 'seq.npy'), mmap_mode='r')
+        self.doc_ids = np.load(os.path.join(dirpath, 'doc_id.npy'), mmap_mode='r')
+        self.token_lengths = np.load(os.path.join(dirpath, 'token_length.npy'),
+                                     mmap_mode='r')
+        self.kind_ids = np.load(os.path.join(dirpath, 'kind_id.npy'), mmap_mode='r')
+        if self.info['version'] >= 3:
+            self.doc_start = np.load(os.path.join(dirpath, 'doc_start.npy'), mmap_mode='r')
+            self.doc_end = np.load(os.path.join(dirpath, 'doc_end.npy'), mmap_mode='r')
+            self.para_char_offsets = np.load(os.path.join(dirpath, 'para_char_offsets.npy'),
+                                             mmap_mode='r')
+        else:
+            print('Old metadata store, computing document boundaries...')
+            self.doc_start, self.doc_end = get_doc_boundaries(np.asarray(self.doc_ids),
+                                                              len(self.doc_paths))
+            lengths = [len(self.paras[i]) for i in range(len(self.seqs))]
+            self.para_char_offsets = np.zeros(len(lengths) + 1, dtype='int64')
+            np.cumsum(lengths, out=self.para_char_offsets[1:])
+        if self.info['version'] >= 4:
+            self.canonical = np.load(os.path.join(dirpath, 'canonical.npy'), mmap_mode='r')
+        else:
+            print('Old metadata store, clustering duplicate paragraphs...')
+            self.canonical = get_canonical_rows(self.paras[i] for i in range(len(self.seqs)))
+
+    def __len__(self):
+        return len(self.seqs)
+
+    def __getitem__(self, index):
+        index = int(index)
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('metadata index out of range')
+        return MetaRow(self, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield MetaRow(self, index)
+
+    def doc_path_column(self):
+        return DocPathColumn(self)
+
+    def context_windows(self, indices, context_size, max_steps=None):
+        """
+        For each row in indices, find the window of rows [first, last] around
+        it within its document: the window grows by one row on each side
+        per step until it holds context_size characters, the document is
+        exhausted or max_steps is reached.
+
+        All windows are found at once by bisecting the number of steps.
+        """
+        indices = np.asarray(indices, dtype='int64')
+        docs = self.doc_ids[indices]
+        doc_first = self.doc_start[docs]
+        doc_last = self.doc_end[docs] - 1
+        steps_hi = np.maximum(indices - doc_first, doc_last - indices)
+        if max_steps is not None:
+            steps_hi = np.minimum(steps_hi, max_steps)
+        steps_lo = np.zeros_like(steps_hi)
+
+        def window(steps):
+            first = np.maximum(indices - steps, doc_first)
+            last = np.minimum(indices + steps, doc_last)
+            return first, last
+
+        while np.any(steps_lo < steps_hi):
+            searching = steps_lo < steps_hi
+            mid = (steps_lo + steps_hi) // 2
+            first, last = window(mid)
+            large_enough = (self.para_char_offsets[last + 1] - self.para_char_offsets[first]) >= context_size
+            steps_hi = np.where(searching & large_enough, mid, steps_hi)
+            steps_lo = np.where(searching & ~large_enough, mid + 1, steps_lo)
+        return window(steps_lo)
+
+
+def context_windows(metadata, indices, context_size, max_steps=None):
+    """
+    see MetaStore.context_windows(). Metadata lists loaded from pickles are
+    walked row by row.
+    """
+    if isinstance(metadata, MetaStore):
+        return metadata.context_windows(indices, context_size, max_steps)
+    firsts = []
+    lasts = []
+    for index in indices:
+        doc_path = metadata[index].doc_path
+        first = last = index
+        total = len(metadata[index].para)
+        steps = 0
+        while total < context_size and (max_steps is None or steps < max_steps):
+            grown = False
+            if first > 0 and metadata[first - 1].doc_path == doc_path:
+                first -= 1
+                total += len(metadata[first].para)
+                grown = True
+            if last + 1 < len(metadata) and metadata[last + 1].doc_path == doc_path:
+                last += 1
+                total += len(metadata[last].para)
+                grown = True
+            if not grown:
+                break
+            steps += 1
+        firsts.append(first)
+        lasts.append(last)
+    return np.array(firsts, dtype='int64'), np.array(lasts, dtype='int64')
+
+
+def duplicate_keys(metadata, indices):
+    """
+    keys of the rows in indices (any shape) that are equal exactly for rows
+    with the same paragraph text; -1 for indices < 0. Metadata lists loaded
+    from pickles use the texts as keys.
+    """
+    indices = np.asarray(indices, dtype='int64')
+    valid = indices >= 0
+    if isinstance(metadata, MetaStore):
+        return np.where(valid, metadata.canonical[np.where(valid, indices, 0)], -1)
+    keys = np.full(indices.shape, -1, dtype=object)
+    for pos in zip(*np.nonzero(valid)):
+        keys[pos] = metadata[indices[pos]].para
+    return keys
+
+
+def load_metastore(dirpath):
+    print('Mapping metadata store...')
+    return MetaStore(dirpath)
@@ -0,0 +1,78 @@
+"""
+Convert datasets created before the metadata store to memory-mapped loading.
+
+Writes the metadata store and the lexical index from
+`<dataset>_metadata.pkl` and, for flat indexes, extracts the vectors into
+`<dataset>_vectors.npy`. After that, the pickle file is no longer needed.
+"""
+
+import sys
+import os
+import pickle
+import faiss
+import numpy as np
+from tqdm import tqdm
+
+import faissindex
+import metastore
+import lexicalindex
+from myargs import parse_args
+
+
+FILN_FAISS_INDEX = 'faiss.index'
+FILN_METADATA = 'metadata.pkl'
+FILN_INDEX_CONFIG = faissindex.FILN_INDEX_CONFIG
+FILN_VECTORS = faissindex.FILN_VECTORS
+DIRN_METASTORE = metastore.DIRN_METASTORE
+DIRN_LEXICAL = lexicalindex.DIRN_LEXICAL
+
+
+def load_metadata(filepath):
+    print('Loading metadata...')
+    with open(filepath, 'rb') as f:
+        metadata = pickle.load(f)
+    return metadata
+
+
+def extract_vectors(index, filepath, chunk_size=50000):
+    print('Extracting vectors...')
+    vectors = np.lib.format.open_memmap(filepath, mode='w+', dtype='float32',
+                                        shape=(index.ntotal, index.d))
+    for start in tqdm(range(0, index.ntotal, chunk_size)):
+        n = min(chunk_size, index.ntotal - start)
+        vectors[start:start + n] = index.reconstruct_n(start, n)
+    vectors.flush()
+
+
+def convert(dataset_dir, dataset_name):
+    filn_metadata = os.path.join(dataset_dir, f'{dataset_name}_{FILN_METADATA}')
+    filn_faiss = os.path.join(dataset_dir, f'{dataset_name}_{FILN_FAISS_INDEX}')
+    filn_index_config = os.path.join(dataset_dir, f'{dataset_name}_{FILN_INDEX_CONFIG}')
+    filn_vectors = os.path.join(dataset_dir, f'{dataset_name}_{FILN_VECTORS}')
+    dirn_metastore = os.path.join(dataset_dir, f'{dataset_name}_{DIRN_METASTORE}')
+    dirn_lexical = os.path.join(dataset_dir, f'{dataset_name}_{DIRN_LEXICAL}')
+
+    print(f'=== {dataset_name} ===')
+    metadata = load_metadata(filn_metadata)
+    metastore.save_metastore(metadata, dirn_metastore)
+    lexicalindex.save_lexical_index(metadata, dirn_lexical)
+
+    index_config = faissindex.load_index_config(filn_index_config)
+    if os.path.exists(filn_vectors):
+        print(f'{filn_vectors} exists')
+    elif index_config['index_type'] == 'flat' and index_config['storage'] == 'fp32':
+        extract_vectors(faiss.read_index(filn_faiss), filn_vectors)
+    else:
+        print(f"Cannot extract vectors from index type {index_config['index_type']}")
+
+
+if __name__ == '__main__':
+    args, kwargs, flags = parse_args(sys.argv[1:])
+    if len(args) < 1:
+        print(f'Usage  : python {sys.argv[0]} dataset_name [dataset_name ...]')
+        print(f"Example: python {sys.argv[0]} Sitzungsprotokolle_RST --dataset_dir=datasets-release")
+        sys.exit(1)
+
+    dataset_dir = kwargs.get('dataset_dir', '.')
+    for dataset_name in args:
+        convert(dataset_dir, dataset_name)
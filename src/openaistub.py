@@ -0,0 +1,130 @@
+"""
+Local stand-in for the OpenAI embeddings API, for testing builds offline.
+
+Serves POST /v1/embeddings with deterministic pseudo-random unit vectors
+(the same text always gets the same vector), after a simulated latency. It
+enforces its own requests/tokens per minute and answers 429 with a
+retry-after header beyond them, and can fail a share of requests with 500.
+
+Point the OpenAI client at it with OPENAI_BASE_URL:
+
+    python src/openaistub.py --port=8000 --latency=0.3 --rpm=3000 --error_rate=0.01
+    OPENAI_BASE_URL=http://localhost:8000/v1 OPENAI_RKI_KEY=x python src/preprocess.py ...
+"""
+
+import sys
+import json
+import time
+import base64
+import random
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+from myargs import parse_args
+
+
+DEFAULT_DIMS = 3072
+
+
+def fake_embedding(text, dims):
+    seed = int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+    vector = np.random.default_rng(seed).standard_normal(dims).astype('float32')
+    return vector / np.linalg.norm(vector)
+
+
+class MinuteWindow:
+    """
+    counts requests and tokens of the last 60 seconds
+    """
+    def __init__(self, rpm, tpm):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.events = []
+        self.lock = threading.Lock()
+
+    def admit(self, tokens):
+        """
+        returns 0 if admitted, else the seconds until the oldest request
+        leaves the window
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.events = [(t, n) for t, n in self.events if now - t < 60]
+            if len(self.events) + 1 > self.rpm or sum(n for _, n in self.events) + tokens > self.tpm:
+                return max(60 - (now - self.events[0][0]), 0.001) if self.events else 1
+            self.events.append((now, tokens))
+            return 0
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+    error_rate = 0.0
+    window = None
+
+    def send_json(self, status, obj, headers=None):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if not self.path.rstrip('/').endswith('/embeddings'):
+            self.send_json(404, {'error': {'message': 'not found'}})
+            return
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        texts = request['input']
+        if isinstance(texts, str):
+            texts = [texts]
+        dims = request.get('dimensions') or DEFAULT_DIMS
+        # roughly 4 characters per token
+        num_tokens = sum(max(1, len(text) // 4) for text in texts)
+
+        wait = self.window.admit(num_tokens)
+        if wait:
+            self.send_json(429, {'error': {'message': 'rate limit exceeded', 'type': 'rate_limit'}},
+                           headers={'retry-after': f'{wait:.3f}'})
+            return
+        time.sleep(self.latency)
+        if random.random() < self.error_rate:
+            self.send_json(500, {'error': {'message': 'simulated server error'}})
+            return
+
+        data = []
+        for i, text in enumerate(texts):
+            vector = fake_embedding(text, dims)
+            if request.get('encoding_format') == 'base64':
+                embedding = base64.b64encode(vector.tobytes()).decode('ascii')
+            else:
+                embedding = vector.tolist()
+            data.append({'object': 'embedding', 'index': i, 'embedding': embedding})
+        self.send_json(200, {
+            'object': 'list',
+            'data': data,
+            'model': request.get('model'),
+            'usage': {'prompt_tokens': num_tokens, 'total_tokens': num_tokens},
+            })
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+    args, kwargs, flags = parse_args(sys.argv[1:])
+    if 'help' in flags:
+        print(f'Usage  : python {sys.argv[0]} [options]')
+        print(f'Options: --port=8000 --latency=0.3 --rpm=3000 --tpm=1000000 --error_rate=0.0')
+        sys.exit(1)
+
+    port = int(kwargs.get('port', 8000))
+    StubHandler.latency = float(kwargs.get('latency', 0.3))
+    StubHandler.error_rate = float(kwargs.get('error_rate', 0.0))
+    StubHandler.window = MinuteWindow(int(kwargs.get('rpm', 3000)),
+                                      int(kwargs.get('tpm', 1000000)))
+    print(f'Serving fake embeddings on http://localhost:{port}/v1')
+    ThreadingHTTPServer(('', port), StubHandler).serve_forever()
@@ -1,54 +1,135 @@
 import sys
 import os
 import time
+import shutil
 import faiss
 import numpy as np
-import pickle
-from embedding import EmbeddingCache
+from segmentcache import SegmentCache
 from tqdm import tqdm
 
-from textloading import read_text_files_by_paragraph
-from batchpacking import create_optimal_batches
+from textloading import find_text_files, read_files_by_paragraph, Meta
+import batchpacking
 from myargs import parse_args
+import faissindex
+import metastore
+import lexicalindex
+import embedding
+import embedscheduler
+import manifest
 
 
 FILN_FAISS_INDEX = 'faiss.index'
-FILN_METADATA = 'metadata.pkl'
+FILN_INDEX_CONFIG = faissindex.FILN_INDEX_CONFIG
+FILN_VECTORS = faissindex.FILN_VECTORS
+DIRN_METASTORE = metastore.DIRN_METASTORE
+DIRN_LEXICAL = lexicalindex.DIRN_LEXICAL
+FILN_MANIFEST = manifest.FILN_MANIFEST
 
 
-def get_openai_embeddings(meta_batches, embedding_cache, auto_save=False, just_load=False, save_every=100):
-    embeddings = []
-    for index, metas in enumerate(tqdm(meta_batches)):
-        sentence_batch = [meta.para for meta in metas]
-        embedding = embedding_cache.get_batch(sentence_batch, auto_save=False)
-        embeddings.append(embedding)
-        if index % save_every == 0 and not just_load:
-            print('saving cache')
+def get_openai_embeddings(meta_batches, embedding_cache, save_every=100,
+                          workers=embedscheduler.DEFAULT_WORKERS,
+                          rpm=embedscheduler.DEFAULT_RPM,
+                          tpm=embedscheduler.DEFAULT_TPM):
+    """
+    yield the embeddings of each batch, in order. uncached texts are packed
+    into requests again, see batchpacking.py, embedded first, with several
+    requests in flight, see embedscheduler.py, and appended to the cache
+    every save_every batches
+    """
+    uncached = {}
+    for metas in meta_batches:
+        for meta in metas:
+            if meta.para not in uncached and meta.para not in embedding_cache:
+                uncached[meta.para] = meta
+    packed = batchpacking.create_optimal_batches(uncached.values())
+    packed, minutes = batchpacking.schedule_batches(packed, rpm, tpm)
+    new_batches = [[meta.para for meta in batch] for batch in packed]
+    token_counts = [batchpacking.batch_tokens(batch) for batch in packed]
+    if new_batches:
+        stats = batchpacking.packing_stats(packed)
+        print(f'Embedding {stats["items"]} texts in {len(new_batches)} batches '
+              f'(efficiency {stats["efficiency"]:.3f}) with {workers} workers, '
+              f'at least {minutes:.1f} minutes at {rpm} rpm and {tpm} tpm...')
+    results = embedscheduler.embed_batches(embedding_cache.model, new_batches, token_counts,
+                                           workers=workers, rpm=rpm, tpm=tpm)
+    for index, (new_batch, embeddings) in enumerate(tqdm(zip(new_batches, results),
+                                                         total=len(new_batches))):
+        for sentence, embedding in zip(new_batch, embeddings):
+            embedding_cache.put(sentence, embedding)
+        if index % save_every == 0:
             embedding_cache.save_cache()
-    return embeddings
-
-# by normalizing, we effectively perform a cosine search. see faiss github
-def normalize_embeddings(embeddings):
-    print('Normalizing embeddings...')
-    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
-    normalized_embeddings = embeddings / norms
-    return normalized_embeddings
-
-def create_faiss_index(embeddings):
-    print('Creating FAISS index...')
-    dimension = embeddings.shape[1]
-    index = faiss.IndexFlatL2(dimension)
-    index.add(embeddings)
-    return index
+    embedding_cache.save_cache()
+
+    for metas in meta_batches:
+        sentence_batch = [meta.para for meta in metas]
+        yield embedding_cache.get_batch(sentence_batch, auto_save=False)
+
+def write_embeddings(meta_batches, embedding_batches, metadata, vectors):
+    """
+    normalize the embeddings of each batch and write them as float32 into
+    vectors, at the rows of their paragraphs in metadata
+    """
+    seqs = np.array([meta.seq for meta in metadata], dtype='int64')
+    sorter = np.argsort(seqs)
+    for metas, embeddings in zip(meta_batches, embedding_batches):
+        rows = sorter[np.searchsorted(seqs, [meta.seq for meta in metas], sorter=sorter)]
+        # by normalizing, we effectively perform a cosine search. see faiss github
+        embeddings = np.asarray(embeddings, dtype='float32')
+        vectors[rows] = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+def get_unchanged_rows(old_metadata, files, changed):
+    """
+    for an incremental build: the rows of the previous dataset of each
+    unchanged file, as dict of doc_path -> (start, end)
+    """
+    changed = set(changed)
+    old_docs = {old_metadata.doc_paths[doc]: doc for doc in range(len(old_metadata.doc_paths))}
+    unchanged = {}
+    for doc_path in files:
+        if doc_path not in changed and doc_path in old_docs:
+            doc = old_docs[doc_path]
+            unchanged[doc_path] = (int(old_metadata.doc_start[doc]), int(old_metadata.doc_end[doc]))
+    return unchanged
+
+def merge_metadata(new_metadata, old_metadata, unchanged):
+    """
+    rows of the new dataset version, sorted by doc_path: paragraphs of
+    changed files from new_metadata, of unchanged files from old_metadata.
+    returns metadata and the (new row, old start, old end) of unchanged
+    documents
+    """
+    by_doc = {}
+    for meta in new_metadata:
+        by_doc.setdefault(meta.doc_path, []).append(meta)
+    metadata = []
+    copies = []
+    for doc_path in sorted(set(by_doc) | set(unchanged)):
+        if doc_path in unchanged:
+            start, end = unchanged[doc_path]
+            copies.append((len(metadata), start, end))
+            for row in range(start, end):
+                meta = old_metadata[row]
+                metadata.append(Meta(meta.seq, meta.doc_path, meta.para, meta.token_length, meta.kind))
+        else:
+            metadata.extend(by_doc[doc_path])
+    return metadata, copies
+
+def replace_dir(dirpath_new, dirpath):
+    # processes that mapped the old files keep them until they exit
+    dirpath_old = f'{dirpath}.old'
+    shutil.rmtree(dirpath_old, ignore_errors=True)
+    if os.path.exists(dirpath):
+        os.rename(dirpath, dirpath_old)
+    os.rename(dirpath_new, dirpath)
+    shutil.rmtree(dirpath_old, ignore_errors=True)
+
+def create_faiss_index(embeddings, index_config):
+    return faissindex.create_index(embeddings, index_config)
 
 def save_faiss_index(index, filepath):
     print('Saving FAISS index...')
     faiss.write_index(index, filepath)
 
-def save_metadata(metadata, filepath):
-    print('Saving metadata...')
-    with open(filepath, 'wb') as f:
-        pickle.dump(metadata, f)
 
 
 if __name__ == '__main__':
@@ -56,59 +137,156 @@ if __name__ == '__main__':
     if len(args) != 2:
         print(f'Usage  : python {sys.argv[0]} path/to/data dataset_name')
         print(f"Example: python {sys.argv[0]} ./data Zusatzpaket")
+        print(f"Options: --index_type={'|'.join(faissindex.INDEX_TYPES)} --nlist=N --nprobe=N")
+        print(f"         --storage={'|'.join(faissindex.STORAGE_TYPES)} --pq_m=N --rerank=N")
+        print(f"         --hnsw_m=N --ef_construction=N --ef_search=N --train_size=N")
+        print(f"         --coarse_dims=256|512 --coarse_candidates=N (index truncated vectors, re-rank at full dimension)")
+        print(f"         --incremental (only read and embed files changed since the last build)")
+        print(f"         --compact_cache (drop cached embeddings of texts no longer in the data)")
+        print(f"         --load_workers=N (processes reading and tokenizing texts, default: all cores)")
+        print(f"         --workers={embedscheduler.DEFAULT_WORKERS} --rpm={embedscheduler.DEFAULT_RPM} --tpm={embedscheduler.DEFAULT_TPM}")
+        print(f"         --backend={'|'.join(embedding.BACKENDS)} --model=name --dims=N (embedding model, default: {embedding.DEFAULT_MODEL})")
         sys.exit(1)
 
-    if 'continue' in flags:
-        continue_mode = True
-    else:
-        continue_mode = False
+    # --continue is kept for old scripts: an interrupted build always resumes
+    # from the embeddings appended to the cache so far
 
     directory = args[0]
     dataset_name = args[1]
 
     dataset_dir = kwargs.get('dataset_dir', '.')
     os.makedirs(dataset_dir, exist_ok=True)
+    index_config = faissindex.make_index_config(kwargs)
 
-    filn_metadata = os.path.join(dataset_dir, f'{dataset_name}_{FILN_METADATA}')
     filn_faiss = os.path.join(dataset_dir, f'{dataset_name}_{FILN_FAISS_INDEX}')
+    filn_index_config = os.path.join(dataset_dir, f'{dataset_name}_{FILN_INDEX_CONFIG}')
+    filn_vectors = os.path.join(dataset_dir, f'{dataset_name}_{FILN_VECTORS}')
+    dirn_metastore = os.path.join(dataset_dir, f'{dataset_name}_{DIRN_METASTORE}')
+    dirn_lexical = os.path.join(dataset_dir, f'{dataset_name}_{DIRN_LEXICAL}')
+
+    filn_manifest = os.path.join(dataset_dir, f'{dataset_name}_{FILN_MANIFEST}')
+
+    # incremental builds keep the embedding model the dataset was built with
+    if 'incremental' in flags and os.path.exists(filn_index_config):
+        embedding_config = {**embedding.DEFAULT_EMBEDDING_CONFIG,
+                            **faissindex.load_index_config(filn_index_config).get('embedding', {})}
+    else:
+        embedding_config = {
+            'backend': kwargs.get('backend', embedding.DEFAULT_BACKEND),
+            'model': kwargs.get('model'),
+            'dims': int(kwargs['dims']) if 'dims' in kwargs else None,
+        }
+    corpus_embedding_cache = SegmentCache(dataset_name, dataset_dir=dataset_dir,
+                                          backend=embedding_config['backend'],
+                                          model=embedding_config['model'],
+                                          dims=embedding_config['dims'])
+    print(f'Embedding model: {embedding.embedding_config(corpus_embedding_cache.model)}')
+    print(f'Embedding cache holds {len(corpus_embedding_cache)} unique texts')
+
+    print('Checking files...')
+    all_files = find_text_files(directory)
+    old_manifest = manifest.load_manifest(filn_manifest)
+    incremental = 'incremental' in flags
+    if incremental and (old_manifest is None or not os.path.exists(dirn_metastore)
+                        or not os.path.exists(filn_vectors)):
+        print('No previous build with manifest found, building from scratch')
+        incremental = False
+
+    if incremental:
+        # only new and changed files are read and embedded, rows of unchanged
+        # ones are taken over from the previous version
+        files, changed, deleted = manifest.compare_files(old_manifest, all_files)
+        print(f'{len(changed)} new or changed files, {len(deleted)} deleted files')
+        if not changed and not deleted:
+            old_manifest['files'] = files
+            manifest.save_manifest(old_manifest, filn_manifest)
+            print(f'Dataset {dataset_name} is up to date')
+            sys.exit(0)
+        # the index of the previous build is refilled, with its options
+        built_config = faissindex.load_index_config(filn_index_config)
+        changed_options = [key for key in faissindex.DEFAULT_INDEX_CONFIG
+                           if key in kwargs and index_config[key] != built_config[key]]
+        if changed_options:
+            print(f'Cannot change --{", --".join(changed_options)} with --incremental, '
+                  f'the index of the previous build is refilled. Build {dataset_name} without it')
+            sys.exit(1)
+        index_config = built_config
+        old_metadata = metastore.load_metastore(dirn_metastore)
+        old_vectors = faissindex.load_vectors(filn_vectors)
+        unchanged = get_unchanged_rows(old_metadata, files, changed)
+        next_seq = old_manifest['next_seq']
+        version = old_manifest['version'] + 1
+    else:
+        files = {filepath: manifest.file_entry(filepath) for filepath in all_files}
+        changed = all_files
+        unchanged = {}
+        old_metadata = None
+        next_seq = 0
+        version = 1
 
-    corpus_embedding_cache = EmbeddingCache(dataset_name, dataset_dir=dataset_dir)
-    print(f'Embedding cache holds {len(corpus_embedding_cache.values)} unique texts')
+    if index_config['coarse_dims'] >= corpus_embedding_cache.model.dims:
+        print(f"--coarse_dims={index_config['coarse_dims']} must be less than the model's {corpus_embedding_cache.model.dims} dimensions")
+        sys.exit(1)
 
-    metadata = read_text_files_by_paragraph(directory)
+    print('Loading texts...')
+    new_metadata = read_files_by_paragraph(changed, first_seq=next_seq,
+                                           workers=int(kwargs.get('load_workers', os.cpu_count())))
+    next_seq += len(new_metadata)
 
-    # fill embeddings cache
     print('Packing batches...')
-    metadata_batches = create_optimal_batches(metadata)
-    print(f'Generating/loading embeddings for {len(metadata)} texts in {len(metadata_batches)} batches...')
-    embedding_batches = get_openai_embeddings(metadata_batches, corpus_embedding_cache, just_load=continue_mode)
-
-    # now flatten meta and embeddings into flat lists again
-    # so they can be accessed by index returned by faiss search
-    print('Re-organizing...')
-    # Flatten the metadata and embedding batches
-    metadata = [meta for batch in metadata_batches for meta in batch]
-    embeddings = [embedding for batch in embedding_batches for embedding in batch]
-    # Combine metadata and embeddings into a list of tuples
-    combined = list(zip(metadata, embeddings))
-    # Sort the combined list based on the seq field of the Meta namedtuple
-    combined_sorted = sorted(combined, key=lambda x: x[0].seq)
-    # Extract the sorted metadata and embeddings
-    sorted_metadata = [meta for meta, _ in combined_sorted]
-    sorted_embeddings = [embedding for _, embedding in combined_sorted]
-    metadata = sorted_metadata
-    embeddings = sorted_embeddings
-
-    # normalize embeddings before creating the faiss index
-    print('Converting embeddings to numpy...')
-    embeddings = np.array(embeddings)
-    embeddings = normalize_embeddings(embeddings)
-
-    # save cache after that
-    print('Saving embeddings...')
-    corpus_embedding_cache.save_cache()
-    save_metadata(metadata, filn_metadata)
-    faiss_index = create_faiss_index(embeddings)
-    save_faiss_index(faiss_index, filn_faiss)
-
-    print(f'Dataset {dataset_name} created!')
+    metadata_batches = batchpacking.create_optimal_batches(new_metadata)
+    # rows of the dataset: all paragraphs that fit into a batch, by document
+    new_metadata = sorted((meta for batch in metadata_batches for meta in batch),
+                          key=lambda meta: meta.seq)
+    metadata, copies = merge_metadata(new_metadata, old_metadata, unchanged)
+
+    # embeddings go straight into float32 vectors on disk, at their rows
+    print(f'Generating/loading embeddings for {len(new_metadata)} texts in {len(metadata_batches)} batches...')
+    filn_vectors_tmp = f'{filn_vectors}.tmp'
+    vectors = faissindex.create_vectors(filn_vectors_tmp, len(metadata),
+                                        corpus_embedding_cache.model.dims)
+    for row, start, end in copies:
+        vectors[row:row + end - start] = old_vectors[start:end]
+    if corpus_embedding_cache.model.backend == 'local':
+        # no rate limits, one inference at a time uses all cores
+        workers, rpm, tpm = 1, 10**9, 10**12
+    else:
+        workers = int(kwargs.get('workers', embedscheduler.DEFAULT_WORKERS))
+        rpm = int(kwargs.get('rpm', embedscheduler.DEFAULT_RPM))
+        tpm = int(kwargs.get('tpm', embedscheduler.DEFAULT_TPM))
+    embedding_batches = get_openai_embeddings(metadata_batches, corpus_embedding_cache,
+                                              workers=workers, rpm=rpm, tpm=tpm)
+    write_embeddings(metadata_batches, embedding_batches, metadata, vectors)
+    vectors.flush()
+    del vectors
+
+    # drop embeddings of texts that were re-embedded or are no longer needed
+    if 'compact_cache' in flags:
+        corpus_embedding_cache.compact(keep=(meta.para for meta in metadata))
+    elif corpus_embedding_cache.dead_records() > corpus_embedding_cache.num_records // 2:
+        corpus_embedding_cache.compact()
+
+    # the new version is written next to the old one and then moved into place
+    metastore.save_metastore(metadata, f'{dirn_metastore}.tmp')
+    lexicalindex.save_lexical_index(metadata, f'{dirn_lexical}.tmp')
+    if incremental and os.path.exists(filn_faiss):
+        # the old index is already trained
+        faiss_index = faissindex.refill_index(faiss.read_index(filn_faiss),
+                                              faissindex.load_vectors(filn_vectors_tmp),
+                                              index_config)
+    else:
+        faiss_index = create_faiss_index(faissindex.load_vectors(filn_vectors_tmp), index_config)
+    index_config['version'] = version
+    # queries must be embedded by the same model
+    index_config['embedding'] = embedding.embedding_config(corpus_embedding_cache.model)
+    save_faiss_index(faiss_index, f'{filn_faiss}.tmp')
+    os.replace(filn_vectors_tmp, filn_vectors)
+    replace_dir(f'{dirn_metastore}.tmp', dirn_metastore)
+    replace_dir(f'{dirn_lexical}.tmp', dirn_lexical)
+    os.replace(f'{filn_faiss}.tmp', filn_faiss)
+    faissindex.save_index_config(index_config, filn_index_config)
+    # written last: an interrupted build is repeated
+    manifest.save_manifest({'version': version, 'next_seq': next_seq, 'files': files},
+                           filn_manifest)
+
+    print(f'Dataset {dataset_name} version {version} created!')
@@ -0,0 +1,145 @@
+"""
+Persistent query embedding cache, shared by all datasets and workers.
+
+Embeddings of search queries are stored in a SQLite database keyed by
+(model, dims, normalized text), as float32 blobs. The database runs in WAL
+mode, so all gunicorn workers read and write it concurrently, and it
+survives restarts. When it holds more than max_entries embeddings, the least
+recently used ones are deleted.
+
+QueryEmbeddingCache offers get() and get_batch() like EmbeddingCache.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+
+from embedding import create_model, DEFAULT_BACKEND
+
+
+FILN_QUERY_CACHE = 'query_embeddings.sqlite'
+
+# last_used is only updated if older than this, to save writes on hits
+TOUCH_INTERVAL = 60
+# eviction is checked after this many inserts
+EVICT_INTERVAL = 100
+
+
+def normalize_text(text):
+    return ' '.join(text.split())
+
+
+class QueryEmbeddingCache:
+    def __init__(self, filepath, model=None, dims=None, max_entries=20000,
+                 backend=DEFAULT_BACKEND):
+        self.model = create_model(backend, model, dims)
+        self.filepath = filepath
+        self.max_entries = max_entries
+        self.local = threading.local()
+        self.num_inserts = 0
+        conn = self.connect()
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS embeddings ('
+                         ' model TEXT NOT NULL,'
+                         ' dims INTEGER NOT NULL,'
+                         ' text TEXT NOT NULL,'
+                         ' vector BLOB NOT NULL,'
+                         ' last_used REAL NOT NULL,'
+                         ' PRIMARY KEY (model, dims, text))')
+            conn.execute('CREATE INDEX IF NOT EXISTS embeddings_last_used'
+                         ' ON embeddings (last_used)')
+        print(f'Query embedding cache {filepath} holds {len(self)} texts (max_entries={max_entries})')
+
+    def connect(self):
+        # one connection per thread; a worker forked after __init__ opens
+        # its own instead of sharing the parent's
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.filepath, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def __len__(self):
+        conn = self.connect()
+        return conn.execute('SELECT COUNT(*) FROM embeddings WHERE model = ? AND dims = ?',
+                            (self.model.cache_name, self.model.dims)).fetchone()[0]
+
+    def lookup(self, texts):
+        """
+        dict of normalized text -> embedding for the cached ones of texts
+        """
+        conn = self.connect()
+        found = {}
+        stale = []
+        now = time.time()
+        for text in set(texts):
+            row = conn.execute('SELECT vector, last_used FROM embeddings'
+                               ' WHERE model = ? AND dims = ? AND text = ?',
+                               (self.model.cache_name, self.model.dims, text)).fetchone()
+            if row is None:
+                continue
+            found[text] = np.frombuffer(row[0], dtype='float32')
+            if now - row[1] > TOUCH_INTERVAL:
+                stale.append(text)
+        if stale:
+            with conn:
+                conn.executemany('UPDATE embeddings SET last_used = ?'
+                                 ' WHERE model = ? AND dims = ? AND text = ?',
+                                 [(now, self.model.cache_name, self.model.dims, text) for text in stale])
+        return found
+
+    def store(self, embeddings):
+        """
+        embeddings: dict of normalized text -> embedding
+        """
+        conn = self.connect()
+        now = time.time()
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?)',
+                             [(self.model.cache_name, self.model.dims, text,
+                               np.asarray(embedding, dtype='float32').tobytes(), now)
+                              for text, embedding in embeddings.items()])
+        self.num_inserts += len(embeddings)
+        if self.num_inserts >= EVICT_INTERVAL:
+            self.num_inserts = 0
+            self.evict()
+
+    def evict(self):
+        conn = self.connect()
+        with conn:
+            total = conn.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+            if total > self.max_entries:
+                conn.execute('DELETE FROM embeddings WHERE rowid IN'
+                             ' (SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)',
+                             (total - self.max_entries,))
+
+    def get(self, sentence, auto_save=False, keep_stats=False):
+        text = normalize_text(sentence)
+        found = self.lookup([text])
+        if text in found:
+            return found[text]
+        embedding, stats = self.model.get_embeddings(text, keep_stats=keep_stats)
+        self.store({text: embedding})
+        return np.asarray(embedding, dtype='float32')
+
+    def uncached(self, sentence_batch):
+        texts = list(dict.fromkeys(normalize_text(s) for s in sentence_batch))
+        found = self.lookup(texts)
+        return [text for text in texts if text not in found]
+
+    def get_batch(self, sentence_batch, auto_save=False):
+        texts = [normalize_text(s) for s in sentence_batch]
+        found = self.lookup(texts)
+        new_batch = list(dict.fromkeys(text for text in texts if text not in found))
+        if new_batch:
+            embeddings, stats = self.model.get_embeddings_batch(new_batch)
+            new_embeddings = dict(zip(new_batch, embeddings))
+            self.store(new_embeddings)
+            for text, embedding in new_embeddings.items():
+                found[text] = np.asarray(embedding, dtype='float32')
+        return [found[text] for text in texts]
@@ -0,0 +1,67 @@
+"""
+In-memory cache of serialized API responses.
+
+Shared search links cause bursts of identical requests. Their JSON responses
+are kept as bytes, so a hit skips search, formatting and serialization. The
+cache is bounded by the total size of the responses (least recently used
+ones are evicted first) and entries expire after ttl seconds.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+# rough per-entry overhead of key, tuple and dict slot
+ENTRY_OVERHEAD = 200
+
+
+class ResultCache:
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=3600):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.values = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is not None and entry[0] < time.time():
+                self.remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.values.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, data):
+        size = len(data) + ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.values:
+                self.remove(key)
+            self.values[key] = (time.time() + self.ttl, data)
+            self.num_bytes += size
+            while self.num_bytes > self.max_bytes:
+                self.remove(next(iter(self.values)))
+
+    def remove(self, key):
+        _, data = self.values.pop(key)
+        self.num_bytes -= len(data) + ENTRY_OVERHEAD
+
+    def stats(self):
+        with self.lock:
+            return {
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'entries': len(self.values),
+                    'bytes': self.num_bytes,
+                    'max_bytes': self.max_bytes,
+                    'ttl': self.ttl,
+                   }
@@ -0,0 +1,241 @@
+"""
+Micro-batching of concurrent searches in one index.
+
+FAISS answers many queries at once much faster than the same queries one
+by one, and concurrent single-query searches each start their own OpenMP
+threads, which oversubscribes the CPU. A SearchExecutor wraps the index of a
+dataset: searches from concurrent request threads are queued, and a batch
+thread takes the first one, waits up to max_wait_ms for more, and runs all
+of them (up to max_batch_size query vectors) as one multi-query search. Each
+caller waits for its own rows of the result.
+
+SearchExecutor quacks like a faiss index as far as main.search_faiss_index()
+cares, so it can stand in for any index, RerankIndex or SubsetIndex.
+
+To measure queries per second and latency under load:
+
+    python src/searchexecutor.py --vectors=datasets-release/pei_files_vectors.npy --clients=1,8,32
+"""
+
+import sys
+import os
+import time
+import queue
+import threading
+from concurrent.futures import Future
+import faiss
+import numpy as np
+
+from myargs import parse_args
+
+
+MAX_BATCH_SIZE = 32
+MAX_WAIT_MS = 2
+THREADS = 1
+
+
+class SearchExecutor:
+    """
+    threads: number of batches searched at the same time
+    """
+    def __init__(self, index, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS, threads=THREADS):
+        self.index = index
+        self.ntotal = index.ntotal
+        self.d = index.d
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.num_threads = threads
+        self.queue = None
+        self.lock = threading.Lock()
+        # threads are started by the first search: a gunicorn worker forked
+        # after __init__ starts its own
+        self.pid = None
+        self.closed = False
+        self.num_requests = 0
+        self.num_queries = 0
+        self.num_batches = 0
+        self.max_batch = 0
+
+    def start(self):
+        # called with self.lock held. each thread set gets its own queue
+        self.pid = os.getpid()
+        self.queue = queue.Queue()
+        for _ in range(self.num_threads):
+            threading.Thread(target=self.run, args=(self.queue,), daemon=True).start()
+
+    def submit(self, query_embeddings, k):
+        """
+        returns a Future of (distances, indices)
+        """
+        future = Future()
+        query_embeddings = np.ascontiguousarray(query_embeddings, dtype='float32')
+        with self.lock:
+            if not self.closed:
+                if self.pid != os.getpid():
+                    self.start()
+                self.queue.put((query_embeddings, k, future))
+                return future
+        # closed: searches that still hold the executor search by themselves
+        try:
+            future.set_result(self.index.search(query_embeddings, k))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def search(self, query_embeddings, k):
+        return self.submit(query_embeddings, k).result()
+
+    def close(self):
+        """
+        stop the batch threads once the queued searches are done, so that
+        they release the index
+        """
+        with self.lock:
+            self.closed = True
+            if self.pid == os.getpid():
+                for _ in range(self.num_threads):
+                    self.queue.put(None)
+            self.pid = None
+            self.queue = None
+
+    def collect(self, q):
+        first = q.get()
+        if first is None:
+            return None
+        batch = [first]
+        n = len(first[0])
+        deadline = time.monotonic() + self.max_wait
+        while n < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    item = q.get(timeout=timeout)
+                else:
+                    # whatever is queued already comes along
+                    item = q.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # put back, it stops a thread after this batch
+                q.put(None)
+                break
+            batch.append(item)
+            n += len(item[0])
+        return batch
+
+    def run(self, q):
+        while True:
+            batch = self.collect(q)
+            if batch is None:
+                break
+            self.run_batch(batch)
+
+    def run_batch(self, batch):
+        # searches with the same k are run together
+        by_k = {}
+        for item in batch:
+            by_k.setdefault(item[1], []).append(item)
+        for k, items in by_k.items():
+            try:
+                query_embeddings = np.concatenate([item[0] for item in items])
+                distances, indices = self.index.search(query_embeddings, k)
+            except Exception as e:
+                for _, _, future in items:
+                    future.set_exception(e)
+                continue
+            with self.lock:
+                self.num_requests += len(items)
+                self.num_queries += len(query_embeddings)
+                self.num_batches += 1
+                self.max_batch = max(self.max_batch, len(query_embeddings))
+            start = 0
+            for queries, _, future in items:
+                end = start + len(queries)
+                future.set_result((distances[start:end], indices[start:end]))
+                start = end
+
+    def stats(self):
+        with self.lock:
+            return {
+                    'requests': self.num_requests,
+                    'queries': self.num_queries,
+                    'batches': self.num_batches,
+                    'avg_batch': self.num_queries / self.num_batches if self.num_batches else 0.0,
+                    'max_batch': self.max_batch,
+                    'max_batch_size': self.max_batch_size,
+                    'max_wait_ms': self.max_wait * 1000,
+                    'threads': self.num_threads,
+                   }
+
+
+def benchmark(index, queries, clients, seconds, k):
+    """
+    clients threads search single queries in a loop for seconds. returns
+    queries per second and the latencies in ms
+    """
+    latencies = [[] for _ in range(clients)]
+    stop = time.monotonic() + seconds
+
+    def client(c):
+        i = c
+        while time.monotonic() < stop:
+            start = time.perf_counter()
+            index.search(queries[i % len(queries)][None], k)
+            latencies[c].append((time.perf_counter() - start) * 1000)
+            i += clients
+
+    threads = [threading.Thread(target=client, args=(c,)) for c in range(clients)]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+    latencies = np.concatenate([np.array(l) for l in latencies])
+    return len(latencies) / elapsed, latencies
+
+
+def print_benchmark(name, qps, latencies):
+    print(f'{name:28s}: {qps:8.1f} q/s  p50 {np.percentile(latencies, 50):7.2f} ms  '
+          f'p99 {np.percentile(latencies, 99):7.2f} ms')
+
+
+if __name__ == '__main__':
+    import faissindex
+
+    args, kwargs, flags = parse_args(sys.argv[1:])
+    if 'help' in flags:
+        print(f'Usage  : python {sys.argv[0]}')
+        print(f'Compares single-query searches from concurrent clients with micro-batched ones')
+        print(f'Options: --vectors=path/to/vectors.npy (default: --n=100000 random vectors of --d=3072 dims)')
+        print(f'         --clients=1,8,32 --seconds=5 --k=20 --faiss_threads=N')
+        print(f'         --max_batch_size={MAX_BATCH_SIZE} --wait_ms=1,2,5 --threads={THREADS}')
+        sys.exit(1)
+
+    if 'vectors' in kwargs:
+        vectors = faissindex.load_vectors(kwargs['vectors'])
+    else:
+        rng = np.random.default_rng(1234)
+        vectors = rng.standard_normal((int(kwargs.get('n', 100000)), int(kwargs.get('d', 3072))),
+                                      dtype='float32')
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    if 'faiss_threads' in kwargs:
+        faiss.omp_set_num_threads(int(kwargs['faiss_threads']))
+    index = faissindex.MmapFlatIndex(vectors)
+    rng = np.random.default_rng(4321)
+    queries = np.array(vectors[np.sort(rng.choice(len(vectors), size=min(1000, len(vectors)), replace=False))])
+    k = int(kwargs.get('k', 20))
+    seconds = float(kwargs.get('seconds', 5))
+    max_batch_size = int(kwargs.get('max_batch_size', MAX_BATCH_SIZE))
+    threads = int(kwargs.get('threads', THREADS))
+    print(f'{len(vectors)} vectors of {vectors.shape[1]} dims, k={k}, {faiss.omp_get_max_threads()} faiss threads')
+
+    for clients in [int(c) for c in kwargs.get('clients', '1,8,32').split(',')]:
+        print(f'--- {clients} clients ---')
+        print_benchmark('direct', *benchmark(index, queries, clients, seconds, k))
+        for wait_ms in [float(w) for w in kwargs.get('wait_ms', '1,2,5').split(',')]:
+            executor = SearchExecutor(index, max_batch_size=max_batch_size, max_wait_ms=wait_ms,
+                                      threads=threads)
+            qps, latencies = benchmark(executor, queries, clients, seconds, k)
+            print_benchmark(f'batched, wait {wait_ms:g} ms', qps, latencies)
+            print(f"{'':28s}  avg batch {executor.stats()['avg_batch']:.1f}")
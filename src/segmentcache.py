@@ -0,0 +1,237 @@
+"""
+Append-only, segmented cache of corpus embeddings.
+
+EmbeddingCache pickles all its embeddings again on every save, which takes
+longer and longer as a build goes on, and loses everything since the last
+save on a crash. SegmentCache appends instead:
+
+    <name>_<model>_<dims>_segments/
+        seg-000000.keys      16-byte hashes of the texts, one per record
+        seg-000000.vec       float32[dims] records, same order
+        seg-000001.keys
+        ...
+
+New embeddings are buffered and appended to the newest segment on
+save_cache(), which fsyncs the files; a segment holds up to segment_size
+records. Vectors are written before their keys, so a record whose key is
+on disk is complete; a torn write at the end of a segment is ignored on
+open. Opening the cache only reads the key files, so resuming a build costs
+nothing. When a text is embedded again, the newest record wins; compact()
+rewrites the live records (optionally only those still needed) into new
+segments, and an interrupted compaction is finished or undone on open.
+
+An existing pickled EmbeddingCache is imported once.
+"""
+
+import os
+import glob
+import shutil
+import pickle
+import hashlib
+import numpy as np
+
+from embedding import create_model, DEFAULT_BACKEND
+
+
+KEY_SIZE = 16
+DEFAULT_SEGMENT_SIZE = 20000
+
+
+def text_key(text):
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=KEY_SIZE).digest()
+
+
+def fsync_append(filepath, data):
+    with open(filepath, 'ab') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class SegmentCache:
+    def __init__(self, name, model=None, dataset_dir='.',
+                 segment_size=DEFAULT_SEGMENT_SIZE, backend=DEFAULT_BACKEND, dims=None):
+        self.model = create_model(backend, model, dims)
+        self.dims = self.model.dims
+        self.record_size = self.dims * 4
+        self.segment_size = segment_size
+        self.dirpath = os.path.join(dataset_dir, f'{name}_{self.model.cache_name}_{self.model.dims}_segments')
+        self.pickle_file = os.path.join(dataset_dir, f'{name}_{self.model.cache_name}_{self.model.dims}.pkl')
+        self.recover_compaction()
+        os.makedirs(self.dirpath, exist_ok=True)
+        self.open_segments()
+        if not self.index and os.path.exists(self.pickle_file):
+            self.import_pickle()
+
+    def recover_compaction(self):
+        """
+        finish or undo a compact() that was interrupted
+        """
+        dirpath_new = f'{self.dirpath}.compact'
+        dirpath_old = f'{self.dirpath}.old'
+        if (os.path.isdir(self.dirpath) and os.path.isdir(dirpath_old)
+                and not glob.glob(os.path.join(self.dirpath, 'seg-*'))):
+            # left empty by a crash between the renames
+            os.rmdir(self.dirpath)
+        if not os.path.isdir(self.dirpath):
+            if os.path.isdir(dirpath_old) and os.path.isdir(dirpath_new):
+                # the new segments were complete before the first rename
+                print('Finishing interrupted compaction of', self.dirpath, flush=True)
+                os.rename(dirpath_new, self.dirpath)
+            elif os.path.isdir(dirpath_old):
+                print('Restoring', self.dirpath, 'from', dirpath_old, flush=True)
+                os.rename(dirpath_old, self.dirpath)
+        # the old segments of a finished compaction, or incomplete new ones
+        shutil.rmtree(dirpath_old, ignore_errors=True)
+        shutil.rmtree(dirpath_new, ignore_errors=True)
+
+    def segment_path(self, segment, ext):
+        return os.path.join(self.dirpath, f'seg-{segment:06d}.{ext}')
+
+    def open_segments(self):
+        """
+        build the hash index from the key files
+        """
+        self.index = {}         # key -> (segment, record)
+        self.pending = {}       # key -> embedding, not yet on disk
+        self.pending_keys = []
+        self.mapped = {}        # segment -> memmap of its vectors
+        self.num_records = 0
+        num_segments = len({os.path.splitext(filn)[0]
+                             for filn in glob.glob(os.path.join(self.dirpath, 'seg-*'))})
+        self.segment_counts = []
+        for segment in range(num_segments):
+            filn_keys = self.segment_path(segment, 'keys')
+            filn_vec = self.segment_path(segment, 'vec')
+            keys = np.fromfile(filn_keys, dtype=f'V{KEY_SIZE}') if os.path.exists(filn_keys) else []
+            num_vectors = os.path.getsize(filn_vec) // self.record_size if os.path.exists(filn_vec) else 0
+            count = min(len(keys), num_vectors)
+            self.truncate(segment, count)
+            for record, key in enumerate(keys[:count]):
+                self.index[key.tobytes()] = (segment, record)
+            self.segment_counts.append(count)
+            self.num_records += count
+        if self.num_records:
+            print(f'Embedding cache: {len(self.index)} texts in {num_segments} segments')
+
+    def truncate(self, segment, count):
+        # drop the incomplete tail of a write that was interrupted
+        for ext, size in (('keys', KEY_SIZE), ('vec', self.record_size)):
+            filepath = self.segment_path(segment, ext)
+            if os.path.exists(filepath) and os.path.getsize(filepath) > count * size:
+                print(f'Truncating incomplete records of {filepath}')
+                with open(filepath, 'r+b') as f:
+                    f.truncate(count * size)
+
+    def import_pickle(self):
+        print(f'Importing {self.pickle_file} into {self.dirpath}...')
+        with open(self.pickle_file, 'rb') as f:
+            values = pickle.load(f)
+        for sentence, embedding in values.items():
+            self.put(sentence, embedding)
+        self.save_cache()
+
+    def __len__(self):
+        return len(self.index) + len(self.pending)
+
+    def __contains__(self, sentence):
+        key = text_key(sentence)
+        return key in self.pending or key in self.index
+
+    def uncached(self, sentence_batch):
+        # unique sentences of the batch that are not cached, in order
+        return list(dict.fromkeys(s for s in sentence_batch if s not in self))
+
+    def put(self, sentence, embedding):
+        key = text_key(sentence)
+        if key not in self.pending:
+            self.pending_keys.append(key)
+        self.pending[key] = np.asarray(embedding, dtype='float32')
+
+    def save_cache(self):
+        """
+        append pending embeddings to the segments and fsync them
+        """
+        start = 0
+        while start < len(self.pending_keys):
+            if not self.segment_counts or self.segment_counts[-1] >= self.segment_size:
+                self.segment_counts.append(0)
+            segment = len(self.segment_counts) - 1
+            n = min(self.segment_size - self.segment_counts[segment], len(self.pending_keys) - start)
+            keys = self.pending_keys[start:start + n]
+            vectors = np.stack([self.pending[key] for key in keys])
+            # vectors first: a key on disk implies a complete record
+            fsync_append(self.segment_path(segment, 'vec'), vectors.tobytes())
+            fsync_append(self.segment_path(segment, 'keys'), b''.join(keys))
+            for i, key in enumerate(keys):
+                self.index[key] = (segment, self.segment_counts[segment] + i)
+            self.segment_counts[segment] += n
+            self.num_records += n
+            self.mapped.pop(segment, None)
+            start += n
+        self.pending = {}
+        self.pending_keys = []
+        self.model.save_stats()
+
+    def vectors(self, segment):
+        if segment not in self.mapped:
+            self.mapped[segment] = np.memmap(self.segment_path(segment, 'vec'), dtype='float32',
+                                             mode='r', shape=(self.segment_counts[segment], self.dims))
+        return self.mapped[segment]
+
+    def get_batch(self, sentence_batch, auto_save=False):
+        """
+        cached embeddings of all sentences of the batch, as float32 arrays
+        """
+        embeddings = [None] * len(sentence_batch)
+        by_segment = {}
+        for i, sentence in enumerate(sentence_batch):
+            key = text_key(sentence)
+            if key in self.pending:
+                embeddings[i] = self.pending[key]
+            else:
+                segment, record = self.index[key]
+                by_segment.setdefault(segment, []).append((i, record))
+        for segment, positions in by_segment.items():
+            rows = self.vectors(segment)[[record for _, record in positions]]
+            for (i, _), row in zip(positions, rows):
+                embeddings[i] = row
+        return embeddings
+
+    def compact(self, keep=None):
+        """
+        rewrite the live records into new segments. keep: optional sentences
+        to keep, all others are dropped
+        """
+        self.save_cache()
+        if keep is not None:
+            keep_keys = {text_key(sentence) for sentence in keep}
+        else:
+            keep_keys = self.index.keys()
+        live = [(key, location) for key, location in self.index.items() if key in keep_keys]
+        live.sort(key=lambda item: item[1])
+        print(f'Compacting embedding cache: {self.num_records} records -> {len(live)}')
+
+        dirpath_new = f'{self.dirpath}.compact'
+        shutil.rmtree(dirpath_new, ignore_errors=True)
+        os.makedirs(dirpath_new)
+        for segment, start in enumerate(range(0, len(live), self.segment_size)):
+            chunk = live[start:start + self.segment_size]
+            vectors = np.empty((len(chunk), self.dims), dtype='float32')
+            for i, (_, (old_segment, record)) in enumerate(chunk):
+                vectors[i] = self.vectors(old_segment)[record]
+            filn = os.path.join(dirpath_new, f'seg-{segment:06d}')
+            fsync_append(f'{filn}.vec', vectors.tobytes())
+            fsync_append(f'{filn}.keys', b''.join(key for key, _ in chunk))
+
+        self.mapped = {}
+        # a crash from here on is recovered by recover_compaction()
+        dirpath_old = f'{self.dirpath}.old'
+        shutil.rmtree(dirpath_old, ignore_errors=True)
+        os.rename(self.dirpath, dirpath_old)
+        os.rename(dirpath_new, self.dirpath)
+        shutil.rmtree(dirpath_old)
+        self.open_segments()
+
+    def dead_records(self):
+        return self.num_records - len(self.index)
@@ -1,8 +1,14 @@
+import sys
 import os
+import time
 from tqdm import tqdm
 import tiktoken
 import re
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+
+from myargs import parse_args
 
 Meta = namedtuple('Meta', ['seq', 'doc_path', 'para', 'token_length', 'kind'])
 
@@ -65,31 +71,79 @@ def textfile_to_paras(filn):
     return paras
 
 
-def read_text_files_by_paragraph(directory, extension='.txt'):
-    """
-    return metadata, where metadata is a tuple of filename,
-    paragraph text, num_tokens, and kind. atm kind is always paragraph.
-    """
-    metadata = []  # To store the document, paragraph/table info, and the text
-    print('Loading texts...')
-
-    # first, collect files
+def find_text_files(directory, extension='.txt'):
     all_files = []
     for dirpath, _, filenames in os.walk(directory):
         for filename in filenames:
             if filename.endswith(extension):
                 doc_path = os.path.join(dirpath, filename)
                 all_files.append(doc_path)
+    return sorted(all_files)
+
+
+def read_text_files_by_paragraph(directory, extension='.txt', workers=1):
+    """
+    return metadata, where metadata is a tuple of filename,
+    paragraph text, num_tokens, and kind. atm kind is always paragraph.
+    """
+    print('Loading texts...')
+    return read_files_by_paragraph(find_text_files(directory, extension), workers=workers)
+
+
+def load_files(doc_paths):
+    """
+    paragraphs and their token lengths of each file, tokenized as a batch.
+    runs in the worker processes of read_files_by_paragraph()
+    """
+    results = []
+    for doc_path in doc_paths:
+        paras = [para.strip() for para in textfile_to_paras(doc_path)]
+        paras = [para for para in paras if para]  # Ensure that the text is not empty
+        # one thread per process: the processes are the parallelism
+        tokens = openai_encoding.encode_batch(paras, num_threads=1) if paras else []
+        results.append((doc_path, paras, [len(t) for t in tokens]))
+    return results
+
 
-    # process files
-    seq = 0
-    for doc_path in tqdm(sorted(all_files)):
-        # print('Processing', doc_path)
-        # Extract paragraphs
-        for para in textfile_to_paras(doc_path):
-            para = para.strip()
-            if para:  # Ensure that the text is not empty
-                metadata.append(Meta(seq, doc_path, para, token_length(para), "paragraph"))
-                seq += 1
+def read_files_by_paragraph(doc_paths, first_seq=0, workers=1, files_per_task=50):
+    """
+    metadata of the given files, numbered from first_seq on. With workers > 1,
+    files are loaded by a process pool; results are merged in file order, so
+    seqs are the same as with one worker.
+    """
+    tasks = [doc_paths[i:i + files_per_task] for i in range(0, len(doc_paths), files_per_task)]
+    metadata = []  # To store the document, paragraph/table info, and the text
+    seq = first_seq
+    with ProcessPoolExecutor(max_workers=workers) if workers > 1 else nullcontext() as pool:
+        results = pool.map(load_files, tasks) if pool else map(load_files, tasks)
+        for task_results in tqdm(results, total=len(tasks)):
+            for doc_path, paras, token_lengths in task_results:
+                for para, length in zip(paras, token_lengths):
+                    metadata.append(Meta(seq, doc_path, para, length, "paragraph"))
+                    seq += 1
     return metadata
 
+
+if __name__ == '__main__':
+    args, kwargs, flags = parse_args(sys.argv[1:])
+    if len(args) != 1:
+        print(f'Usage  : python {sys.argv[0]} path/to/data')
+        print(f'Measures paragraphs per second of text loading by number of worker processes')
+        print(f'Options: --workers=1,2,4,{os.cpu_count()} --extension=.txt')
+        sys.exit(1)
+
+    all_files = find_text_files(args[0], kwargs.get('extension', '.txt'))
+
+    default_workers = sorted({1, 2, 4, os.cpu_count()})
+    reference = None
+    reference_workers = None
+    for workers in kwargs.get('workers', ','.join(map(str, default_workers))).split(','):
+        workers = int(workers)
+        start = time.time()
+        metadata = read_files_by_paragraph(all_files, workers=workers)
+        elapsed = time.time() - start
+        if reference is None:
+            reference, reference_workers = metadata, workers
+        elif metadata != reference:
+            print(f'workers={workers}: results differ from workers={reference_workers}!')
+        print(f'workers={workers:3d}: {len(metadata) / elapsed:10.1f} paras/s ({len(metadata)} paras, {elapsed:.2f}s)')
@@ -0,0 +1,162 @@
+"""
+One shared vector store with named subsets instead of separate datasets.
+
+The store is a normal dataset built by preprocess.py over the whole data
+directory. Subsets are defined in `<store>_subsets.json` next to it:
+
+    {
+        "corona_BKA": {"paths": ["data/corona-protokolle/Bundeskanzleramt"]},
+        "corona_MPK": {"paths": ["data/corona-protokolle/kanzlerin"]},
+        "corona_ALL": {"union": ["corona_BKA", "corona_MPK"]}
+    }
+
+`paths` are directories (or single files) of the document paths, `union`
+combines other subsets. Searches in a subset are restricted to its rows at
+query time, so defining a new subset needs no rebuild and no extra memory.
+
+preprocess.py sorts documents by path, so every directory maps to one
+contiguous range of rows, which is found by bisection. Stores with unsorted
+rows are refused.
+"""
+
+import sys
+import os
+import json
+from bisect import bisect_left, bisect_right
+import numpy as np
+
+import faissindex
+import metastore
+from myargs import parse_args
+
+
+FILN_SUBSETS = 'subsets.json'
+FILN_INDEX_CONFIG = faissindex.FILN_INDEX_CONFIG
+
+
+def load_subsets(filepath):
+    with open(filepath, 'rt') as f:
+        return json.load(f)
+
+
+def get_doc_paths(metadata):
+    if isinstance(metadata, metastore.MetaStore):
+        return metadata.doc_path_column()
+    return [meta.doc_path for meta in metadata]
+
+
+def merge_ranges(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def check_sorted(metadata):
+    """
+    subsets are found by bisection: raise if the rows are not sorted by
+    doc_path, as in stores built before preprocess.py sorted them
+    """
+    if isinstance(metadata, metastore.MetaStore):
+        # documents are numbered in order of their first row
+        doc_paths = [metadata.doc_paths[doc] for doc in range(len(metadata.doc_paths))]
+        is_sorted = bool(np.all(np.diff(np.asarray(metadata.doc_ids)) >= 0))
+    else:
+        doc_paths = [meta.doc_path for meta in metadata]
+        is_sorted = True
+    if not is_sorted or any(a > b for a, b in zip(doc_paths, doc_paths[1:])):
+        raise ValueError('Rows of the vector store are not sorted by doc_path, build it again')
+
+
+def prefix_ranges(doc_paths, prefix):
+    """
+    rows of the file prefix and of the files below the directory prefix
+    (but not of data/kanzlerin_alt for data/kanzlerin)
+    """
+    ranges = [(bisect_left(doc_paths, prefix), bisect_right(doc_paths, prefix))]
+    prefix = prefix.rstrip('/') + '/'
+    start = bisect_left(doc_paths, prefix)
+    # the highest code point sorts after every continuation of the prefix
+    end = bisect_left(doc_paths, prefix + '\U0010ffff', lo=start)
+    ranges.append((start, end))
+    return [(start, end) for start, end in ranges if start < end]
+
+
+def get_subset_ranges(subsets, subset_name, doc_paths, _path=frozenset(), _resolved=None):
+    """
+    _path: the unions being resolved, _resolved: subset name -> ranges of the
+    subsets resolved so far, shared by all subsets of one store
+    """
+    if _resolved is None:
+        _resolved = {}
+    if subset_name in _resolved:
+        return _resolved[subset_name]
+    if subset_name in _path:
+        raise ValueError(f'Subset {subset_name} is defined recursively')
+    _path = _path | {subset_name}
+
+    definition = subsets[subset_name]
+    ranges = []
+    for prefix in definition.get('paths', []):
+        found = prefix_ranges(doc_paths, prefix)
+        if not found:
+            print(f'Subset {subset_name}: no documents match {prefix}')
+        ranges.extend(found)
+    for other in definition.get('union', []):
+        ranges.extend(get_subset_ranges(subsets, other, doc_paths, _path, _resolved))
+    _resolved[subset_name] = merge_ranges([r for r in ranges if r[0] < r[1]])
+    return _resolved[subset_name]
+
+
+def load_subset_ranges(dataset_dir, store_name, metadata):
+    """
+    return a dict of subset name -> row ranges of the subset
+    """
+    filn_subsets = os.path.join(dataset_dir, f'{store_name}_{FILN_SUBSETS}')
+    subsets = load_subsets(filn_subsets)
+    check_sorted(metadata)
+    doc_paths = get_doc_paths(metadata)
+    resolved = {}
+    return {subset_name: get_subset_ranges(subsets, subset_name, doc_paths, _resolved=resolved)
+            for subset_name in subsets}
+
+
+def get_subset_indexes(dataset_dir, store_name, metadata, faiss_index):
+    """
+    return a dict of subset name -> index restricted to the subset
+    """
+    filn_index_config = os.path.join(dataset_dir, f'{store_name}_{FILN_INDEX_CONFIG}')
+    index_config = faissindex.load_index_config(filn_index_config)
+
+    subset_indexes = {}
+    for subset_name, ranges in load_subset_ranges(dataset_dir, store_name, metadata).items():
+        subset_indexes[subset_name] = faissindex.restrict_index(faiss_index, ranges, index_config)
+        print(f'Subset {subset_name}: {subset_indexes[subset_name].ntotal} of {len(metadata)} paragraphs')
+    return subset_indexes
+
+
+if __name__ == '__main__':
+    args, kwargs, flags = parse_args(sys.argv[1:])
+    if len(args) != 1:
+        print(f'Usage  : python {sys.argv[0]} store_name')
+        print(f'Shows the sizes and row ranges of the subsets of a vector store')
+        print(f"Example: python {sys.argv[0]} corona_STORE --dataset_dir=datasets-release")
+        sys.exit(1)
+
+    store_name = args[0]
+    dataset_dir = kwargs.get('dataset_dir', '.')
+    dirn_metastore = os.path.join(dataset_dir, f'{store_name}_{metastore.DIRN_METASTORE}')
+    filn_subsets = os.path.join(dataset_dir, f'{store_name}_{FILN_SUBSETS}')
+
+    metadata = metastore.load_metastore(dirn_metastore)
+    subsets = load_subsets(filn_subsets)
+    check_sorted(metadata)
+    doc_paths = metadata.doc_path_column()
+    resolved = {}
+    for subset_name in subsets:
+        ranges = get_subset_ranges(subsets, subset_name, doc_paths, _resolved=resolved)
+        size = sum(end - start for start, end in ranges)
+        print(f'{subset_name}: {size} paragraphs in {len(ranges)} ranges {ranges[:5]}')